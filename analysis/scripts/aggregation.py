@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing the (plot-free) binned aggregates from which the exploratory plots are
+    rendered: 1-D and 2-D histograms and correlation estimates are accumulated over chunks of
+    rows in NumPy, such that the plots only draw a fixed number of bins whatever the number of
+    vectors.
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import numpy as np
+import pandas as pd
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------1-D aggregates--------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_values(serie):
+    """
+    Returns the non missing values of a column as a float numpy array
+
+    Parameters
+    -------------
+    serie: pandas Series or numpy ndarray
+
+    Returns
+    -------------
+    values: numpy ndarray
+    """
+    values = np.asarray(serie, dtype=np.float64)
+    return values[~np.isnan(values)]
+
+def get_central_range(values_list, ratio_pop_show=0.9):
+    """
+    Returns the interval containing the central ratio_pop_show of every population (the union of
+    their central intervals), used to hide the outliers
+
+    Parameters
+    -------------
+    values_list: list(numpy ndarray)
+        the values of each population
+    ratio_pop_show: float, default 0.9
+        the ratio of each population that must be inside the interval
+
+    Returns
+    -------------
+    lower, upper: float
+    """
+    lower_quantile = (1-ratio_pop_show)/2
+    upper_quantile = 1-lower_quantile
+    lower = min(np.quantile(v, lower_quantile) for v in values_list)
+    upper = max(np.quantile(v, upper_quantile) for v in values_list)
+    return lower, upper
+
+def histogram_1d(values, edges, chunk_size=1000000):
+    """
+    Accumulates the histogram of values over chunks of rows (the values outside of the edges are not counted)
+
+    Parameters
+    -------------
+    values: numpy ndarray
+    edges: numpy ndarray
+        the edges of the bins
+    chunk_size: int, default 1000000
+        the number of values processed at once
+
+    Returns
+    -------------
+    counts: numpy ndarray
+    """
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    for start in range(0, len(values), chunk_size):
+        counts += np.histogram(values[start:start + chunk_size], bins=edges)[0]
+    return counts
+
+def value_frequencies(values):
+    """
+    Returns the frequency of each distinct value (for the discrete columns such as the MISS flags)
+
+    Parameters
+    -------------
+    values: numpy ndarray
+
+    Returns
+    -------------
+    frequencies: pandas Series
+        the frequency of each value, sorted by value
+    """
+    distinct, counts = np.unique(values, return_counts=True)
+    return pd.Series(counts/max(len(values), 1), index=distinct)
+
+def class_histograms(values, classes, n_bins=10):
+    """
+    Histograms of a variable for each class with n_bins equal width bins over its range (the bins
+    of pd.cut(values, n_bins)), computed with a single np.bincount
+
+    Parameters
+    -------------
+    values: numpy ndarray
+        the values of the variable
+    classes: numpy ndarray
+        the class of each value (0 or 1)
+    n_bins: int, default 10
+        the number of bins
+
+    Returns
+    -------------
+    cnt: pandas DataFrame
+        the percentage of each class ('sick' for 1, 'healthy' for 0) in each bin, indexed by the bins
+    """
+    values = np.asarray(values, dtype=np.float64)
+    classes = np.asarray(classes).astype(np.int64)
+    keep = ~np.isnan(values)
+    values, classes = values[keep], classes[keep]
+
+    _, edges = pd.cut(values, n_bins, include_lowest=True, retbins=True)
+    bins = np.clip(np.searchsorted(edges, values, side='left') - 1, 0, n_bins - 1)
+    counts = np.bincount(classes*n_bins + bins, minlength=2*n_bins).reshape(2, n_bins)
+
+    index = pd.IntervalIndex.from_breaks(np.round(edges, 3), closed='right')
+    cnt = pd.DataFrame({'sick': counts[1], 'healthy': counts[0]}, index=index)
+    return cnt.apply(lambda x: round(100*x/max(x.sum(), 1), 3))
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------2-D aggregates--------------------------------------
+### --------------------------------------------------------------------------------------------
+def joint_aggregates(x, y, n_bins=100, chunk_size=1000000):
+    """
+    Aggregates the joint distribution of two variables over chunks of rows: the 2-D histogram
+    over their ranges, the moments giving the exact Pearson correlation and the least squares
+    line, and an approximation of the Spearman correlation computed from the histogram (the
+    values of a bin take the mid rank of the bin in each margin).
+
+    Parameters
+    -------------
+    x, y: numpy ndarray
+        the two variables (the rows where one of them is missing are ignored)
+    n_bins: int, default 100
+        the number of bins along each axis
+    chunk_size: int, default 1000000
+        the number of rows processed at once
+
+    Returns
+    -------------
+    aggregates: dict
+        'counts' (n_bins by n_bins), 'x_edges', 'y_edges', 'pearson', 'spearman', 'slope', 'intercept'
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    keep = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], y[keep]
+
+    x_edges = np.linspace(x.min(), x.max(), n_bins + 1) if len(x) else np.linspace(0, 1, n_bins + 1)
+    y_edges = np.linspace(y.min(), y.max(), n_bins + 1) if len(y) else np.linspace(0, 1, n_bins + 1)
+    if(x_edges[0] == x_edges[-1]):
+        x_edges = x_edges[0] + np.linspace(-0.5, 0.5, n_bins + 1)
+    if(y_edges[0] == y_edges[-1]):
+        y_edges = y_edges[0] + np.linspace(-0.5, 0.5, n_bins + 1)
+
+    counts = np.zeros((n_bins, n_bins), dtype=np.int64)
+    # the moments are accumulated around the first values to limit the cancellation
+    shift_x = x[0] if len(x) else 0
+    shift_y = y[0] if len(y) else 0
+    s_x = s_y = s_xx = s_yy = s_xy = 0.
+    for start in range(0, len(x), chunk_size):
+        x_c = x[start:start + chunk_size]
+        y_c = y[start:start + chunk_size]
+        counts += np.histogram2d(x_c, y_c, bins=(x_edges, y_edges))[0].astype(np.int64)
+        dx = x_c - shift_x
+        dy = y_c - shift_y
+        s_x += dx.sum()
+        s_y += dy.sum()
+        s_xx += dx.dot(dx)
+        s_yy += dy.dot(dy)
+        s_xy += dx.dot(dy)
+
+    n = max(len(x), 1)
+    cov = s_xy/n - (s_x/n)*(s_y/n)
+    var_x = s_xx/n - (s_x/n)**2
+    var_y = s_yy/n - (s_y/n)**2
+    pearson = cov/np.sqrt(var_x*var_y) if var_x > 0 and var_y > 0 else np.nan
+    slope = cov/var_x if var_x > 0 else 0.
+    intercept = (s_y/n + shift_y) - slope*(s_x/n + shift_x)
+
+    return {'counts': counts,
+            'x_edges': x_edges,
+            'y_edges': y_edges,
+            'pearson': pearson,
+            'spearman': spearman_from_histogram(counts),
+            'slope': slope,
+            'intercept': intercept}
+
+def spearman_from_histogram(counts):
+    """
+    Approximates the Spearman correlation from a 2-D histogram: it is the Pearson correlation
+    of the mid ranks of the bins in each margin, weighted by the counts (exact when every
+    distinct value has its own bin)
+
+    Parameters
+    -------------
+    counts: numpy ndarray
+        2-D histogram
+
+    Returns
+    -------------
+    rho: float
+    """
+    counts = counts.astype(np.float64)
+    n = counts.sum()
+    if(n == 0):
+        return np.nan
+    row_counts = counts.sum(axis=1)
+    col_counts = counts.sum(axis=0)
+    row_ranks = np.cumsum(row_counts) - (row_counts - 1)/2
+    col_ranks = np.cumsum(col_counts) - (col_counts - 1)/2
+    mean_x = row_ranks.dot(row_counts)/n
+    mean_y = col_ranks.dot(col_counts)/n
+    cov = (row_ranks - mean_x).dot(counts).dot(col_ranks - mean_y)/n
+    var_x = ((row_ranks - mean_x)**2).dot(row_counts)/n
+    var_y = ((col_ranks - mean_y)**2).dot(col_counts)/n
+    if(var_x == 0 or var_y == 0):
+        return np.nan
+    return cov/np.sqrt(var_x*var_y)
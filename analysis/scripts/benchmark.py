@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing the benchmarks of the hot paths of the pipeline (ingestion, preprocessing,
+    cross validation and energy test) run on synthetic samples of several sizes (see synthetic.py).
+    Each case is timed over a few runs and its peak memory (the Python and numpy allocations
+    traced by tracemalloc) is measured in a separate run. The results are written in a json file
+    and two result files can be compared to see the regressions and improvements over time, e.g.
+    (from the analysis folder):
+
+        python -m scripts.benchmark run --sizes 10000 50000 --output Data/benchmarks/before.json
+        python -m scripts.benchmark run --sizes 10000 50000 --output Data/benchmarks/after.json
+        python -m scripts.benchmark compare Data/benchmarks/before.json Data/benchmarks/after.json
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import io
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import contextlib
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import sklearn
+import sklearn.ensemble
+
+from scripts.utils import import_sample, usable_data, transform_raw_sample, get_ml_data
+from scripts.preprocessing import encode_categorical, remove_features, convert_to_binary_labels, impute_missing, \
+                                  find_correlation, nearZeroVar
+from scripts.model_selection import distinct_date_split, get_cross_validated_metrics, custom_GridSearchCV
+from scripts.energy_test_DP import energy_two_sample_test
+from scripts.synthetic import generate_dataset, read_partitions
+
+# the benchmarked cases, in the order they are run
+BENCHMARK_CASES = ['import_sample', 'usable_data', 'encode_remove_features', 'find_correlation', 'nearZeroVar',
+                   'distinct_date_split', 'get_cross_validated_metrics', 'custom_GridSearchCV', 'energy_two_sample_test']
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Data------------------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_sample_name(size, n_days, sick_rate, seed):
+    """
+    Returns the name identifying a synthetic sample in the work folder, it is made of everything
+    the sample depends on such that the partitions, the source file and the caches of another
+    sample are never reused. It only contains digits and underscores, as the date strings of the
+    extracted samples (the source file is then found by usable_data and import_sample).
+
+    Parameters
+    -------------
+    size, n_days, sick_rate, seed: see prepare_context
+
+    Returns
+    -------------
+    name: str
+        e.g. '10000_10_200000_0' (the sick rate is given in parts per million)
+    """
+    return '{:d}_{:d}_{:d}_{:d}'.format(size, n_days, int(round(sick_rate*1e6)), seed)
+
+def prepare_context(size, work_dir, n_days=10, sick_rate=0.2, energy_sample_size=1000, n_jobs=-1, seed=0):
+    """
+    Generates (once) a synthetic sample of a given size and prepares the inputs of the cases:
+    the source file of import_sample (an excel file as the extracted samples, written once) and
+    the outputs of each step of usable_data.
+
+    Parameters
+    -------------
+    size: int
+        the number of vectors of the sample
+    work_dir: str
+        the folder where the sample, its partitions and the caches are written
+    n_days: int, default 10
+        the number of days of the sample
+    sick_rate: float, default 0.2
+        the ratio of sick vectors (the extracted samples keep all the sick CPEs)
+    energy_sample_size: int, default 1000
+        the number of weekday and of weekend vectors compared by the energy test
+    n_jobs: int, default -1
+        the number of processes generating the sample
+    seed: int, default 0
+
+    Returns
+    -------------
+    context: dict
+    """
+    sample_name = get_sample_name(size, n_days, sick_rate, seed)
+    partitions_dir = os.path.join(work_dir, 'partitions_{}'.format(sample_name))
+    if(not os.path.isdir(partitions_dir)):
+        generate_dataset(partitions_dir, n_days, int(np.ceil(size/n_days)), sick_rate=sick_rate,
+                         partition_size=50000, file_format='pk', n_jobs=n_jobs, seed=seed, verbose=False)
+    raw_df = read_partitions(sorted(os.path.join(partitions_dir, f) for f in os.listdir(partitions_dir)))
+    context = {'size': size, 'work_dir': work_dir, 'source_error': None, 'sample_name': sample_name,
+               'source_path': os.path.join(work_dir, 'sample_{}.xlsx'.format(sample_name)),
+               'energy_sample_size': energy_sample_size, 'seed': seed}
+
+    if(not os.path.isfile(context['source_path'])):
+        try:
+            raw_df.to_excel(context['source_path'], index=False)
+        except ImportError as e:
+            # the excel writer is optional, the ingestion cases are then reported as failed
+            context['source_error'] = repr(e)
+
+    df = transform_raw_sample(raw_df)
+    x_extracted, labels = get_ml_data(df)
+    x_df = remove_features(encode_categorical(x_extracted), verbose=False)
+    context.update({'x_extracted': x_extracted,
+                    'x_df': x_df,
+                    'x': impute_missing(x_df).values.astype(np.float64),
+                    'y': convert_to_binary_labels(labels),
+                    'dates': df['day_0'].values,
+                    'weekend': df['day_0'].dt.weekday.values >= 5})
+    return context
+
+def get_pipeline(params=None):
+    """
+    Returns the classifier used by the cross validation cases (a small random forest)
+
+    Parameters
+    -------------
+    params: dict, optional
+        the parameters of the forest that differ from the default ones
+
+    Returns
+    -------------
+    clf: sklearn model
+    """
+    kw_args = {'n_estimators': 20, 'max_depth': 8, 'random_state': 0}
+    kw_args.update(params if params is not None else {})
+    return sklearn.ensemble.RandomForestClassifier(**kw_args)
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Cases-----------------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_case(name, context):
+    """
+    Returns the function running a benchmark case on the sample of a context
+
+    Parameters
+    -------------
+    name: str
+        one of BENCHMARK_CASES
+    context: dict
+        see prepare_context
+
+    Returns
+    -------------
+    target: function
+        the function to time (it takes no argument)
+    """
+    x, y, dates = context['x'], context['y'], context['dates']
+    dump_path = os.path.join(context['work_dir'], 'sample_{}.pk'.format(context['sample_name']))
+
+    def run_import_sample():
+        # the dump is removed such that the sample is imported from its source
+        cached_path = dump_path.replace('.pk', '_sick_only.pk')
+        if(os.path.isfile(cached_path)):
+            os.remove(cached_path)
+        assert(context['source_error'] is None), context['source_error']
+        import_sample(context['source_path'], dump_path)
+
+    def run_usable_data():
+        # it uses the dump of import_sample (written by the previous case or by this first run)
+        assert(context['source_error'] is None), context['source_error']
+        usable_data(context['sample_name'], context['work_dir'])
+
+    def run_energy_test():
+        weekend = context['weekend']
+        m = context['energy_sample_size']
+        rng = np.random.RandomState(context['seed'])
+        X = x[rng.permutation(np.flatnonzero(~weekend))[:m]].T
+        Y = x[rng.permutation(np.flatnonzero(weekend))[:m]].T
+        energy_two_sample_test(X, Y, 99, 1, print_exec_time=False, use_bkp=False, random_state=context['seed'])
+
+    cases = {'import_sample': run_import_sample,
+             'usable_data': run_usable_data,
+             'encode_remove_features': lambda: remove_features(encode_categorical(context['x_extracted']), verbose=False),
+             'find_correlation': lambda: find_correlation(context['x_df']),
+             'nearZeroVar': lambda: nearZeroVar(context['x_df']),
+             'distinct_date_split': lambda: distinct_date_split(x, y, dates, k=5, random_state=context['seed']),
+             'get_cross_validated_metrics': lambda: get_cross_validated_metrics(get_pipeline(), 0.15, x, y, cv=3),
+             'custom_GridSearchCV': lambda: custom_GridSearchCV(x, y, dates, get_pipeline, {'max_depth': [4, 8], 'n_estimators': [10]},
+                                                                cv=3, random_state=context['seed']),
+             'energy_two_sample_test': run_energy_test}
+    return cases[name]
+
+def measure(target, repeat=3, trace_memory=True):
+    """
+    Times a function over several runs and measures its peak memory in a separate run (tracing
+    the allocations slows the function down). What the function prints is discarded.
+
+    Parameters
+    -------------
+    target: function
+    repeat: int, default 3
+        the number of timed runs
+    trace_memory: boolean, default True
+        can be set to False to not measure the peak memory
+
+    Returns
+    -------------
+    seconds: list(float)
+        the duration of each run
+    peak_memory_mb: float
+        the peak of the traced memory (None if not measured)
+    """
+    seconds = []
+    peak_memory_mb = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            target()
+            seconds.append(time.perf_counter() - start)
+        if(trace_memory):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                target()
+                peak_memory_mb = tracemalloc.get_traced_memory()[1]/2**20
+            finally:
+                tracemalloc.stop()
+    return seconds, peak_memory_mb
+
+def get_environment():
+    """
+    Describes the environment of a benchmark run (versions, machine and git commit)
+
+    Returns
+    -------------
+    environment: dict
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'sklearn': sklearn.__version__,
+            'platform': platform.platform(),
+            'n_cpus': os.cpu_count()}
+
+def run_benchmarks(sizes, work_dir, cases=None, repeat=3, trace_memory=True, n_days=10, energy_sample_size=1000, seed=0, verbose=True):
+    """
+    Runs the benchmark cases on synthetic samples of several sizes. A case that fails is
+    reported with its error and does not stop the others.
+
+    Parameters
+    -------------
+    sizes: list(int)
+        the number of vectors of each sample
+    work_dir: str
+        the folder where the samples and the caches are written (reused between runs)
+    cases: list(str), optional
+        the cases to run (all of BENCHMARK_CASES if not set)
+    repeat: int, default 3
+        the number of timed runs of each case
+    trace_memory: boolean, default True
+        can be set to False to not measure the peak memory
+    n_days: int, default 10
+        the number of days of the samples
+    energy_sample_size: int, default 1000
+        the number of weekday and of weekend vectors compared by the energy test
+    seed: int, default 0
+    verbose: boolean, default True
+        can be set to False to not print the result of each case
+
+    Returns
+    -------------
+    results: dict
+        'environment' (see get_environment) and 'results', one record per case and size
+    """
+    cases = BENCHMARK_CASES if cases is None else cases
+    if(not os.path.isdir(work_dir)):
+        os.makedirs(work_dir)
+
+    records = []
+    for size in sizes:
+        context = prepare_context(size, work_dir, n_days, energy_sample_size=energy_sample_size, seed=seed)
+        for name in cases:
+            record = {'case': name, 'size': size, 'n_vectors': len(context['x']), 'n_features': context['x'].shape[1],
+                      'repeat': repeat, 'status': 'ok', 'error': None, 'seconds': [], 'median_seconds': None,
+                      'min_seconds': None, 'peak_memory_mb': None}
+            try:
+                seconds, peak_memory_mb = measure(get_case(name, context), repeat, trace_memory)
+                record.update({'seconds': seconds, 'median_seconds': float(np.median(seconds)), 'min_seconds': min(seconds),
+                               'peak_memory_mb': peak_memory_mb})
+            except Exception as e:
+                record.update({'status': 'error', 'error': repr(e)})
+            records.append(record)
+            if(verbose):
+                if(record['status'] == 'ok'):
+                    memory = '' if peak_memory_mb is None else ', peak memory {:.1f} MB'.format(peak_memory_mb)
+                    print('{:<30} size {:>8}: {:.4f}s{}'.format(name, size, record['median_seconds'], memory))
+                else:
+                    print('{:<30} size {:>8}: failed ({})'.format(name, size, record['error']))
+    return {'environment': get_environment(), 'results': records}
+
+def save_results(results, path):
+    """
+    Saves benchmark results (json)
+
+    Parameters
+    -------------
+    results: dict
+        see run_benchmarks
+    path: str
+    """
+    folder = os.path.dirname(path)
+    if(folder and not os.path.isdir(folder)):
+        os.makedirs(folder)
+    print('Saving to ' + path)
+    with open(path, 'w') as handle:
+        json.dump(results, handle, indent=2)
+
+def load_results(path):
+    """
+    Loads benchmark results saved by save_results
+
+    Parameters
+    -------------
+    path: str
+
+    Returns
+    -------------
+    results: dict
+    """
+    with open(path) as handle:
+        return json.load(handle)
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Comparison------------------------------------------
+### --------------------------------------------------------------------------------------------
+def compare_results(baseline, candidate, threshold=0.1):
+    """
+    Compares two benchmark results case by case: the median durations and the peak memories
+    of the candidate are divided by those of the baseline. A case that ran in the baseline but
+    failed in the candidate is marked as 'failed', a case missing from (or failing in) the
+    baseline or missing from the candidate as 'missing'.
+
+    Parameters
+    -------------
+    baseline, candidate: dict
+        see run_benchmarks
+    threshold: float, default 0.1
+        the relative change above which a case is marked as a regression or an improvement
+
+    Returns
+    -------------
+    comparison_df: pandas DataFrame
+        indexed by case and size, with the durations, peak memories, their ratios and the verdict
+    """
+    columns = ['case', 'size', 'median_seconds', 'peak_memory_mb', 'status']
+    baseline_df = pd.DataFrame(baseline['results'], columns=columns).set_index(['case', 'size'])
+    candidate_df = pd.DataFrame(candidate['results'], columns=columns).set_index(['case', 'size'])
+    comparison_df = baseline_df.join(candidate_df, how='outer', lsuffix='_baseline', rsuffix='_candidate')
+    comparison_df['time_ratio'] = comparison_df.median_seconds_candidate/comparison_df.median_seconds_baseline
+    comparison_df['memory_ratio'] = comparison_df.peak_memory_mb_candidate/comparison_df.peak_memory_mb_baseline
+
+    def get_verdict(row):
+        if(row.status_baseline == 'ok' and isinstance(row.status_candidate, str) and row.status_candidate != 'ok'):
+            return 'failed'
+        if(row.status_baseline != 'ok' or row.status_candidate != 'ok'):
+            return 'missing'
+        if(row.time_ratio > 1 + threshold or row.memory_ratio > 1 + threshold):
+            return 'regression'
+        if(row.time_ratio < 1 - threshold or row.memory_ratio < 1 - threshold):
+            return 'improvement'
+        return 'unchanged'
+    comparison_df['verdict'] = comparison_df.apply(get_verdict, axis=1)
+    return comparison_df[['median_seconds_baseline', 'median_seconds_candidate', 'time_ratio',
+                          'peak_memory_mb_baseline', 'peak_memory_mb_candidate', 'memory_ratio', 'verdict']]
+
+def main(argv = None):
+    """
+    Command line entry point, see the module documentation or --help
+    """
+    parser = argparse.ArgumentParser(description = 'Benchmarks the hot paths of the pipeline on synthetic samples.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    run_parser = subparsers.add_parser('run', help = 'runs the benchmarks and writes their results')
+    run_parser.add_argument('--sizes', type = int, nargs = '+', default = [10000, 50000])
+    run_parser.add_argument('--cases', nargs = '+', default = None, choices = BENCHMARK_CASES)
+    run_parser.add_argument('--repeat', type = int, default = 3)
+    run_parser.add_argument('--no-memory', action = 'store_true', help = 'do not measure the peak memory')
+    run_parser.add_argument('--n-days', type = int, default = 10)
+    run_parser.add_argument('--energy-sample-size', type = int, default = 1000)
+    run_parser.add_argument('--seed', type = int, default = 0)
+    run_parser.add_argument('--work-dir', default = 'Data/benchmarks/work', help = 'folder of the synthetic samples')
+    run_parser.add_argument('--output', default = None, help = 'json file of the results (Data/benchmarks/benchmark_<date>.json)')
+
+    compare_parser = subparsers.add_parser('compare', help = 'compares two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type = float, default = 0.1)
+    compare_parser.add_argument('--fail-on-regression', action = 'store_true', help = 'exit with status 1 if a case regressed or failed')
+    args = parser.parse_args(argv)
+
+    if(args.command == 'run'):
+        output = args.output
+        if(output is None):
+            output = os.path.join('Data', 'benchmarks', 'benchmark_{}.json'.format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+        results = run_benchmarks(args.sizes, args.work_dir, args.cases, args.repeat, not args.no_memory, args.n_days,
+                                 args.energy_sample_size, args.seed)
+        save_results(results, output)
+    else:
+        comparison_df = compare_results(load_results(args.baseline), load_results(args.candidate), args.threshold)
+        with pd.option_context('display.width', 200, 'display.max_columns', None):
+            print(comparison_df.round(4))
+        if(args.fail_on_regression and comparison_df.verdict.isin(['regression', 'failed']).any()):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
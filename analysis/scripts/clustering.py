@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing the (plot-free) computations of the clustering analysis: the silhouette
+    of the vectors is computed by blocks of rows, such that it scales to any number of vectors,
+    and the same blocks of distances are shared by the clusterings of every k.
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import os
+import json
+import timeit
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.spatial.distance
+import sklearn.cluster
+import sklearn.decomposition
+from scipy import stats
+from joblib import Parallel, delayed, effective_n_jobs
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Silhouette------------------------------------------
+### --------------------------------------------------------------------------------------------
+def silhouettes_from_cluster_sums(sums, counts, own):
+    """
+    Computes silhouette coefficients from the sums of distances of some vectors to each cluster,
+    following sklearn.metrics.silhouette_samples: a is the mean distance to the other vectors of
+    the cluster, b the smallest mean distance to another cluster and the silhouette is
+    (b-a)/max(a,b) (0 for the vectors alone in their cluster).
+
+    Parameters
+    -------------
+    sums: numpy ndarray
+        m by k array, the sum of the distances of each vector to the vectors of each cluster
+    counts: numpy ndarray
+        the size of each cluster
+    own: numpy ndarray
+        the cluster of each vector
+
+    Returns
+    -------------
+    silhouettes: numpy ndarray
+    """
+    rows = np.arange(len(own))
+    own_counts = counts[own]
+    a = sums[rows, own]/np.maximum(own_counts - 1, 1)
+    means = sums/np.maximum(counts, 1)
+    means[rows, own] = np.inf
+    means[:, counts == 0] = np.inf
+    b = means.min(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        silhouettes = (b - a)/np.maximum(a, b)
+    silhouettes[(own_counts <= 1) | ~np.isfinite(silhouettes)] = 0
+    return silhouettes
+
+def compute_sampled_silhouettes(X, labelings, sample_size=10000, chunk_size=500, random_state=None, rows=None, block_size=20000):
+    """
+    Computes the exact silhouette coefficient of a random sample of the vectors for one or many
+    clusterings: the distances of the sampled vectors to all the vectors are computed by blocks of
+    chunk_size sampled rows and block_size vectors (memory in O(chunk_size*block_size), whatever n)
+    and each block is reduced for every clustering to the sums of distances to each cluster, so the
+    distances are computed once for all values of k.
+    With sample_size >= n every vector is evaluated and the mean is sklearn's silhouette_score.
+
+    Parameters
+    -------------
+    X: numpy ndarray
+        the input data
+    labelings: list(numpy ndarray)
+        the cluster labels of each clustering (arrays of length n)
+    sample_size: int, default 10000
+        the number of vectors whose silhouette is computed
+    chunk_size: int, default 500
+        the number of sampled vectors processed at once
+    random_state: int, optional
+        seed of the sample
+    rows: numpy ndarray, optional
+        the indices of the vectors to evaluate (e.g. a stratified sample, see get_stratified_rows), 
+        sample_size and random_state are then ignored
+    block_size: int, default 20000
+        the number of vectors the sampled rows are compared to at once
+
+    Returns
+    -------------
+    rows: numpy ndarray
+        the indices of the sampled vectors
+    silhouettes: numpy ndarray
+        m by L array, the silhouette of each sampled vector for each clustering
+    """
+    if(rows is None):
+        rows = get_stratified_rows(X.shape[0], sample_size, random_state=random_state)
+
+    # cluster indices of each clustering (one hot encoded block by block)
+    encodings = []
+    for labels in labelings:
+        codes, labels = np.unique(labels, return_inverse=True)
+        encodings.append((labels, np.eye(len(codes)), np.bincount(labels, minlength=len(codes))))
+
+    silhouettes = np.zeros((len(rows), len(labelings)))
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        sums = [np.zeros((len(chunk), len(counts))) for _, _, counts in encodings]
+        for block_start in range(0, X.shape[0], block_size):
+            block = slice(block_start, block_start + block_size)
+            distances = scipy.spatial.distance.cdist(X[chunk], X[block])
+            for l, (labels, eye, _) in enumerate(encodings):
+                sums[l] += distances.dot(eye[labels[block]])
+        for l, (labels, _, counts) in enumerate(encodings):
+            silhouettes[start:start + len(chunk), l] = silhouettes_from_cluster_sums(sums[l], counts, labels[chunk])
+    return rows, silhouettes
+
+def get_stratified_rows(n, sample_size, strata=None, random_state=None):
+    """
+    Draws the vectors whose silhouette is computed: a simple random sample or, if strata is given 
+    (e.g. the binary labels), a sample taking the same proportion of each stratum
+
+    Parameters
+    -------------
+    n: int
+        the number of vectors
+    sample_size: int
+        the number of vectors to draw (all of them if sample_size >= n)
+    strata: numpy ndarray, optional
+        the stratum of each vector
+    random_state: int, optional
+        seed of the sample
+
+    Returns
+    -------------
+    rows: numpy ndarray
+        the sorted indices of the sampled vectors
+    """
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    if(sample_size >= n):
+        return np.arange(n)
+    if(strata is None):
+        return np.sort(rng.choice(n, sample_size, replace=False))
+    rows = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        size = max(1, int(round(sample_size*len(members)/n)))
+        rows.append(rng.choice(members, min(size, len(members)), replace=False))
+    return np.sort(np.concatenate(rows))
+
+def summarise_silhouettes(silhouettes, n, confidence=0.95):
+    """
+    Estimates the silhouette score (mean silhouette of all the vectors) from the silhouettes of a
+    random sample, with the half width of its confidence interval (normal approximation with the
+    finite population correction, it is 0 when all the vectors were evaluated).
+
+    Parameters
+    -------------
+    silhouettes: numpy ndarray
+        m by L array of sampled silhouettes (see compute_sampled_silhouettes)
+    n: int
+        the total number of vectors
+    confidence: float, default 0.95
+        the confidence level of the interval
+
+    Returns
+    -------------
+    scores: numpy ndarray
+        the estimated silhouette score of each clustering
+    errors: numpy ndarray
+        the half width of the confidence interval of each score
+    """
+    m = silhouettes.shape[0]
+    scores = silhouettes.mean(axis=0)
+    if(m <= 1):
+        return scores, np.full(len(scores), np.inf)
+    z = stats.norm.ppf(0.5 + confidence/2)
+    errors = z*silhouettes.std(axis=0, ddof=1)/np.sqrt(m)*np.sqrt(max(n - m, 0)/max(n - 1, 1))
+    return scores, errors
+
+def silhouette_scores(X, labelings, sample_size=10000, chunk_size=500, confidence=0.95, random_state=None, names=None):
+    """
+    Estimated silhouette score of several clusterings of the same vectors, with a bound on the error
+
+    Parameters
+    -------------
+    X: numpy ndarray
+        the input data
+    labelings: list(numpy ndarray)
+        the cluster labels of each clustering
+    sample_size: int, default 10000
+        the number of vectors whose silhouette is computed
+    chunk_size: int, default 500
+        the number of sampled vectors processed at once
+    confidence: float, default 0.95
+        the confidence level of the error
+    random_state: int, optional
+        seed of the sample
+    names: list, optional
+        the name of each clustering (e.g. its number of clusters)
+
+    Returns
+    -------------
+    scores_df: pandas DataFrame
+        the estimated silhouette score, the half width of its confidence interval and the number of
+        vectors evaluated for each clustering
+    """
+    rows, silhouettes = compute_sampled_silhouettes(X, labelings, sample_size, chunk_size, random_state)
+    scores, errors = summarise_silhouettes(silhouettes, X.shape[0], confidence)
+    names = list(range(len(labelings))) if names is None else names
+    return pd.DataFrame({'silhouette': scores, 'error': errors, 'n_evaluated': len(rows)}, index=names)
+
+def centroid_silhouettes(X, labels, centers, chunk_size=10000):
+    """
+    Computes the simplified silhouette of every vector in O(n*k): a is the distance to the centroid
+    of its cluster and b the distance to the closest other centroid. It is a cheap proxy of the
+    silhouette for k-means clusterings on all the vectors.
+
+    Parameters
+    -------------
+    X: numpy ndarray
+        the input data
+    labels: numpy ndarray
+        the cluster of each vector (index of its centroid)
+    centers: numpy ndarray
+        k by d array of centroids
+    chunk_size: int, default 10000
+        the number of vectors processed at once
+
+    Returns
+    -------------
+    silhouettes: numpy ndarray
+    """
+    silhouettes = np.zeros(X.shape[0])
+    for start in range(0, X.shape[0], chunk_size):
+        distances = scipy.spatial.distance.cdist(X[start:start + chunk_size], centers)
+        own = labels[start:start + chunk_size]
+        rows = np.arange(len(own))
+        a = distances[rows, own]
+        distances[rows, own] = np.inf
+        b = distances.min(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = (b - a)/np.maximum(a, b)
+        s[~np.isfinite(s)] = 0
+        silhouettes[start:start + chunk_size] = s
+    return silhouettes
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------K-means sweep---------------------------------------
+### --------------------------------------------------------------------------------------------
+def fit_kmeans(X, n_clusters, batch_size=1000, random_state=None):
+    """
+    Fits a MiniBatchKMeans with n_clusters clusters (one task of kmeans_sweep)
+
+    Parameters
+    -------------
+    X: numpy ndarray
+        the input data (memory mapped when called by kmeans_sweep)
+    n_clusters: int
+        the number of clusters
+    batch_size: int, default 1000
+        the size of the mini batches
+    random_state: int, optional
+        seed of the clustering
+
+    Returns
+    -------------
+    result: dict
+        'k', 'inertia', 'fit_seconds', 'labels' and 'centers'
+    """
+    start = timeit.default_timer()
+    k_mean = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=random_state)
+    k_mean.fit(X)
+    return {'k': n_clusters,
+            'inertia': k_mean.inertia_,
+            'fit_seconds': timeit.default_timer() - start,
+            'labels': k_mean.labels_.astype(np.int32),
+            'centers': k_mean.cluster_centers_}
+
+def kmeans_sweep(X, cluster_numbers, sample_size=10000, strata=None, batch_size=1000, n_jobs=-1, random_state=None, verbose=0,
+                 return_labels=False):
+    """
+    Fits MiniBatchKMeans for every number of clusters in parallel processes sharing the memory mapped 
+    data, then estimates the silhouette score of every clustering on the same (stratified) sample of 
+    vectors, the chunks of sampled vectors being split between the processes and their distances 
+    shared by all the clusterings.
+
+    Parameters
+    -------------
+    X: numpy ndarray
+        data that is ready for clustering
+    cluster_numbers: list(int)
+        the values of k to consider
+    sample_size: int, default 10000
+        the number of vectors whose silhouette is computed
+    strata: numpy ndarray, optional
+        stratum of each vector (e.g. the binary labels) to draw a stratified sample
+    batch_size: int, default 1000
+        the size of the mini batches of MiniBatchKMeans
+    n_jobs: int, default -1
+        the number of processes (-1 for all cores)
+    random_state: int, optional
+        seed of the clusterings and of the sample
+    verbose: int, default 0
+        verbosity of joblib
+    return_labels: boolean, default False
+        can be set to True to also return the labels and centroids of each clustering
+
+    Returns
+    -------------
+    sweep_df: pandas DataFrame
+        indexed by k: inertia, estimated silhouette score, half width of its 95% confidence 
+        interval and fit time of each clustering
+    fits: dict(int -> dict), only if return_labels
+        the result of fit_kmeans for each k
+    """
+    parallel = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r', verbose=verbose)
+    fits = parallel(delayed(fit_kmeans)(X, k, batch_size, random_state) for k in cluster_numbers)
+    labelings = [f['labels'] for f in fits]
+
+    rows = get_stratified_rows(X.shape[0], sample_size, strata, random_state)
+    blocks = np.array_split(rows, max(1, min(effective_n_jobs(n_jobs), len(rows))))
+    results = parallel(delayed(compute_sampled_silhouettes)(X, labelings, rows=block) for block in blocks if len(block) != 0)
+    silhouettes = np.vstack([r[1] for r in results])
+    scores, errors = summarise_silhouettes(silhouettes, X.shape[0])
+
+    sweep_df = pd.DataFrame({'inertia': [f['inertia'] for f in fits],
+                             'silhouette': scores,
+                             'silhouette_error': errors,
+                             'fit_seconds': [f['fit_seconds'] for f in fits]},
+                            index=pd.Index(cluster_numbers, name='k'))
+    if(return_labels):
+        return sweep_df, {f['k']: f for f in fits}
+    return sweep_df
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------PCA-------------------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_pca_key(x, max_retained_var, max_components, method, random_state, batch_size=10000):
+    """
+    Returns the key of a PCA projection in the cache: a hash of the parameters and of all the values of x 
+    (hashed by batches of rows such that a memory mapped x is never copied as a whole)
+
+    Parameters
+    -------------
+    see fit_pca_once
+
+    Returns
+    -------------
+    key: str
+    """
+    h = hashlib.sha1('{}|{}|{}|{}|{}'.format(x.shape, max_retained_var, max_components, method, random_state).encode('utf-8'))
+    for start in range(0, x.shape[0], batch_size):
+        h.update(memoryview(np.ascontiguousarray(x[start:start + batch_size])))
+    return h.hexdigest()
+
+def get_n_components(explained_variance_ratio, retained_var):
+    """
+    Returns the number of components needed to retain a ratio of the variance, as PCA(retained_var) does
+
+    Parameters
+    -------------
+    explained_variance_ratio: numpy ndarray
+        the ratio of the variance explained by each component
+    retained_var: float
+        the ratio of the variance to retain (in ]0,1[)
+
+    Returns
+    -------------
+    n_components: int
+    """
+    cumulated = np.cumsum(explained_variance_ratio)
+    return int(min(np.searchsorted(cumulated, retained_var, side='right') + 1, len(cumulated)))
+
+def fit_pca_once(x, max_retained_var=0.99, max_components=None, method='randomized', batch_size=10000, cache_dir=None,
+                 random_state=None, min_components=16):
+    """
+    Fits a single PCA serving every retained variance up to max_retained_var: the components are 
+    ordered by explained variance, so the projection retaining a smaller variance is made of the 
+    first columns of the projection retaining the largest one (see project_retained_variance). 
+    The rank of the PCA is derived from max_retained_var: a PCA of min_components components is 
+    fitted and its rank is doubled until its components retain max_retained_var of the variance. 
+    Once the rank would exceed half of the full rank, the randomized solver is not faster anymore 
+    and a full SVD is computed instead. The projection (truncated to the rank needed by 
+    max_retained_var) can be cached on disk and is then memory mapped instead of being recomputed.
+
+    Parameters
+    -------------
+    x: numpy ndarray
+        data that is ready for clustering
+    max_retained_var: float, default 0.99
+        the largest ratio of the variance that will be retained
+    max_components: int, optional
+        the largest number of components fitted (all of them by default)
+    method: str, default 'randomized'
+        'randomized' (PCA with the randomized solver) or 'incremental' (IncrementalPCA fitted by 
+        batches of batch_size rows, to use on memory mapped data that does not fit in memory)
+    batch_size: int, default 10000
+        the number of rows of each batch of the incremental PCA and of the projection
+    cache_dir: str, optional
+        the folder where the projections are cached
+    random_state: int, optional
+        seed of the randomized solver
+    min_components: int, default 16
+        the number of components of the first PCA fitted
+
+    Returns
+    -------------
+    projection: numpy ndarray
+        n by r projection of x on its r first components (memory mapped if cache_dir is set)
+    explained_variance_ratio: numpy ndarray
+        the ratio of the variance explained by each of the r components
+    """
+    if(cache_dir is not None):
+        key = get_pca_key(x, max_retained_var, max_components, method, random_state, batch_size, min_components)
+        path = os.path.join(cache_dir, key)
+        if(os.path.isfile(path + '.npy')):
+            print("Retrieving the PCA projection at: {}".format(path + '.npy'))
+            with open(path + '.json') as handle:
+                explained_variance_ratio = np.array(json.load(handle)['explained_variance_ratio'])
+            return np.load(path + '.npy', mmap_mode='r'), explained_variance_ratio
+
+    full_rank = min(x.shape)
+    max_rank = full_rank if max_components is None else min(max_components, full_rank)
+    n_components = min(min_components, max_rank)
+    while(True):
+        if(method == 'incremental'):
+            pca = sklearn.decomposition.IncrementalPCA(n_components=n_components, batch_size=max(batch_size, n_components))
+        elif(2*n_components > full_rank):
+            # a randomized SVD of (almost) full rank is slower than the full one
+            n_components = max_rank
+            pca = sklearn.decomposition.PCA(n_components=n_components, svd_solver='full')
+        else:
+            pca = sklearn.decomposition.PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+        pca.fit(x)
+        if(np.sum(pca.explained_variance_ratio_) >= max_retained_var or n_components == max_rank):
+            break
+        n_components = min(2*n_components, max_rank)
+
+    r = get_n_components(pca.explained_variance_ratio_, max_retained_var)
+    if(np.sum(pca.explained_variance_ratio_) < max_retained_var):
+        print("The {} components fitted only retain {:.4f} of the variance".format(n_components, np.sum(pca.explained_variance_ratio_)))
+    explained_variance_ratio = pca.explained_variance_ratio_[:r]
+
+    # the projection is done by batches such that x can be memory mapped, when it is cached it is
+    # written directly in the (memory mapped) file such that it is never held in memory either
+    if(cache_dir is not None):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + '.{}.tmp.npy'.format(os.getpid())
+        projection = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=(x.shape[0], r))
+    else:
+        projection = np.empty((x.shape[0], r))
+    for start in range(0, x.shape[0], batch_size):
+        projection[start:start + batch_size] = pca.transform(x[start:start + batch_size])[:, :r]
+
+    if(cache_dir is not None):
+        projection.flush()
+        del projection
+        with open(path + '.json', 'w') as handle:
+            json.dump({'explained_variance_ratio': explained_variance_ratio.tolist(), 'method': method}, handle)
+        # renamed once complete such that a concurrent reader never sees a partial projection
+        os.replace(tmp_path, path + '.npy')
+        print("Saving the PCA projection at: {}".format(path + '.npy'))
+        projection = np.load(path + '.npy', mmap_mode='r')
+    return projection, explained_variance_ratio
+
+def project_retained_variance(projection, explained_variance_ratio, retained_var):
+    """
+    Returns the projection retaining a given ratio of the variance by slicing the projection of 
+    fit_pca_once (no copy is made)
+
+    Parameters
+    -------------
+    projection: numpy ndarray
+        the projection returned by fit_pca_once
+    explained_variance_ratio: numpy ndarray
+        the ratios returned by fit_pca_once
+    retained_var: float
+        the ratio of the variance to retain (at most the max_retained_var of fit_pca_once)
+
+    Returns
+    -------------
+    X: numpy ndarray
+        the projection on the components needed to retain retained_var
+    """
+    return projection[:, :get_n_components(explained_variance_ratio, retained_var)]
+
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing the drift monitor used in production: each new day_0 batch of feature
+    vectors is compared to the distribution the model was trained on. The training vectors are
+    summarised once in a compact reference:
+        * a sorted quantile sketch of each feature, against which the KS statistic and the 1-D
+          energy distance of each feature of a new day are computed (see compute_ks_energy_block)
+        * a fixed subsample of standardised training vectors with its precomputed distance
+          matrix, such that the multivariate energy test of a day only computes the distances
+          involving the vectors of the day
+    The missing values are ignored by the sketches (the KS statistic of a feature only compares
+    its non missing values) and imputed with the training mean before computing distances.
+    Two kinds of features are not compared vector by vector:
+        * the weekday dummies (wk_*) are constant within a day, so a single day always differs
+          from a reference built over several weekdays: they are left out of the reference
+        * the CMTS measurements (cmts_*) are shared by all the CPEs of a CMTS, their values are
+          not independent from one vector to the other: they are only compared on the distinct
+          CMTS rows (one per CMTS and day) and left out of the multivariate energy test
+    The cost of a report is then proportional to the size of the new day only, it can be built
+    from the analysis folder with:
+
+        reference = build_drift_reference(x_train_df)
+        check_reference_days(reference, x_train_df, dates_train)
+        save_drift_reference(reference, 'Data/drift_reference.npz')
+        report = compute_drift_report(load_drift_reference('Data/drift_reference.npz'), x_day_df)
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import warnings
+import numpy as np
+import pandas as pd
+import scipy.spatial.distance
+from scipy import stats
+
+from scripts.energy_test_DP import compute_ks_energy_block, accumulate_group_sums, energy_from_sums, \
+                                   compute_energy_replicates_batched, iter_matrix_tiles, find_p_value
+
+# the prefixes of the features left out of the reference (the weekday dummies of encode_categorical)
+EXCLUDED_PREFIXES = ['wk_']
+# the prefixes of the features shared by all the CPEs of a CMTS
+SHARED_PREFIXES = ['cmts_']
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Reference-------------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_shared_rows(x):
+    """
+    Returns the distinct rows of the shared (CMTS) features: the CPEs of a CMTS have the same
+    values on a given day, so each CMTS and day is kept once
+
+    Parameters
+    -------------
+    x: numpy ndarray
+        n by s values of the shared features
+
+    Returns
+    -------------
+    rows: numpy ndarray
+        the distinct rows (missing values being equal to each other)
+    """
+    if(x.shape[1] == 0):
+        return x
+    return pd.DataFrame(x).drop_duplicates().values
+
+def build_drift_reference(x_df, n_quantiles=1000, sample_size=2000, random_state=None, excluded_prefixes=EXCLUDED_PREFIXES,
+                          shared_prefixes=SHARED_PREFIXES):
+    """
+    Summarises the training feature vectors in a compact reference for the drift monitor.
+
+    Parameters
+    -------------
+    x_df: pandas DataFrame
+        the training feature vectors (as returned by usable_data)
+    n_quantiles: int, default 1000
+        the number of quantiles kept in the sketch of each feature
+    sample_size: int, default 2000
+        the number of training vectors kept for the multivariate energy test
+    random_state: int, optional
+        seed of the subsample
+    excluded_prefixes: list(str), default EXCLUDED_PREFIXES
+        the prefixes of the features left out of the reference
+    shared_prefixes: list(str), default SHARED_PREFIXES
+        the prefixes of the features shared by all the CPEs of a CMTS
+
+    Returns
+    -------------
+    reference: dict
+        'columns' (the monitored features), 'shared' (whether each of them is shared), 'n_vectors', 
+        'counts' (non missing values of each feature, in the distinct CMTS rows for the shared 
+        ones), 'quantiles' (n_quantiles by d, of the same values), 'mean', 'std' (used to 
+        standardise the vectors), 'sample' (standardised subsample of the features that are not 
+        shared, missing values imputed with the mean) and 'sample_distances' (its distance 
+        matrix in condensed form)
+    """
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    columns = [c for c in x_df.columns if not str(c).startswith(tuple(excluded_prefixes))]
+    shared = np.array([str(c).startswith(tuple(shared_prefixes)) for c in columns], dtype=bool)
+    x = x_df[columns].values.astype(np.float64)
+    x_shared = get_shared_rows(x[:, shared])
+    levels = (np.arange(n_quantiles) + 0.5)/n_quantiles
+    quantiles = np.empty((n_quantiles, len(columns)))
+    with warnings.catch_warnings():
+        # features that are always missing have NaN statistics and quantiles
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mean = np.nanmean(x, axis=0)
+        std = np.nanstd(x, axis=0)
+        quantiles[:, ~shared] = np.nanquantile(x[:, ~shared], levels, axis=0)
+        quantiles[:, shared] = np.nanquantile(x_shared, levels, axis=0)
+    mean[np.isnan(mean)] = 0
+    # constant features are only centred
+    std[(std == 0) | np.isnan(std)] = 1
+
+    counts = np.empty(len(columns), dtype=np.int64)
+    counts[~shared] = (~np.isnan(x[:, ~shared])).sum(axis=0)
+    counts[shared] = (~np.isnan(x_shared)).sum(axis=0)
+
+    rows = rng.choice(len(x), min(sample_size, len(x)), replace=False)
+    sample = standardise(x[rows][:, ~shared], mean[~shared], std[~shared])
+    return {'columns': np.array(columns, dtype=str),
+            'shared': shared,
+            'n_vectors': len(x),
+            'counts': counts,
+            'quantiles': quantiles,
+            'mean': mean,
+            'std': std,
+            'sample': sample,
+            'sample_distances': scipy.spatial.distance.pdist(sample)}
+
+def get_shared_mask(reference):
+    """
+    Returns whether each feature of a reference is shared by the CPEs of a CMTS (none of them for
+    the references saved before the shared features were told apart)
+
+    Parameters
+    -------------
+    reference: dict
+
+    Returns
+    -------------
+    shared: numpy ndarray (bool)
+    """
+    return np.asarray(reference.get('shared', np.zeros(len(reference['columns']), dtype=bool)), dtype=bool)
+
+def standardise(x, mean, std):
+    """
+    Standardises vectors with the statistics of the reference, the missing values are imputed
+    with the mean (0 once standardised) such that the distances are defined.
+
+    Parameters
+    -------------
+    x: numpy ndarray
+        n by d vectors
+    mean, std: numpy ndarray
+        the statistics of each feature
+
+    Returns
+    -------------
+    standardised: numpy ndarray
+    """
+    standardised = (x - mean)/std
+    standardised[np.isnan(standardised)] = 0
+    return standardised
+
+def save_drift_reference(reference, path):
+    """
+    Saves a reference built by build_drift_reference (as a .npz file)
+
+    Parameters
+    -------------
+    reference: dict
+    path: str
+    """
+    np.savez(path, **reference)
+    print('Saving to ' + path)
+
+def load_drift_reference(path):
+    """
+    Loads a reference saved by save_drift_reference
+
+    Parameters
+    -------------
+    path: str
+
+    Returns
+    -------------
+    reference: dict
+    """
+    with np.load(path, allow_pickle=False) as data:
+        reference = {key: data[key] for key in data.files}
+    reference['columns'] = [str(c) for c in reference['columns']]
+    reference['n_vectors'] = int(reference['n_vectors'])
+    return reference
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Drift scores----------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_feature_drift(reference, x):
+    """
+    Compares each feature of a new batch of vectors to its reference sketch: the quantiles of the
+    sketch are used as an equally weighted sample of the (non missing) training values, the
+    p-values of the KS statistics use the number of non missing values of the feature in the
+    training vectors and in the batch. The shared (CMTS) features are compared on the distinct
+    CMTS rows of the batch, their p-values use the number of CMTS rows. A feature missing in all 
+    the vectors of the batch (or of the training) has NaN statistics.
+
+    Parameters
+    -------------
+    reference: dict
+        the reference (see build_drift_reference)
+    x: numpy ndarray
+        the new vectors, with the columns of the reference
+
+    Returns
+    -------------
+    features_df: pandas DataFrame
+        KS statistic, p-value and energy distance of each feature, sorted by increasing p-values
+    """
+    shared = get_shared_mask(reference)
+    ks_statistics = np.empty(len(shared))
+    energy_distances = np.empty(len(shared))
+    n1 = np.empty(len(shared))
+    for mask, values in [(~shared, x[:, ~shared]), (shared, get_shared_rows(x[:, shared]))]:
+        if(mask.any()):
+            ks_statistics[mask], energy_distances[mask] = compute_ks_energy_block(values, reference['quantiles'][:, mask])
+            n1[mask] = (~np.isnan(values)).sum(axis=0)
+    # the references saved before the counts were kept only know the number of vectors
+    n2 = np.asarray(reference.get('counts', reference['n_vectors']), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_values = stats.kstwo.sf(ks_statistics, np.round(n1*n2/(n1 + n2)))
+    p_values[np.isnan(ks_statistics)] = np.nan
+    features_df = pd.DataFrame({'statistic': ks_statistics, 'pvalue': p_values, 'energy_distance': energy_distances},
+                               index=pd.Index(reference['columns'], name='measurement'))
+    return features_df.sort_values(by='pvalue', ascending=True)
+
+def get_multivariate_drift(reference, x, n_bootstrap=99, sample_size=2000, random_state=None):
+    """
+    Energy test between a subsample of the new (standardised) vectors and the reference subsample
+    on the features that are not shared by the CPEs of a CMTS: only the distances involving the 
+    new vectors are computed, those of the reference subsample were computed when it was built.
+
+    Parameters
+    -------------
+    reference: dict
+        the reference (see build_drift_reference)
+    x: numpy ndarray
+        the new vectors, with the columns of the reference
+    n_bootstrap: int, default 99
+        the number of permutations
+    sample_size: int, default 2000
+        the maximum number of new vectors used
+    random_state: int, optional
+        seed of the subsample and of the permutations
+
+    Returns
+    -------------
+    E_distance_observed: float
+        the energy statistic between the new vectors and the reference
+    p_value: float
+    """
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    kept = ~get_shared_mask(reference)
+    new = standardise(x[rng.choice(len(x), min(sample_size, len(x)), replace=False)][:, kept], reference['mean'][kept],
+                      reference['std'][kept])
+    sample = reference['sample']
+    n1 = len(new)
+    n2 = len(sample)
+
+    distance = np.empty((n1 + n2, n1 + n2))
+    distance[:n1,:n1] = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(new))
+    distance[:n1,n1:] = scipy.spatial.distance.cdist(new, sample)
+    distance[n1:,:n1] = distance[:n1,n1:].T
+    distance[n1:,n1:] = scipy.spatial.distance.squareform(reference['sample_distances'])
+
+    s_xx, s_yy, s_xy = accumulate_group_sums(iter_matrix_tiles(distance), np.arange(n1 + n2) < n1)
+    E_distance_observed = energy_from_sums(s_xx, s_yy, s_xy, n1, n2)
+    E_distance_replicates = compute_energy_replicates_batched(lambda: iter_matrix_tiles(distance), n1, n2, n_bootstrap,
+                                                              rng=rng, verbose=False)
+    return E_distance_observed, find_p_value(E_distance_replicates, E_distance_observed)
+
+def compute_drift_report(reference, x_day, alpha=1, max_drifted_ratio=0.1, n_bootstrap=99, sample_size=2000, random_state=None,
+                         verbose=True):
+    """
+    Compares a new day of feature vectors to the training reference and decides whether the model
+    should be retrained: either the multivariate energy test rejects the null hypothesis at the
+    level alpha or more than max_drifted_ratio of the features drifted (KS p-value below alpha
+    divided by the number of features that could be tested, i.e. not missing in the day).
+
+    Parameters
+    -------------
+    reference: dict
+        the reference (see build_drift_reference)
+    x_day: pandas DataFrame or numpy ndarray
+        the feature vectors of the day (an array must have the columns of the reference, i.e. 
+        without the excluded features)
+    alpha: int, default 1
+        significance level (in 0-100)
+    max_drifted_ratio: float, default 0.1
+        the ratio of drifted features above which retraining is advised
+    n_bootstrap: int, default 99
+        the number of permutations of the multivariate test
+    sample_size: int, default 2000
+        the maximum number of vectors of the day used by the multivariate test
+    random_state: int, optional
+        seed of the multivariate test
+    verbose: boolean, default True
+        can be set to False to not print the summary of the report
+
+    Returns
+    -------------
+    report: dict
+        'n_vectors', 'features' (see get_feature_drift), 'drifted_features', 'energy_statistic',
+        'energy_pvalue' and 'retrain'
+    """
+    if(isinstance(x_day, pd.DataFrame)):
+        x_day = x_day.reindex(columns=reference['columns'], fill_value=0).values
+    x_day = np.asarray(x_day, dtype=np.float64)
+
+    features_df = get_feature_drift(reference, x_day)
+    n_tested = max(int(features_df.pvalue.notnull().sum()), 1)
+    drifted = [str(c) for c in features_df.index[features_df.pvalue < alpha/100/n_tested]]
+    E_distance_observed, p_value = get_multivariate_drift(reference, x_day, n_bootstrap, sample_size, random_state)
+    retrain = (p_value < alpha/100) or (len(drifted) > max_drifted_ratio*n_tested)
+
+    if(verbose):
+        print("{} vectors: {} drifted features out of {}, energy statistic = {} (p-value = {})".format(
+            len(x_day), len(drifted), n_tested, E_distance_observed, p_value))
+        if(retrain):
+            print("The distribution drifted from the training data, the model should be retrained")
+    return {'n_vectors': len(x_day),
+            'features': features_df,
+            'drifted_features': drifted,
+            'energy_statistic': E_distance_observed,
+            'energy_pvalue': p_value,
+            'retrain': retrain}
+
+def monitor_days(reference, x_df, dates, alpha=1, max_drifted_ratio=0.1, n_bootstrap=99, sample_size=2000, random_state=None):
+    """
+    Computes the drift report of each day_0 of a sample and summarises them in a table
+
+    Parameters
+    -------------
+    reference: dict
+        the reference (see build_drift_reference)
+    x_df: pandas DataFrame
+        the feature vectors
+    dates: numpy ndarray
+        the day_0 of each vector
+    (other parameters: see compute_drift_report)
+
+    Returns
+    -------------
+    summary_df: pandas DataFrame
+        one row per day with the number of vectors, of drifted features, the energy statistic,
+        its p-value and whether retraining is advised
+    """
+    rows = []
+    for day in np.unique(dates):
+        report = compute_drift_report(reference, x_df[dates == day], alpha, max_drifted_ratio, n_bootstrap, sample_size,
+                                      random_state, verbose=False)
+        rows.append({'day': day,
+                     'n_vectors': report['n_vectors'],
+                     'n_drifted_features': len(report['drifted_features']),
+                     'energy_statistic': report['energy_statistic'],
+                     'energy_pvalue': report['energy_pvalue'],
+                     'retrain': report['retrain']})
+    return pd.DataFrame(rows).set_index('day')
+
+def check_reference_days(reference, x_df, dates, alpha=1, max_drifted_ratio=0.1, n_bootstrap=99, sample_size=2000,
+                         random_state=None):
+    """
+    Sanity check of a reference: the days of the vectors it was built from belong to the training
+    distribution, none of them must advise to retrain (otherwise the monitor would raise an alarm
+    every day, e.g. because of features that are constant within a day)
+
+    Parameters
+    -------------
+    reference: dict
+        the reference (see build_drift_reference)
+    x_df: pandas DataFrame
+        the feature vectors the reference was built from
+    dates: numpy ndarray
+        the day_0 of each vector
+    (other parameters: see compute_drift_report)
+
+    Returns
+    -------------
+    summary_df: pandas DataFrame
+        the summary of the reports of the days (see monitor_days)
+    """
+    summary_df = monitor_days(reference, x_df, dates, alpha, max_drifted_ratio, n_bootstrap, sample_size, random_state)
+    alarms = [str(d) for d in summary_df.index[summary_df.retrain]]
+    assert(len(alarms) == 0), 'The reference advises to retrain on the days it was built from: {}'.format(alarms)
+    return summary_df
@@ -8,14 +8,19 @@ __author__ = "Hugo Moreau"
 __email__ = "hugo.moreau@epfl.ch"
 __status__ = "Prototype"
 
-import scipy, timeit
-from scipy import stats
+import scipy.spatial.distance, timeit
+from scipy import stats, special
 import numpy as np
 import pandas as pd
 import os
 import sys
+import hashlib
+import shutil
+import tempfile
+from joblib import Parallel, delayed
 
-from scripts.utils import *
+import scripts.utils
+from scripts.utils import progress
 ### --------------------------------------------------------------------------------------------
 ### ----------------------------------------Naive-----------------------------------------------
 ### --------------------------------------------------------------------------------------------
@@ -52,13 +57,122 @@ def get_ks_test_result(weekday_df,weekend_df,measurements,with_miss_mes=True):
     result_df = pd.DataFrame(results).set_index('measurement')[['statistic','pvalue']]
     return result_df.sort_values(by='pvalue',ascending=True)
 
+def compute_ks_energy_block(first, second, columns=slice(None)):
+    """
+    Computes at once, for each column of a block, the two-sample Kolmogorov-Smirnov statistic and 
+    the 1-D energy distance between the two populations. The columns of the pooled values are sorted 
+    once (in O(n log n)) and both empirical CDFs are read from the cumulated labels: the KS statistic 
+    is the largest gap between the CDFs (taken after each distinct value) and the energy distance is 
+    sqrt(2*integral((F1-F2)^2)), as in scipy.stats.energy_distance. The missing values (NaN) are 
+    ignored: the CDFs of a column are those of its non missing values in each population (the 
+    statistics are NaN if one of them has none).
+
+    Parameters
+    -------------
+    first: numpy ndarray
+        n1 by c array containing the c measurements of the first population
+    second: numpy ndarray
+        n2 by c array containing the same measurements for the second population
+    columns: slice, default all the columns
+        the block of columns to process
+
+    Returns
+    -------------
+    ks_statistics: numpy ndarray
+        the KS statistic of each column
+    energy_distances: numpy ndarray
+        the energy distance of each column
+    """
+    n_first = first.shape[0]
+    # one row per measurement such that the sorts run on contiguous memory
+    pooled = np.ascontiguousarray(np.concatenate((first[:, columns], second[:, columns]), axis=0).T, dtype=np.float64)
+    present = ~np.isnan(pooled)
+    n1 = present[:, :n_first].sum(axis=1)[:, None]
+    n2 = present[:, n_first:].sum(axis=1)[:, None]
+
+    # the missing values are sorted last and never counted in the CDFs
+    order = np.argsort(pooled, axis=1)
+    values = np.take_along_axis(pooled, order, axis=1)
+    valid = ~np.isnan(values)
+    from_first = (order < n_first) & valid
+    from_second = (order >= n_first) & valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf_gap = np.cumsum(from_first, axis=1)/n1 - np.cumsum(from_second, axis=1)/n2
+
+    # the CDFs are only compared after the last occurence of each value
+    widths = np.diff(values, axis=1)
+    last_of_value = np.hstack((widths != 0, np.ones((values.shape[0], 1), dtype=bool))) & valid
+    widths = np.where(valid[:, 1:], widths, 0)
+    ks_statistics = np.where(last_of_value, np.abs(cdf_gap), 0).max(axis=1)
+    energy_distances = np.sqrt(2*(np.where(valid[:, 1:], cdf_gap[:,:-1], 0)**2*widths).sum(axis=1))
+
+    empty = (n1[:, 0] == 0) | (n2[:, 0] == 0)
+    ks_statistics[empty] = np.nan
+    energy_distances[empty] = np.nan
+    return ks_statistics, energy_distances
+
+def screen_distribution_shift(first_df, second_df, measurements, with_miss_mes=True, block_size=32, n_jobs=-1):
+    """
+    Vectorized counterpart of get_ks_test_result that also computes the 1-D energy distance of 
+    each measurement: the measurements are processed by blocks of columns (see compute_ks_energy_block) 
+    run in parallel, such that all the measurements of two days (or of weekdays and weekends) can be 
+    screened in seconds. The p-values are those of the asymptotic distribution of the KS statistic 
+    (scipy.stats.ks_2samp with method='asymp', which is also what it uses for large samples). The 
+    missing values are dropped per measurement, as if ks_2samp was run on the non missing values 
+    of each column (the statistic and p-value are NaN for a measurement missing in a population).
+
+    Parameters
+    -------------
+    first_df : pandas Dataframe
+        contains the first population
+    second_df : pandas DataFrame
+        contains the seconds population
+    measurements: list(str)
+        the list of columns that we wish to look at
+    with_miss_mes: boolean, default True
+        can be et to False to take out the Measurements that are prefixed by 'MISS' in the list of measurements
+    block_size: int, default 32
+        the number of measurements processed together
+    n_jobs: int, default -1
+        the number of processes (-1 for all cores)
+
+    Returns
+    -------------
+    results_df: pandas Dataframe
+        KS statistic, p-value and energy distance of each measurement, sorted by increasing p-values
+    """
+    considered_mes = measurements
+    if(not with_miss_mes):
+        considered_mes = [x for x in measurements if not('MISS' in x)]
+    first = first_df[considered_mes].values.astype(np.float64)
+    second = second_df[considered_mes].values.astype(np.float64)
+
+    starts = range(0, len(considered_mes), block_size)
+    # the populations are memory mapped once and each worker only reads its block of columns
+    blocks = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+        delayed(compute_ks_energy_block)(first, second, slice(s, s + block_size)) for s in starts)
+    ks_statistics = np.concatenate([b[0] for b in blocks])
+    energy_distances = np.concatenate([b[1] for b in blocks])
+
+    # the sample sizes of each measurement only count its non missing values
+    n1 = (~np.isnan(first)).sum(axis=0).astype(np.float64)
+    n2 = (~np.isnan(second)).sum(axis=0).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_values = stats.kstwo.sf(ks_statistics, np.round(n1*n2/(n1 + n2)))
+    p_values[np.isnan(ks_statistics)] = np.nan
+
+    result_df = pd.DataFrame({'statistic': ks_statistics, 'pvalue': p_values, 'energy_distance': energy_distances},
+                             index=pd.Index(considered_mes, name='measurement'))
+    return result_df.sort_values(by='pvalue',ascending=True)
+
 
 
 ### --------------------------------------------------------------------------------------------
 ### ----------------------------------------Energy test-----------------------------------------
 ### --------------------------------------------------------------------------------------------
 
-def energy_two_sample_large_dataset(original_X,original_Y,n_bootstrap=99,alpha=1,print_exec_time=True,n_repeat=10,sample_size=10000,similar=False):
+def energy_two_sample_large_dataset(original_X,original_Y,n_bootstrap=99,alpha=1,print_exec_time=True,n_repeat=10,sample_size=10000,similar=False,
+                                    engine='batched',batch_size=100,n_jobs=1,random_state=None):
     """
     Similar to energy_two_sample_test but works on large data samples, so it will subsample 
     the population and run the experiment multiple times to estimate test results.
@@ -78,6 +192,17 @@ def energy_two_sample_large_dataset(original_X,original_Y,n_bootstrap=99,alpha=1
     similar: boolean, default False
         f we want to run the test by sampling two population 
         from only original_X (can be useful for reality checks)
+    engine: str, default 'batched'
+        'batched' to evaluate the permutations by batches of matrix products (see 
+        compute_energy_replicates_batched) or 'loop' to evaluate them one by one
+    batch_size: int, default 100
+        the number of permutations per batch of the 'batched' engine
+    n_jobs: int, default 1
+        if different from 1, the repetitions are run in parallel by n_jobs processes (-1 for 
+        all cores), each with its own random stream spawned from random_state (the populations 
+        are shared with the workers through a memory map)
+    random_state: int, optional
+        seed of the random streams of the parallel repetitions
 
     Returns
     -------------
@@ -97,55 +222,59 @@ def energy_two_sample_large_dataset(original_X,original_Y,n_bootstrap=99,alpha=1
     observed = []
     limits = []
 
-    count = 0
-    for i in range(n_repeat):
-        if(count == 0):
-            scripts.utils.progress(count+1,n_bootstrap*n_repeat)
-        if(similar):
-            assert(original_Y == None)
-            sample_size = min(sample_size,original_X.shape[1]/2)
-            sample = original_X[:,np.random.choice(original_X.shape[1],2*sample_size,replace=False)]
-            x_samp = sample[:,:sample_size]
-            y_samp = sample[:,sample_size:]
-        else:
-            # because we sample without replacement we take the maximum sample size up to the limit passed by argument
-            sample_size = min(sample_size,min(original_X.shape[1],original_Y.shape[1]))
-            x_samp = original_X[:,np.random.choice(original_X.shape[1],sample_size,replace=False)]
-            y_samp = original_Y[:,np.random.choice(original_Y.shape[1],sample_size,replace=False)]
+    if(n_jobs != 1):
+        seeds = np.random.SeedSequence(random_state).spawn(n_repeat)
+        results = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+            delayed(run_subsampled_test)(original_X, original_Y, n_bootstrap, alpha, sample_size, similar, batch_size, seed) for seed in seeds)
+        for p_value, E_distance_observed, lim in results:
+            p_values.append(p_value)
+            observed.append(E_distance_observed)
+            limits.append(lim)
+    else:
+        count = 0
+        for i in range(n_repeat):
+            if(count == 0):
+                scripts.utils.progress(count+1,n_bootstrap*n_repeat)
+            x_samp, y_samp = get_subsamples(original_X, original_Y, sample_size, similar)
 
-        # we will store the distances between two vectors in this matrix, it will not be n*n because 
-        # it would then be storing twice the same info (as distance is symetric)
-        d,n1 = x_samp.shape
-        n2 = y_samp.shape[1]
-        n = n1 + n2
+            # we will store the distances between two vectors in this matrix, it will not be n*n because 
+            # it would then be storing twice the same info (as distance is symetric)
+            d,n1 = x_samp.shape
+            n2 = y_samp.shape[1]
+            n = n1 + n2
 
-        pooled = np.concatenate((x_samp,y_samp),axis=1)
+            pooled = np.concatenate((x_samp,y_samp),axis=1)
 
-        transposed = pooled.T
-        distance_square_form = scipy.spatial.distance.pdist(transposed)
-        distance = scipy.spatial.distance.squareform(distance_square_form)
-         
-        X_indices = np.arange(n1)
-        Y_indices = np.arange(n1,n)
-        
-        E_distance_observed = compute_energy_statistic(X_indices,Y_indices,distance)
-        E_distance_replicates = []
-        
-        for b in range(0,n_bootstrap):
-            if(count != 0):
-                progress(count+1,n_bootstrap*n_repeat)
-            indices_Xb,indices_Yb = get_resampled_indices(n1, n2)
-            E_distance = compute_energy_statistic(indices_Xb,indices_Yb,distance)
-            E_distance_replicates.append(E_distance)
-            count = count + 1
+            transposed = pooled.T
+            distance_square_form = scipy.spatial.distance.pdist(transposed)
+            distance = scipy.spatial.distance.squareform(distance_square_form)
+             
+            X_indices = np.arange(n1)
+            Y_indices = np.arange(n1,n)
             
-        percentile_lim = (100-alpha)
-        lim = np.percentile(np.array(E_distance_replicates),percentile_lim)
-        p_value = find_p_value(E_distance_replicates,E_distance_observed)
+            E_distance_observed = compute_energy_statistic(X_indices,Y_indices,distance)
+            E_distance_replicates = []
+            
+            if(engine == 'batched'):
+                E_distance_replicates = compute_energy_replicates_batched(lambda: iter_matrix_tiles(distance), n1, n2, n_bootstrap, batch_size, verbose=False)
+                count = count + n_bootstrap
+                progress(count,n_bootstrap*n_repeat)
+            else:
+                for b in range(0,n_bootstrap):
+                    if(count != 0):
+                        progress(count+1,n_bootstrap*n_repeat)
+                    indices_Xb,indices_Yb = get_resampled_indices(n1, n2)
+                    E_distance = compute_energy_statistic(indices_Xb,indices_Yb,distance)
+                    E_distance_replicates.append(E_distance)
+                    count = count + 1
+                
+            percentile_lim = (100-alpha)
+            lim = np.percentile(np.array(E_distance_replicates),percentile_lim)
+            p_value = find_p_value(E_distance_replicates,E_distance_observed)
 
-        p_values.append(p_value)
-        observed.append(E_distance_observed)
-        limits.append(lim)
+            p_values.append(p_value)
+            observed.append(E_distance_observed)
+            limits.append(lim)
 
     end = timeit.default_timer()
 
@@ -163,7 +292,8 @@ def energy_two_sample_large_dataset(original_X,original_Y,n_bootstrap=99,alpha=1
 
 
 
-def energy_two_sample_test(original_X,original_Y,n_bootstrap,alpha,distance_matrix_bkp=None,print_exec_time=True,use_bkp=True):
+def energy_two_sample_test(original_X,original_Y,n_bootstrap,alpha,distance_matrix_bkp=None,print_exec_time=True,use_bkp=True,engine='batched',batch_size=100,
+                           n_jobs=1,random_state=None,cache_dir=None,metric='euclidean'):
     """
     Performs the hypothesis testing: given two independent random 
     samples in R^d, it will test whether we can reject the null hypothesis
@@ -191,6 +321,22 @@ def energy_two_sample_test(original_X,original_Y,n_bootstrap,alpha,distance_matr
         can be set to true to also display the information regarding the running times
     use_bkp: boolean, default True
         can be set to True if we wish to use a backup of the distance matrix
+    engine: str, default 'batched'
+        'batched' to evaluate the permutations by batches of matrix products (see 
+        compute_energy_replicates_batched) or 'loop' to evaluate them one by one
+    batch_size: int, default 100
+        the number of permutations per batch of the 'batched' engine
+    n_jobs: int, default 1
+        if different from 1, the permutations are evaluated by n_jobs processes (-1 for all cores) 
+        sharing the memory mapped condensed distance matrix (see parallel_energy_replicates)
+    random_state: int, optional
+        seed of the random streams of the parallel permutations
+    cache_dir: str, optional
+        if set, the condensed distance matrix is taken from (or added to) the float32 distance 
+        cache in this folder (see get_cached_condensed_distances) instead of distance_matrix_bkp, 
+        and the permutations are evaluated by batches directly on its memory map
+    metric: str, default 'euclidean'
+        the metric of the distances (only used with cache_dir)
 
 
     Returns
@@ -211,19 +357,21 @@ def energy_two_sample_test(original_X,original_Y,n_bootstrap,alpha,distance_matr
     pooled = np.concatenate((original_X,original_Y),axis=1)
     
     path = distance_matrix_bkp
-    if(use_bkp and not path.endswith('.npy')):
+    if(cache_dir is not None):
+        use_bkp = False
+    elif(use_bkp and not path.endswith('.npy')):
         path = path+'.npy'
 
     # first we compute the distance matrix
-    if(use_bkp and os.path.isfile(path)):
+    if(cache_dir is not None):
+        distance_square_form, path = get_cached_condensed_distances(pooled.T, cache_dir, metric)
+    elif(use_bkp and os.path.isfile(path)):
             print("Retrieving the distance matrix at: {}".format(path))
-            distance_square_form = np.load(path)
-            distance = scipy.spatial.distance.squareform(distance_square_form)
+            distance_square_form = np.load(path, mmap_mode='r' if n_jobs != 1 else None)
     else:
         print("Computing the distance matrix...")
         transposed = pooled.T
         distance_square_form = scipy.spatial.distance.pdist(transposed)
-        distance = scipy.spatial.distance.squareform(distance_square_form)
         if(use_bkp):
             print("Saving the distance matrix at: {}".format(path))
             np.save(path,distance_square_form)
@@ -231,14 +379,37 @@ def energy_two_sample_test(original_X,original_Y,n_bootstrap,alpha,distance_matr
     X_indices = np.arange(n1)
     Y_indices = np.arange(n1,n)
     
-    E_distance_observed = compute_energy_statistic(X_indices,Y_indices,distance)
-    E_distance_replicates = []
-    
-    for b in range(0,n_bootstrap):
-        progress(b+1,n_bootstrap)
-        indices_Xb,indices_Yb = get_resampled_indices(n1, n2)
-        E_distance = compute_energy_statistic(indices_Xb,indices_Yb,distance)
-        E_distance_replicates.append(E_distance)
+    if(n_jobs != 1 or cache_dir is not None):
+        # the workers read the condensed matrix from disk, so it must have been saved
+        tmp_dir = None
+        if(not use_bkp and cache_dir is None):
+            tmp_dir = tempfile.mkdtemp()
+            path = os.path.join(tmp_dir, 'condensed.npy')
+            np.save(path, distance_square_form)
+        s_xx, s_yy, s_xy = accumulate_group_sums(iter_condensed_tiles(distance_square_form, n), np.arange(n) < n1)
+        E_distance_observed = energy_from_sums(s_xx, s_yy, s_xy, n1, n2)
+        try:
+            if(n_jobs != 1):
+                E_distance_replicates = parallel_energy_replicates(path, n1, n2, n_bootstrap, n_jobs, random_state, batch_size)
+            else:
+                E_distance_replicates = compute_energy_replicates_batched(lambda: iter_condensed_tiles(distance_square_form, n), n1, n2,
+                                                                          n_bootstrap, batch_size)
+        finally:
+            if(tmp_dir is not None):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        distance = scipy.spatial.distance.squareform(distance_square_form)
+        E_distance_observed = compute_energy_statistic(X_indices,Y_indices,distance)
+        E_distance_replicates = []
+
+        if(engine == 'batched'):
+            E_distance_replicates = compute_energy_replicates_batched(lambda: iter_matrix_tiles(distance), n1, n2, n_bootstrap, batch_size)
+        else:
+            for b in range(0,n_bootstrap):
+                progress(b+1,n_bootstrap)
+                indices_Xb,indices_Yb = get_resampled_indices(n1, n2)
+                E_distance = compute_energy_statistic(indices_Xb,indices_Yb,distance)
+                E_distance_replicates.append(E_distance)
         
 
     percentile_lim = (100-alpha)
@@ -347,3 +518,921 @@ def find_p_value(bootstrapped_energy_list, observed_value):
             count += 1
     return count/len(bootstrapped_energy_list)
 
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Blocked energy statistic----------------------------
+### --------------------------------------------------------------------------------------------
+def iter_distance_tiles(pooled_T, tile_size=1000, metric='euclidean'):
+    """
+    Streams the rows of the n by n distance matrix of the pooled vectors by tiles 
+    of tile_size rows, such that at most tile_size*n distances are in memory.
+
+    Parameters
+    -------------
+    pooled_T: numpy ndarray
+        n by d array where each row is one of the pooled vectors
+    tile_size: int, default 1000
+        the number of rows of each tile
+    metric: str, default 'euclidean'
+        the metric passed to scipy.spatial.distance.cdist
+
+    Returns
+    -------------
+    tiles: generator((int,numpy ndarray))
+        the index of the first row of each tile and the (tile_size,n) distances
+    """
+    n = pooled_T.shape[0]
+    for start in range(0, n, tile_size):
+        stop = min(start + tile_size, n)
+        yield start, scipy.spatial.distance.cdist(pooled_T[start:stop], pooled_T, metric=metric)
+
+def compute_group_distance_sums(pooled_T, in_X, tile_size=1000, metric='euclidean'):
+    """
+    Computes (without storing the distance matrix) the three double sums of the energy 
+    statistic: the sum of distances within the first group, within the second group and 
+    between the two groups (over ordered pairs, as compute_double_sum_eucl).
+
+    Parameters
+    -------------
+    pooled_T: numpy ndarray
+        n by d array where each row is one of the pooled vectors
+    in_X: numpy ndarray
+        boolean array of length n, True for the vectors of the first group 
+        (or n by B array to compute the sums of B groupings at once)
+    tile_size: int, default 1000
+        the number of rows of the distance matrix computed at once
+    metric: str, default 'euclidean'
+        the metric passed to scipy.spatial.distance.cdist
+
+    Returns
+    -------------
+    s_xx, s_yy, s_xy: float (or numpy ndarrays of length B)
+        sums of distances within X, within Y and between X and Y
+    """
+    return accumulate_group_sums(iter_distance_tiles(pooled_T, tile_size, metric), in_X)
+
+def accumulate_group_sums(tiles, in_X):
+    """
+    Accumulates over tiles of rows of a distance matrix the sums of distances within and 
+    between groups, for one or many groupings at once: with Z the n by B 0/1 matrix 
+    indicating the vectors of X in each grouping, the sums only require the products 
+    tile.Z (matrix products done by BLAS).
+
+    Parameters
+    -------------
+    tiles: iterable((int,numpy ndarray))
+        the index of the first row of each tile and the tile (see iter_distance_tiles)
+    in_X: numpy ndarray
+        boolean array of length n (one grouping) or n by B (B groupings)
+
+    Returns
+    -------------
+    s_xx, s_yy, s_xy: float (or numpy ndarrays of length B)
+        sums of distances within X, within Y and between X and Y
+    """
+    Z = np.asarray(in_X, dtype=np.float64)
+    single = (Z.ndim == 1)
+    if(single):
+        Z = Z[:,np.newaxis]
+    s_xx = np.zeros(Z.shape[1])
+    s_yy = np.zeros(Z.shape[1])
+    s_xy = np.zeros(Z.shape[1])
+    for start, tile in tiles:
+        Z_tile = Z[start:start + tile.shape[0]]
+        to_X = tile.dot(Z)                                  # distance of each row to the vectors of X
+        to_Y = tile.sum(axis=1)[:,np.newaxis] - to_X        # and to the vectors of Y
+        s_xx += (Z_tile*to_X).sum(axis=0)
+        s_xy += ((1 - Z_tile)*to_X).sum(axis=0)
+        s_yy += ((1 - Z_tile)*to_Y).sum(axis=0)
+    if(single):
+        return s_xx[0], s_yy[0], s_xy[0]
+    return s_xx, s_yy, s_xy
+
+def energy_from_sums(s_xx, s_yy, s_xy, n1, n2):
+    """
+    Computes the energy statistic from the double sums of distances 
+    (the same formula as compute_energy_statistic)
+
+    Parameters
+    -------------
+    s_xx, s_yy, s_xy: float or numpy ndarray
+        sums of distances within X, within Y and between X and Y
+    n1,n2: int
+        size of each group
+
+    Returns
+    -------------
+    E: float or numpy ndarray
+        the energy statistic
+    """
+    term1 = 2/(n1*n2) * s_xy
+    term2 = 1/(n1**2) * s_xx
+    term3 = 1/(n2**2) * s_yy
+    return (n1*n2)/(n1+n2)*(term1 - term2 - term3)
+
+def compute_energy_statistic_blocked(original_X, original_Y, tile_size=1000, metric='euclidean'):
+    """
+    Computes the energy statistic between two populations like compute_energy_statistic but 
+    streams the pairwise distances by tiles of rows instead of building the dense n by n 
+    distance matrix: the memory used is O(tile_size*n) instead of O(n^2), which allows to 
+    compare populations of any size (e.g. all the weekday and weekend vectors).
+
+    Parameters
+    -------------
+    original_X: numpy ndarray
+        d by n1 array matrix representing X_1, ...,X_n1 the random samples of the first population
+    original_Y: numpy ndarray
+        d by n2 array matrix representing Y_1, ...,Y_n2 the random samples of the second population
+    tile_size: int, default 1000
+        the number of rows of the distance matrix computed at once
+    metric: str, default 'euclidean'
+        the metric passed to scipy.spatial.distance.cdist
+
+    Returns
+    -------------
+    E: float 
+        the energy statistic
+    """
+    n1 = original_X.shape[1]
+    n2 = original_Y.shape[1]
+    pooled_T = np.concatenate((original_X,original_Y),axis=1).T
+    in_X = np.arange(n1 + n2) < n1
+    s_xx, s_yy, s_xy = compute_group_distance_sums(pooled_T, in_X, tile_size, metric)
+    return energy_from_sums(s_xx, s_yy, s_xy, n1, n2)
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Batched permutations--------------------------------
+### --------------------------------------------------------------------------------------------
+def iter_matrix_tiles(distance_matrix, tile_size=1000):
+    """
+    Iterates over tiles of rows of an already computed (square) distance matrix
+
+    Parameters
+    -------------
+    distance_matrix: numpy ndarray
+        n by n distance matrix
+    tile_size: int, default 1000
+        the number of rows of each tile
+
+    Returns
+    -------------
+    tiles: generator((int,numpy ndarray))
+        the index of the first row of each tile and the tile (a view, nothing is copied)
+    """
+    n = distance_matrix.shape[0]
+    for start in range(0, n, tile_size):
+        yield start, distance_matrix[start:start + tile_size]
+
+def get_permutation_indicators(n1, n2, n_permutations, rng=np.random):
+    """
+    Encodes permutations of the pooled samples as a 0/1 matrix Z where Z[i,b] = 1 if the 
+    vector i belongs to the first group in permutation b. The permutations are drawn in 
+    the same way as get_resampled_indices.
+
+    Parameters
+    -------------
+    n1,n2: int
+        >0 integers giving the repective size of the first and second sample
+    n_permutations: int
+        the number of permutations (B)
+    rng: numpy RandomState or Generator, default np.random
+        the source of randomness
+
+    Returns
+    -------------
+    Z: numpy ndarray
+        (n1+n2) by B matrix
+    """
+    n = n1 + n2
+    Z = np.zeros((n, n_permutations))
+    for b in range(n_permutations):
+        Z[rng.permutation(n)[:n1], b] = 1
+    return Z
+
+def compute_energy_replicates_batched(tiles_factory, n1, n2, n_bootstrap, batch_size=100, rng=np.random, verbose=True):
+    """
+    Computes the energy statistic of n_bootstrap permutations of the pooled samples by batches of 
+    batch_size permutations: each batch is encoded as a 0/1 group indicator matrix Z and all its 
+    within and between sums are obtained from the products D.Z (one pass over the distance matrix 
+    per batch) instead of gathering three submatrices per permutation.
+
+    Parameters
+    -------------
+    tiles_factory: () -> iterable((int,numpy ndarray))
+        function returning a new iterator over the tiles of rows of the distance matrix (e.g. 
+        lambda: iter_matrix_tiles(distance) or lambda: iter_distance_tiles(pooled_T))
+    n1,n2: int
+        the respective size of the first and second sample
+    n_bootstrap: int
+        the number of permutations
+    batch_size: int, default 100
+        the number of permutations evaluated in each pass (Z uses (n1+n2)*batch_size floats)
+    rng: numpy RandomState or Generator, default np.random
+        the source of randomness
+    verbose: boolean, default True
+        can be set to False to hide the progress bar
+
+    Returns
+    -------------
+    E_distance_replicates: list(float)
+        the energy statistic of each permutation
+    """
+    replicates = []
+    while(len(replicates) < n_bootstrap):
+        b = min(batch_size, n_bootstrap - len(replicates))
+        Z = get_permutation_indicators(n1, n2, b, rng)
+        s_xx, s_yy, s_xy = accumulate_group_sums(tiles_factory(), Z)
+        replicates.extend(energy_from_sums(s_xx, s_yy, s_xy, n1, n2).tolist())
+        if(verbose):
+            progress(len(replicates), n_bootstrap)
+    return replicates
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Parallel permutations-------------------------------
+### --------------------------------------------------------------------------------------------
+def condensed_index(n, i, j):
+    """
+    Returns the position in the condensed distance matrix (as returned by pdist) of the 
+    distance between the vectors i and j (i != j)
+
+    Parameters
+    -------------
+    n: int
+        the number of vectors
+    i,j: int or numpy ndarray
+        the indices of the vectors
+
+    Returns
+    -------------
+    k: int or numpy ndarray
+    """
+    a = np.minimum(i, j)
+    b = np.maximum(i, j)
+    return n*a - a*(a + 1)//2 + (b - a - 1)
+
+def iter_condensed_tiles(condensed, n, tile_size=500):
+    """
+    Iterates over tiles of rows of the distance matrix by reading them directly from 
+    its condensed form (which can be memory mapped), without building the n by n matrix.
+
+    Parameters
+    -------------
+    condensed: numpy ndarray
+        the condensed distance matrix of length n*(n-1)/2
+    n: int
+        the number of vectors
+    tile_size: int, default 500
+        the number of rows of each tile
+
+    Returns
+    -------------
+    tiles: generator((int,numpy ndarray))
+        the index of the first row of each tile and the (tile_size,n) distances
+    """
+    cols = np.arange(n, dtype=np.int64)
+    for start in range(0, n, tile_size):
+        rows = np.arange(start, min(start + tile_size, n), dtype=np.int64)[:,np.newaxis]
+        on_diagonal = (rows == cols)
+        tile = np.asarray(condensed[np.where(on_diagonal, 0, condensed_index(n, rows, cols))], dtype=np.float64)
+        tile[on_diagonal] = 0
+        yield start, tile
+
+def compute_replicates_from_condensed(condensed_path, n1, n2, n_permutations, seed, batch_size=100, tile_size=500):
+    """
+    Computes the energy statistic of n_permutations permutations of the pooled samples 
+    from a condensed distance matrix saved as a .npy file, which is memory mapped such 
+    that all the processes share the same pages (used by parallel_energy_replicates).
+
+    Parameters
+    -------------
+    condensed_path: str
+        the path of the condensed distance matrix
+    n1,n2: int
+        the respective size of the first and second sample
+    n_permutations: int
+        the number of permutations
+    seed: numpy SeedSequence or int
+        the seed of the random stream of the permutations
+    batch_size: int, default 100
+        the number of permutations per pass over the distance matrix
+    tile_size: int, default 500
+        the number of rows of the distance matrix read at once
+
+    Returns
+    -------------
+    E_distance_replicates: list(float)
+    """
+    condensed = np.load(condensed_path, mmap_mode='r')
+    rng = np.random.default_rng(seed)
+    n = n1 + n2
+    return compute_energy_replicates_batched(lambda: iter_condensed_tiles(condensed, n, tile_size), n1, n2, n_permutations,
+                                             batch_size, rng, verbose=False)
+
+def parallel_energy_replicates(condensed_path, n1, n2, n_bootstrap, n_jobs=-1, random_state=None, batch_size=100, tile_size=500):
+    """
+    Computes the permutation replicates of the energy test with n_jobs processes sharing the 
+    memory mapped condensed distance matrix. The permutations are split in blocks of batch_size 
+    and each block gets its own stream spawned from SeedSequence(random_state), so the replicates 
+    only depend on random_state and batch_size (not on n_jobs). They are returned in the order 
+    of the blocks such that find_p_value and the percentile limit can be applied as usual.
+
+    Parameters
+    -------------
+    condensed_path: str
+        the path of the condensed distance matrix (saved with np.save)
+    n1,n2: int
+        the respective size of the first and second sample
+    n_bootstrap: int
+        the number of permutations
+    n_jobs: int, default -1
+        the number of processes (-1 for all cores)
+    random_state: int, optional
+        the seed of the random streams
+    batch_size: int, default 100
+        the number of permutations per block
+    tile_size: int, default 500
+        the number of rows of the distance matrix read at once
+
+    Returns
+    -------------
+    E_distance_replicates: list(float)
+    """
+    sizes = [min(batch_size, n_bootstrap - start) for start in range(0, n_bootstrap, batch_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(sizes))
+    blocks = Parallel(n_jobs=n_jobs)(delayed(compute_replicates_from_condensed)(condensed_path, n1, n2, size, seed, batch_size, tile_size)
+                                     for size, seed in zip(sizes, seeds))
+    return [e for block in blocks for e in block]
+
+def get_subsamples(original_X, original_Y, sample_size, similar=False, rng=np.random):
+    """
+    Subsamples (without replacement) the two populations for one repetition of 
+    energy_two_sample_large_dataset
+
+    Parameters
+    -------------
+    original_X, original_Y: numpy ndarray
+        d by n1 and d by n2 arrays of the two populations (original_Y is None if similar)
+    sample_size: int
+        the number of samples in each population (if it isn't available we will use the max available)
+    similar: boolean, default False
+        to sample both populations from original_X
+    rng: numpy RandomState or Generator, default np.random
+        the source of randomness
+
+    Returns
+    -------------
+    x_samp, y_samp: numpy ndarray
+    """
+    if(similar):
+        assert(original_Y is None)
+        sample_size = min(sample_size,original_X.shape[1]//2)
+        sample = original_X[:,rng.choice(original_X.shape[1],2*sample_size,replace=False)]
+        return sample[:,:sample_size], sample[:,sample_size:]
+    # because we sample without replacement we take the maximum sample size up to the limit passed by argument
+    sample_size = min(sample_size,min(original_X.shape[1],original_Y.shape[1]))
+    x_samp = original_X[:,rng.choice(original_X.shape[1],sample_size,replace=False)]
+    y_samp = original_Y[:,rng.choice(original_Y.shape[1],sample_size,replace=False)]
+    return x_samp, y_samp
+
+def run_subsampled_test(original_X, original_Y, n_bootstrap, alpha, sample_size, similar, batch_size, seed):
+    """
+    Runs one repetition of energy_two_sample_large_dataset with its own random stream 
+    (used by the parallel repetitions)
+
+    Parameters
+    -------------
+    see energy_two_sample_large_dataset
+    seed: numpy SeedSequence or int
+        the seed of the random stream of the subsampling and of the permutations
+
+    Returns
+    -------------
+    p_value: float
+    E_distance_observed: float
+    lim: float
+        the limit that the statistic shouldn't reach
+    """
+    rng = np.random.default_rng(seed)
+    x_samp, y_samp = get_subsamples(original_X, original_Y, sample_size, similar, rng)
+    n1 = x_samp.shape[1]
+    n2 = y_samp.shape[1]
+    distance = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(np.concatenate((x_samp,y_samp),axis=1).T))
+
+    E_distance_observed = compute_energy_statistic(np.arange(n1),np.arange(n1,n1+n2),distance)
+    E_distance_replicates = compute_energy_replicates_batched(lambda: iter_matrix_tiles(distance), n1, n2, n_bootstrap,
+                                                              batch_size, rng, verbose=False)
+    lim = np.percentile(np.array(E_distance_replicates),100-alpha)
+    return find_p_value(E_distance_replicates,E_distance_observed), E_distance_observed, lim
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Distance matrix cache-------------------------------
+### --------------------------------------------------------------------------------------------
+def get_distance_key(pooled_T, metric='euclidean'):
+    """
+    Returns the key of the condensed distance matrix of the pooled vectors in the distance cache: 
+    a hash of the metric, of the shape and of all the values of the vectors, such that an entry 
+    can never be reused for other data.
+
+    Parameters
+    -------------
+    pooled_T: numpy ndarray
+        n by d array where each row is one of the pooled vectors
+    metric: str, default 'euclidean'
+        the metric of the distances
+
+    Returns
+    -------------
+    key: str
+    """
+    pooled_T = np.ascontiguousarray(pooled_T, dtype=np.float64)
+    h = hashlib.sha1()
+    h.update('{}|{}'.format(metric, pooled_T.shape).encode('utf-8'))
+    h.update(pooled_T.tobytes())
+    return h.hexdigest()
+
+def get_cached_condensed_distances(pooled_T, cache_dir, metric='euclidean', verbose=True):
+    """
+    Returns the condensed distance matrix (as computed by pdist) of the pooled vectors from 
+    the distance cache, computing and adding it if needed. The entries are stored in float32 
+    (half the disk of np.save on the pdist output) and opened with mmap_mode='r', so loading 
+    them is almost free: they are meant to be indexed directly (see condensed_index and 
+    iter_condensed_tiles) rather than expanded with squareform.
+
+    Parameters
+    -------------
+    pooled_T: numpy ndarray
+        n by d array where each row is one of the pooled vectors
+    cache_dir: str
+        the folder of the cache (it will be created if needed)
+    metric: str, default 'euclidean'
+        the metric passed to scipy.spatial.distance.pdist
+    verbose: boolean, default True
+        can be set to False to not print whether the entry was found
+
+    Returns
+    -------------
+    condensed: numpy memmap
+        the condensed distance matrix of length n*(n-1)/2
+    path: str
+        the path of the entry
+    """
+    path = os.path.join(cache_dir, get_distance_key(pooled_T, metric) + '.npy')
+    if(os.path.isfile(path)):
+        if(verbose):
+            print("Retrieving the distance matrix at: {}".format(path))
+    else:
+        if(verbose):
+            print("Computing the distance matrix...")
+        os.makedirs(cache_dir, exist_ok=True)
+        condensed = scipy.spatial.distance.pdist(pooled_T, metric=metric).astype(np.float32)
+        # written under another name first such that a concurrent reader never sees a partial entry
+        tmp_path = path + '.{}.tmp.npy'.format(os.getpid())
+        np.save(tmp_path, condensed)
+        os.replace(tmp_path, path)
+        if(verbose):
+            print("Saving the distance matrix at: {}".format(path))
+    return np.load(path, mmap_mode='r'), path
+
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Sequential permutation test-------------------------
+### --------------------------------------------------------------------------------------------
+def get_p_value_bounds(n_exceed, n_replicates, confidence=0.99):
+    """
+    Clopper-Pearson confidence interval of the p-value (the probability that a permutation 
+    statistic is over the observed one) given the permutations evaluated so far
+
+    Parameters
+    -------------
+    n_exceed: int
+        the number of replicates over the observed statistic
+    n_replicates: int
+        the number of replicates evaluated
+    confidence: float, default 0.99
+        the confidence level of the interval
+
+    Returns
+    -------------
+    lower, upper: float
+    """
+    tail = (1 - confidence)/2
+    lower = 0. if n_exceed == 0 else stats.beta.ppf(tail, n_exceed, n_replicates - n_exceed + 1)
+    upper = 1. if n_exceed == n_replicates else stats.beta.ppf(1 - tail, n_exceed + 1, n_replicates - n_exceed)
+    return lower, upper
+
+def energy_two_sample_sequential_test(original_X, original_Y, alpha, max_permutations=9999, batch_size=100, confidence=0.99, h=None,
+                                      cache_dir=None, random_state=None, print_exec_time=True):
+    """
+    Sequential version of energy_two_sample_test: the permutations are evaluated by batches 
+    (see compute_energy_replicates_batched) and the test stops as soon as the decision at the 
+    level alpha is settled, i.e. when the Clopper-Pearson interval of the p-value at the given 
+    confidence is entirely below or above alpha. If h is set, it also stops (Besag-Clifford) once 
+    h replicates are over the observed statistic, the p-value being then at least h/(replicates used). 
+    Clear rejections and clear non rejections then only need a few hundred permutations.
+
+    Parameters
+    -------------
+    original_X: numpy ndarray
+        d by n1 array matrix representing X_1, ...,X_n1 the random samples of the first population
+    original_Y: numpy ndarray
+        d by n2 array matrix representing Y_1, ...,Y_n2 the random samples of the second population
+    alpha: int
+        significance level (in 0-100)
+    max_permutations: int, default 9999
+        the maximum number of permutations, evaluated if the decision is still unclear
+    batch_size: int, default 100
+        the number of permutations evaluated between two checks of the stopping rule
+    confidence: float, default 0.99
+        the confidence level of the interval of the p-value
+    h: int, optional
+        the number of replicates over the observed statistic after which the test stops
+    cache_dir: str, optional
+        if set, the condensed distance matrix is taken from the distance cache in this folder
+    random_state: int, optional
+        seed of the permutations
+    print_exec_time: boolean, default True
+        can be set to False to not display the execution time
+
+    Returns
+    -------------
+    p_value: float
+        the proportion of replicates over the observed statistic (as find_p_value)
+    E_distance_observed: float
+        the observed statistic
+    E_distance_replicates: list(float)
+        the replicates that were evaluated (their number is the number of permutations used)
+    """
+    start = timeit.default_timer()
+    assert (alpha <= 100 and alpha >= 0),"Alpha should be expressed as a percentage in [0-100]"
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+
+    n1 = original_X.shape[1]
+    n2 = original_Y.shape[1]
+    n = n1 + n2
+    pooled_T = np.concatenate((original_X,original_Y),axis=1).T
+
+    if(cache_dir is not None):
+        condensed, _ = get_cached_condensed_distances(pooled_T, cache_dir)
+        tiles_factory = lambda: iter_condensed_tiles(condensed, n)
+    else:
+        distance = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(pooled_T))
+        tiles_factory = lambda: iter_matrix_tiles(distance)
+
+    s_xx, s_yy, s_xy = accumulate_group_sums(tiles_factory(), np.arange(n) < n1)
+    E_distance_observed = energy_from_sums(s_xx, s_yy, s_xy, n1, n2)
+
+    E_distance_replicates = []
+    n_exceed = 0
+    while(len(E_distance_replicates) < max_permutations):
+        b = min(batch_size, max_permutations - len(E_distance_replicates))
+        batch = compute_energy_replicates_batched(tiles_factory, n1, n2, b, b, rng, verbose=False)
+        E_distance_replicates.extend(batch)
+        n_exceed += sum(1 for e in batch if e > E_distance_observed)
+        progress(len(E_distance_replicates), max_permutations)
+
+        lower, upper = get_p_value_bounds(n_exceed, len(E_distance_replicates), confidence)
+        if(upper < alpha/100 or lower > alpha/100 or (h is not None and n_exceed >= h)):
+            break
+
+    p_value = find_p_value(E_distance_replicates,E_distance_observed)
+    end = timeit.default_timer()
+
+    if(p_value < alpha/100):
+        print("We reject the Null hypothesis (CL = {}%): p-value = {}\n\t observed = {} \t replicates used = {}".format(100-alpha,p_value,E_distance_observed,len(E_distance_replicates)))
+    else:
+        print("We cannot reject the Null hypothesis (CL = {}%): p-value = {}\n\t observed = {} \t replicates used = {}".format(100-alpha,p_value,E_distance_observed,len(E_distance_replicates)))
+    if(print_exec_time):
+        print("Execution time: {}s".format(round(end-start,4)))
+    return p_value, E_distance_observed, E_distance_replicates
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------K-sample energy test--------------------------------
+### --------------------------------------------------------------------------------------------
+def accumulate_k_group_sums(tiles, labels, n_groups):
+    """
+    Accumulates over tiles of rows of a distance matrix the sums of distances between every 
+    pair of groups for B labellings at once: with G_b the n by k 0/1 indicator matrix of the 
+    labelling b, the sums are G_b'.D.G_b, obtained from the products of the tiles with all the 
+    G_b stacked side by side.
+
+    Parameters
+    -------------
+    tiles: iterable((int,numpy ndarray))
+        the index of the first row of each tile and the tile (see iter_distance_tiles)
+    labels: numpy ndarray
+        n by B array giving the group (in 0..k-1) of each vector in each labelling
+    n_groups: int
+        the number of groups (k)
+
+    Returns
+    -------------
+    sums: numpy ndarray
+        B by k by k array, sums[b,i,j] is the sum of the distances between the vectors of 
+        the group i and of the group j in the labelling b
+    """
+    n, B = labels.shape
+    G = (labels[:,:,np.newaxis] == np.arange(n_groups)).astype(np.float64)   # n by B by k
+    sums = np.zeros((B, n_groups, n_groups))
+    for start, tile in tiles:
+        DG = tile.dot(G.reshape(n, B*n_groups)).reshape(-1, B, n_groups)
+        sums += np.einsum('tbi,tbj->bij', G[start:start + tile.shape[0]], DG)
+    return sums
+
+def k_sample_statistics(sums, sizes):
+    """
+    Computes from the sums of distances between groups the two-sample energy statistic of 
+    every pair of groups and the between-sample DISCO statistic (Rizzo and Szekely 2010) which 
+    weights the pairwise statistics by (n_i+n_j)/(2N).
+
+    Parameters
+    -------------
+    sums: numpy ndarray
+        B by k by k sums of distances (see accumulate_k_group_sums)
+    sizes: numpy ndarray
+        the number of vectors in each group
+
+    Returns
+    -------------
+    disco: numpy ndarray
+        the between-sample statistic of each labelling
+    pairwise: numpy ndarray
+        B by k by k two-sample energy statistics
+    """
+    k = len(sizes)
+    N = sizes.sum()
+    pairwise = np.zeros(sums.shape)
+    disco = np.zeros(sums.shape[0])
+    for i in range(k):
+        for j in range(i + 1, k):
+            pairwise[:,i,j] = energy_from_sums(sums[:,i,i], sums[:,j,j], sums[:,i,j], sizes[i], sizes[j])
+            pairwise[:,j,i] = pairwise[:,i,j]
+            disco += (sizes[i] + sizes[j])/(2*N)*pairwise[:,i,j]
+    return disco, pairwise
+
+def energy_k_sample_test(samples, n_bootstrap, alpha, names=None, batch_size=50, cache_dir=None, random_state=None, print_exec_time=True):
+    """
+    Performs the k-sample energy test (DISCO): given k independent random samples in R^d 
+    (e.g. the vectors of each day of the week), it tests whether we can reject the null 
+    hypothesis that they are all sampled from the same distribution. The pooled distances are 
+    computed once, the group labels are permuted jointly and each batch of permutations needs 
+    a single pass over the distance matrix. The two-sample statistics of every pair of groups 
+    are obtained from the same permutations, which replaces the k(k-1)/2 runs of 
+    energy_two_sample_test (their p-values are computed under the global null hypothesis).
+
+    Parameters
+    -------------
+    samples: list(numpy ndarray)
+        the k populations, each a d by n_i array (as in energy_two_sample_test)
+    n_bootstrap: int
+        the number of permutations
+    alpha: int
+        significance level (in 0-100)
+    names: list(str), optional
+        the name of each population (their index by default)
+    batch_size: int, default 50
+        the number of permutations per pass over the distance matrix
+    cache_dir: str, optional
+        if set, the condensed distance matrix is taken from the distance cache in this folder
+    random_state: int, optional
+        seed of the permutations
+    print_exec_time: boolean, default True
+        can be set to False to not display the execution time
+
+    Returns
+    -------------
+    p_value: float
+        the p-value of the k-sample test
+    pairwise_df: pandas DataFrame
+        the observed two-sample statistic and its p-value for every pair of populations
+    E_distance_replicates: list(float)
+        the between-sample statistic of each permutation
+    """
+    start = timeit.default_timer()
+    assert (alpha <= 100 and alpha >= 0),"Alpha should be expressed as a percentage in [0-100]"
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    names = list(range(len(samples))) if names is None else names
+    k = len(samples)
+
+    sizes = np.array([s.shape[1] for s in samples])
+    n = sizes.sum()
+    labels = np.repeat(np.arange(k), sizes)
+    pooled_T = np.concatenate(samples, axis=1).T
+
+    if(cache_dir is not None):
+        condensed, _ = get_cached_condensed_distances(pooled_T, cache_dir)
+        tiles_factory = lambda: iter_condensed_tiles(condensed, n)
+    else:
+        print("Computing the distance matrix...")
+        distance = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(pooled_T))
+        tiles_factory = lambda: iter_matrix_tiles(distance)
+
+    disco_observed, pairwise_observed = k_sample_statistics(accumulate_k_group_sums(tiles_factory(), labels[:,np.newaxis], k), sizes)
+    disco_observed = disco_observed[0]
+    pairwise_observed = pairwise_observed[0]
+
+    E_distance_replicates = []
+    pairwise_exceed = np.zeros((k, k))
+    while(len(E_distance_replicates) < n_bootstrap):
+        b = min(batch_size, n_bootstrap - len(E_distance_replicates))
+        permuted = np.column_stack([rng.permutation(labels) for _ in range(b)])
+        disco, pairwise = k_sample_statistics(accumulate_k_group_sums(tiles_factory(), permuted, k), sizes)
+        E_distance_replicates.extend(disco.tolist())
+        pairwise_exceed += (pairwise > pairwise_observed).sum(axis=0)
+        progress(len(E_distance_replicates), n_bootstrap)
+
+    p_value = find_p_value(E_distance_replicates, disco_observed)
+    pairwise_df = pd.DataFrame([{'first': names[i], 'second': names[j], 'statistic': pairwise_observed[i,j],
+                                 'pvalue': pairwise_exceed[i,j]/n_bootstrap} for i in range(k) for j in range(i + 1, k)])
+    pairwise_df = pairwise_df.set_index(['first','second']).sort_values(by='pvalue', ascending=True)
+    end = timeit.default_timer()
+
+    if(p_value < alpha/100):
+        print("We reject the Null hypothesis (CL = {}%): p-value = {}\n\t observed = {}".format(100-alpha,p_value,disco_observed))
+    else:
+        print("We cannot reject the Null hypothesis (CL = {}%): p-value = {}\n\t observed = {}".format(100-alpha,p_value,disco_observed))
+    if(print_exec_time):
+        print("Execution time: {}s".format(round(end-start,4)))
+    return p_value, pairwise_df, E_distance_replicates
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Random projections----------------------------------
+### --------------------------------------------------------------------------------------------
+def get_projection_constant(d):
+    """
+    Returns the constant c_d such that |x| = c_d * E|<theta,x>| for any x in R^d, where theta 
+    is uniform on the unit sphere: c_d = sqrt(pi)*Gamma((d+1)/2)/Gamma(d/2)
+
+    Parameters
+    -------------
+    d: int
+        the dimension of the vectors
+
+    Returns
+    -------------
+    c_d: float
+    """
+    return np.sqrt(np.pi)*np.exp(special.gammaln((d + 1)/2) - special.gammaln(d/2))
+
+def get_sorted_projections(pooled_T, n_projections=100, rng=np.random):
+    """
+    Projects the pooled vectors on random directions (uniform on the unit sphere) and sorts 
+    each projection once, the permutations then only change the labels of the sorted values.
+
+    Parameters
+    -------------
+    pooled_T: numpy ndarray
+        n by d array where each row is one of the pooled vectors
+    n_projections: int, default 100
+        the number of directions (K)
+    rng: numpy RandomState or Generator, default np.random
+        the source of randomness
+
+    Returns
+    -------------
+    order: numpy ndarray
+        K by n array, the indices of the vectors sorted along each direction
+    widths: numpy ndarray
+        K by n-1 array, the gaps between consecutive sorted projected values
+    """
+    directions = rng.standard_normal((pooled_T.shape[1], n_projections))
+    directions /= np.linalg.norm(directions, axis=0)
+    projected = np.ascontiguousarray(pooled_T.dot(directions).T)
+    order = np.argsort(projected, axis=1)
+    widths = np.diff(np.take_along_axis(projected, order, axis=1), axis=1)
+    return order, widths
+
+def compute_projected_statistics(order, widths, in_X):
+    """
+    Computes along each direction the 1-D energy statistic (without the n1*n2/(n1+n2) factor) 
+    2*integral((F1-F2)^2) of one or many groupings, in O(n) per direction and grouping since 
+    the projections are already sorted.
+
+    Parameters
+    -------------
+    order, widths: numpy ndarray
+        the sorted projections (see get_sorted_projections)
+    in_X: numpy ndarray
+        boolean array of length n, True for the vectors of the first group 
+        (or n by B array for B groupings)
+
+    Returns
+    -------------
+    statistics: numpy ndarray
+        K by B array (K by 1 for a single grouping)
+    """
+    in_X = np.asarray(in_X, dtype=bool)
+    if(in_X.ndim == 1):
+        in_X = in_X[:,np.newaxis]
+    n1 = in_X.sum(axis=0)
+    n2 = in_X.shape[0] - n1
+    # F1-F2 after the i first sorted values is c1/n1 - (i-c1)/n2, with c1 the number of them in X
+    ranks = np.arange(1, in_X.shape[0] + 1)[:,np.newaxis]/n2
+    statistics = np.zeros((order.shape[0], in_X.shape[1]))
+    for k in range(order.shape[0]):
+        cdf_gap = np.cumsum(in_X[order[k]], axis=0, dtype=np.float64)
+        cdf_gap *= (1/n1 + 1/n2)
+        cdf_gap -= ranks
+        statistics[k] = 2*widths[k].dot(cdf_gap[:-1]**2)
+    return statistics
+
+def compute_energy_statistic_projected(original_X, original_Y, n_projections=100, random_state=None):
+    """
+    Approximates the energy statistic of compute_energy_statistic in O(K n log n) instead of O(n^2): 
+    as |x-y| = c_d*E|<theta,x-y>|, the statistic is c_d times the average of the 1-D energy 
+    statistics of the projections on K random directions. The standard error of the average 
+    decreases as 1/sqrt(K).
+
+    Parameters
+    -------------
+    original_X: numpy ndarray
+        d by n1 array matrix representing X_1, ...,X_n1 the random samples of the first population
+    original_Y: numpy ndarray
+        d by n2 array matrix representing Y_1, ...,Y_n2 the random samples of the second population
+    n_projections: int, default 100
+        the number of random directions
+    random_state: int, optional
+        seed of the directions
+
+    Returns
+    -------------
+    E_distance: float
+        the approximated energy statistic
+    std_error: float
+        the standard error of the approximation
+    """
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    d, n1 = original_X.shape
+    n2 = original_Y.shape[1]
+    order, widths = get_sorted_projections(np.concatenate((original_X,original_Y),axis=1).T, n_projections, rng)
+    statistics = (n1*n2)/(n1+n2)*get_projection_constant(d)*compute_projected_statistics(order, widths, np.arange(n1+n2) < n1)[:,0]
+    return statistics.mean(), statistics.std(ddof=1)/np.sqrt(n_projections)
+
+def energy_two_sample_projected_test(original_X, original_Y, n_bootstrap=99, alpha=1, n_projections=100, batch_size=20,
+                                     random_state=None, print_exec_time=True):
+    """
+    Approximate version of energy_two_sample_test whose cost is linear in the number of vectors 
+    (up to the sorts), such that whole populations can be tested at once instead of averaging 
+    the p-values of subsamples as energy_two_sample_large_dataset. The statistic is approximated 
+    by random projections (see compute_energy_statistic_projected) and the permutations reuse the 
+    same sorted projections, so the permutation test is exact for the approximated statistic.
+
+    Parameters
+    -------------
+    original_X: numpy ndarray
+        d by n1 array matrix representing X_1, ...,X_n1 the random samples of the first population
+    original_Y: numpy ndarray
+        d by n2 array matrix representing Y_1, ...,Y_n2 the random samples of the second population
+    n_bootstrap: int, default 99
+        the number of permutations
+    alpha: int, default 1
+        significance level (in 0-100)
+    n_projections: int, default 100
+        the number of random directions, the error of the statistic decreases as 1/sqrt(n_projections)
+    batch_size: int, default 20
+        the number of permutations evaluated at once (uses n*batch_size floats per direction)
+    random_state: int, optional
+        seed of the directions and of the permutations
+    print_exec_time: boolean, default True
+        can be set to False to not display the execution time
+
+    Returns
+    -------------
+    p_value: float
+    E_distance_observed: float
+        the approximated observed statistic
+    std_error: float
+        the standard error of the approximated observed statistic
+    E_distance_replicates: list(float)
+        the approximated statistic of each permutation
+    """
+    start = timeit.default_timer()
+    assert (alpha <= 100 and alpha >= 0),"Alpha should be expressed as a percentage in [0-100]"
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    d, n1 = original_X.shape
+    n2 = original_Y.shape[1]
+    n = n1 + n2
+    factor = (n1*n2)/(n1+n2)*get_projection_constant(d)
+
+    order, widths = get_sorted_projections(np.concatenate((original_X,original_Y),axis=1).T, n_projections, rng)
+    observed = factor*compute_projected_statistics(order, widths, np.arange(n) < n1)[:,0]
+    E_distance_observed = observed.mean()
+    std_error = observed.std(ddof=1)/np.sqrt(n_projections)
+
+    E_distance_replicates = []
+    while(len(E_distance_replicates) < n_bootstrap):
+        b = min(batch_size, n_bootstrap - len(E_distance_replicates))
+        in_X = get_permutation_indicators(n1, n2, b, rng).astype(bool)
+        E_distance_replicates.extend((factor*compute_projected_statistics(order, widths, in_X).mean(axis=0)).tolist())
+        progress(len(E_distance_replicates), n_bootstrap)
+
+    lim = np.percentile(np.array(E_distance_replicates),100-alpha)
+    p_value = find_p_value(E_distance_replicates,E_distance_observed)
+    end = timeit.default_timer()
+
+    if(p_value < alpha/100):
+        print("We reject the Null hypothesis (CL = {}%): p-value = {}\n\t observed = {} (+/- {}) \t limit = {}".format(100-alpha,p_value,E_distance_observed,std_error,lim))
+    else:
+        print("We cannot reject the Null hypothesis (CL = {}%): p-value = {}\n\t observed = {} (+/- {}) \t limit = {}".format(100-alpha,p_value,E_distance_observed,std_error,lim))
+    if(print_exec_time):
+        print("Execution time: {}s".format(round(end-start,4)))
+    return p_value, E_distance_observed, std_error, E_distance_replicates
+
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing the versioned format in which fitted pipelines are saved to be used in
+    production. An artifact is a folder containing:
+        * manifest.json: the format version, the order of the feature columns, the encoder
+          vocabulary (hardware model indices and one hot encoded columns), the column plan of
+          remove_features and the cutoff probabilities chosen for each precision level
+        * model.joblib: the fitted estimator dumped uncompressed by joblib, such that its numpy
+          arrays (coefficients, scaler statistics, nodes of HistGradientBoosting trees, ...) can be
+          memory mapped when loading: the scoring processes of a host then share the same pages
+          instead of each deserialising its own copy.
+        * trees/*.npy: the nodes of the trees when the final estimator is a RandomForest, an
+          ExtraTrees or a GradientBoosting classifier. The sklearn trees copy their nodes when they
+          are unpickled (so joblib cannot map them), they are thus replaced in model.joblib by a
+          MappedTreeEnsemble that predicts directly from the memory mapped node arrays.
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import os
+import copy
+import json
+import datetime
+import joblib
+import numpy as np
+import scipy.special
+import sklearn.base
+import sklearn.ensemble
+
+from scripts.utils import HW_MODELS_2_ID
+from scripts.preprocessing import get_removed_features
+
+ARTIFACT_VERSION = 2
+MANIFEST_FILE = 'manifest.json'
+MODEL_FILE = 'model.joblib'
+TREES_DIR = 'trees'
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Memory mapped trees---------------------------------
+### --------------------------------------------------------------------------------------------
+class MappedTreeEnsemble(sklearn.base.ClassifierMixin, sklearn.base.BaseEstimator):
+    """
+    Stand-in for a fitted RandomForest, ExtraTrees or GradientBoosting classifier that predicts
+    from the flattened nodes of its trees (see get_tree_arrays), such that the nodes can be memory
+    mapped. All the trees are traversed at once: each (row, tree) pair that has not reached a
+    leaf yet moves one level down per iteration. It is several times slower than the compiled
+    traversal of sklearn but the nodes are shared by all the processes that map the artifact.
+    It can not be refitted: fit raises a TypeError (it only exists because sklearn checks that the
+    last step of a pipeline has one).
+
+    Parameters
+    -------------
+    kind: str
+        'forest' (the probabilities of the leaves are averaged) or 'boosting' (the values of the
+        leaves are added to init_raw and go through the sigmoid or the softmax)
+    classes: numpy ndarray
+        the classes of the original estimator
+    n_features: int
+        the number of input features
+    init_raw: numpy ndarray, optional
+        the initial raw prediction of each class ('boosting' only)
+    block_size: int, default 10000
+        the number of rows traversed at once
+    """
+    def __init__(self, kind, classes, n_features, init_raw = None, block_size = 10000):
+        self.kind = kind
+        self.classes = classes
+        self.n_features = n_features
+        self.init_raw = init_raw
+        self.block_size = block_size
+        self.classes_ = np.asarray(classes)
+        self.n_features_in_ = n_features
+        self.arrays = None
+
+    def __getstate__(self):
+        # the nodes are stored next to the pickle, never inside it
+        state = super(MappedTreeEnsemble, self).__getstate__().copy()
+        state['arrays'] = None
+        return state
+
+    def __sklearn_is_fitted__(self):
+        return True
+
+    def fit(self, x, y):
+        # only defined because sklearn requires it of the last step of a fitted pipeline
+        raise TypeError('A MappedTreeEnsemble only predicts, refit the original estimator instead')
+
+    def set_arrays(self, arrays):
+        """
+        Sets the node arrays (dict name -> numpy ndarray, possibly memory mapped) to predict from
+        """
+        self.arrays = arrays
+
+    def get_leaves(self, x):
+        """
+        Returns the leaf reached by each row in every tree
+
+        Parameters
+        -------------
+        x: numpy ndarray
+            n by n_features inputs (compared in float32 like the sklearn trees)
+
+        Returns
+        -------------
+        leaves: numpy ndarray
+            n by n_trees global node indices
+        """
+        a = self.arrays
+        x = np.asarray(x, dtype = np.float32)
+        n_trees = len(a['roots'])
+        node = np.tile(a['roots'], len(x))
+        row = np.repeat(np.arange(len(x)), n_trees)
+        # only the (row, tree) pairs that are not yet in a leaf are moved down
+        active = np.arange(len(node))
+        while(len(active) != 0):
+            current = node[active]
+            left = a['children_left'][current]
+            internal = left != -1
+            active, current, left = active[internal], current[internal], left[internal]
+            values = x[row[active], a['feature'][current]]
+            go_left = np.where(np.isnan(values), a['missing_go_to_left'][current], values <= a['threshold'][current])
+            node[active] = np.where(go_left, left, a['children_right'][current])
+        return node.reshape(len(x), n_trees)
+
+    def predict_proba(self, x):
+        """
+        Probability of each class for each row, as predict_proba of the original estimator
+
+        Parameters
+        -------------
+        x: numpy ndarray
+
+        Returns
+        -------------
+        proba: numpy ndarray
+            n by n_classes
+        """
+        assert(self.arrays is not None), 'The node arrays must be set before predicting'
+        value = self.arrays['value']
+        proba = np.empty((len(x), len(self.classes_)))
+        for start in range(0, len(x), self.block_size):
+            leaves = self.get_leaves(x[start:start + self.block_size])
+            if(self.kind == 'forest'):
+                proba[start:start + len(leaves)] = value[leaves].mean(axis = 1)
+                continue
+            # each tree of the boosting adds its leaf value to the raw prediction of its class
+            one_hot = np.eye(len(self.init_raw))[self.arrays['tree_class']]
+            raw = self.init_raw + value[leaves][:, :, 0].dot(one_hot)
+            if(raw.shape[1] == 1):
+                p = scipy.special.expit(raw[:, 0])
+                proba[start:start + len(leaves)] = np.column_stack([1 - p, p])
+            else:
+                proba[start:start + len(leaves)] = scipy.special.softmax(raw, axis = 1)
+        return proba
+
+    def predict(self, x):
+        return self.classes_[self.predict_proba(x).argmax(axis = 1)]
+
+def get_tree_arrays(estimator):
+    """
+    Flattens the trees of a fitted RandomForest/ExtraTrees classifier or GradientBoosting
+    classifier (with the log loss and a constant init) into node arrays, the node indices of
+    each tree being offset by the nodes of the previous ones.
+
+    Parameters
+    -------------
+    estimator: sklearn estimator
+
+    Returns
+    -------------
+    mapped: MappedTreeEnsemble or None
+        the stand-in of the estimator (without its arrays), None if it is not supported
+    arrays: dict(str -> numpy ndarray) or None
+        the node arrays: feature, threshold, children_left, children_right, missing_go_to_left,
+        value (per node probabilities or leaf values), roots and tree_class of each tree
+    """
+    if(isinstance(estimator, (sklearn.ensemble.RandomForestClassifier, sklearn.ensemble.ExtraTreesClassifier))
+       and getattr(estimator, 'n_outputs_', 1) == 1):
+        trees = [e.tree_ for e in estimator.estimators_]
+        tree_class = np.zeros(len(trees), dtype = np.int64)
+        values = [t.value[:, 0, :]/np.maximum(t.value[:, 0, :].sum(axis = 1, keepdims = True), 1e-300) for t in trees]
+        mapped = MappedTreeEnsemble('forest', estimator.classes_, estimator.n_features_in_)
+    elif(isinstance(estimator, sklearn.ensemble.GradientBoostingClassifier) and estimator.loss == 'log_loss'
+         and (estimator.init_ == 'zero' or type(estimator.init_).__name__ == 'DummyClassifier')):
+        n_classes = estimator.estimators_.shape[1]
+        trees = [e.tree_ for e in estimator.estimators_.ravel()]
+        tree_class = np.tile(np.arange(n_classes), estimator.estimators_.shape[0])
+        values = [estimator.learning_rate*t.value[:, 0, :1] for t in trees]
+        init_raw = estimator._raw_predict_init(np.zeros((1, estimator.n_features_in_)))[0]
+        mapped = MappedTreeEnsemble('boosting', estimator.classes_, estimator.n_features_in_, init_raw = init_raw)
+    else:
+        return None, None
+
+    offsets = np.cumsum([0] + [t.node_count for t in trees])
+    def children(name):
+        return np.concatenate([np.where(getattr(t, name) == -1, -1, getattr(t, name) + o) for t,o in zip(trees, offsets)]).astype(np.int64)
+    arrays = {'feature': np.concatenate([t.feature for t in trees]).astype(np.int64),
+              'threshold': np.concatenate([t.threshold for t in trees]).astype(np.float64),
+              'children_left': children('children_left'),
+              'children_right': children('children_right'),
+              'missing_go_to_left': np.concatenate([t.missing_go_to_left for t in trees]).astype(bool),
+              'value': np.concatenate(values).astype(np.float64),
+              'roots': offsets[:-1].astype(np.int64),
+              'tree_class': tree_class}
+    return mapped, arrays
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Artifacts-------------------------------------------
+### --------------------------------------------------------------------------------------------
+
+def save_model_artifact(path, model, feature_columns, precision_thresholds = None, hw_models_2_id = None,
+                        categorical_cols = ['hardware_model','weekday'], prefixes = ["model","wk"],
+                        removed_features = None, description = '', map_trees = True):
+    """
+    Saves a fitted pipeline and everything needed to score raw vectors with it as an artifact folder.
+
+    Parameters
+    -------------
+    path: str
+        the folder of the artifact (it will be created if needed)
+    model: sklearn pipeline or model on which we can call predict_proba()
+        the fitted pipeline
+    feature_columns: list(str)
+        the columns of the feature vectors the model was trained on, in the training order
+    precision_thresholds: dict(float -> float), optional
+        the cutoff probability chosen for each precision level (e.g. the thresholds
+        returned by recalls_for_prec_list)
+    hw_models_2_id: dict(str -> int), optional
+        the hardware model indices used during training (HW_MODELS_2_ID if not set)
+    categorical_cols: list(str), default ['hardware_model','weekday']
+        the columns one hot encoded by encode_categorical
+    prefixes: list(str), default ["model","wk"]
+        the prefixes of the dummy columns of each categorical column
+    removed_features: list(str), optional
+        the column plan of remove_features (get_removed_features() if not set)
+    description: str, optional
+        free text describing the model (e.g. the training sample and parameters)
+    map_trees: boolean, default True
+        whether the trees of a RandomForest, ExtraTrees or GradientBoosting final estimator are
+        saved as node arrays (shared between processes but slower to predict from, see
+        MappedTreeEnsemble) rather than pickled with the estimator (copied by every process)
+
+    Returns
+    -------------
+    manifest: dict
+        the content of the manifest that was written
+    """
+    os.makedirs(path, exist_ok = True)
+    # the trees of the final estimator are saved as node arrays, the caller's model is not modified
+    final = model.steps[-1][1] if hasattr(model, 'steps') else model
+    mapped, arrays = get_tree_arrays(final) if map_trees else (None, None)
+    dumped = model
+    if(mapped is not None):
+        os.makedirs(os.path.join(path, TREES_DIR), exist_ok = True)
+        for name,array in arrays.items():
+            np.save(os.path.join(path, TREES_DIR, name + '.npy'), array)
+        if(hasattr(model, 'steps')):
+            dumped = copy.copy(model)
+            dumped.steps = list(model.steps[:-1]) + [(model.steps[-1][0], mapped)]
+        else:
+            dumped = mapped
+    # no compression such that the arrays can be memory mapped when loading
+    joblib.dump(dumped, os.path.join(path, MODEL_FILE), compress = 0)
+
+    thresholds = {} if precision_thresholds is None else precision_thresholds
+    manifest = {'version': ARTIFACT_VERSION,
+                'created': datetime.datetime.now().isoformat(),
+                'description': description,
+                'model_class': type(model).__name__,
+                'tree_arrays': None if arrays is None else sorted(arrays),
+                'feature_columns': list(feature_columns),
+                'hw_models_2_id': hw_models_2_id if hw_models_2_id else HW_MODELS_2_ID,
+                'categorical_cols': list(categorical_cols),
+                'prefixes': list(prefixes),
+                'removed_features': list(removed_features) if removed_features is not None else get_removed_features(),
+                'precision_thresholds': {str(float(p)): float(t) for p,t in thresholds.items()}}
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as handle:
+        json.dump(manifest, handle, indent = 2)
+    return manifest
+
+class ModelArtifact(object):
+    """
+    A saved artifact: the manifest is read when it is opened but the estimator is only loaded
+    (memory mapped, along with the node arrays of its trees) the first time it is accessed
+    through model.
+
+    Parameters
+    -------------
+    path: str
+        the folder of the artifact
+    mmap: boolean, default True
+        can be set to False to load the arrays of the estimator in memory instead of mapping them
+    """
+    def __init__(self, path, mmap = True):
+        self.path = path
+        self.mmap = mmap
+        self._model = None
+        with open(os.path.join(path, MANIFEST_FILE)) as handle:
+            self.manifest = json.load(handle)
+        assert(self.manifest['version'] <= ARTIFACT_VERSION), \
+            'The artifact has version {} but only versions up to {} are supported'.format(self.manifest['version'], ARTIFACT_VERSION)
+
+    @property
+    def model(self):
+        if(self._model is None):
+            mmap_mode = 'r' if self.mmap else None
+            self._model = joblib.load(os.path.join(self.path, MODEL_FILE), mmap_mode = mmap_mode)
+            if(self.manifest.get('tree_arrays')):
+                final = self._model.steps[-1][1] if hasattr(self._model, 'steps') else self._model
+                final.set_arrays({name: np.load(os.path.join(self.path, TREES_DIR, name + '.npy'), mmap_mode = mmap_mode)
+                                  for name in self.manifest['tree_arrays']})
+        return self._model
+
+    @property
+    def feature_columns(self):
+        return self.manifest['feature_columns']
+
+    @property
+    def hw_models_2_id(self):
+        return self.manifest['hw_models_2_id']
+
+    @property
+    def removed_features(self):
+        return self.manifest['removed_features']
+
+    @property
+    def precision_thresholds(self):
+        return {float(p): t for p,t in self.manifest['precision_thresholds'].items()}
+
+    def get_threshold(self, precision):
+        """
+        Returns the cutoff probability chosen for a given precision level
+
+        Parameters
+        -------------
+        precision: float
+            the precision level (as in the thresholds passed to save_model_artifact)
+
+        Returns
+        -------------
+        thr: float
+        """
+        return self.precision_thresholds[float(precision)]
+
+def load_model_artifact(path, mmap = True):
+    """
+    Opens an artifact saved by save_model_artifact (the estimator is loaded lazily)
+
+    Parameters
+    -------------
+    path: str
+        the folder of the artifact
+    mmap: boolean, default True
+        can be set to False to load the arrays of the estimator in memory instead of mapping them
+
+    Returns
+    -------------
+    artifact: ModelArtifact
+    """
+    return ModelArtifact(path, mmap)
+
+def is_model_artifact(path):
+    """
+    Returns whether path is the folder of a model artifact
+
+    Parameters
+    -------------
+    path: str
+
+    Returns
+    -------------
+    b: boolean
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
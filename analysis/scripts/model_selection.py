@@ -8,15 +8,21 @@ __author__ = "Hugo Moreau"
 __email__ = "hugo.moreau@epfl.ch"
 __status__ = "Prototype"
 
+import os
+import math
+import hashlib
 import numpy as np
-import sklearn
+import pandas as pd
+import sklearn.base
+import sklearn.metrics
+import sklearn.model_selection
 import itertools
+import timeit
+from joblib import Parallel, delayed
 
-from scripts.preprocessing import *
-from scripts.model_selection import *
-from scripts.plot import *
+import scripts.utils
 
-def get_cross_validated_metrics(clf,top_ratio,x,y,dates=None,dates_fold=False,cv=5):
+def get_cross_validated_metrics(clf,top_ratio,x,y,dates=None,dates_fold=False,cv=5,splits=None,cache_dir=None,preproc_config=None):
     """
     Computes cross validated classification metrics on the top_ratio prediction
 
@@ -36,26 +42,28 @@ def get_cross_validated_metrics(clf,top_ratio,x,y,dates=None,dates_fold=False,cv
         can be set to True if we wish to use a split with distinct dates in each fold
     cv: int, default 5
         number of folds to use to cross validate
+    splits: list, optional
+        a list of pair train-test indices, if set it is used instead of building new folds
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    preproc_config: optional
+        description of the preprocessing that produced x, used to key the cache
 
     Returns
     -------------
     metrics: numpy array
         cross validated Precision, Recall and F1 score.
     """
-    if(dates_fold):
-        splits = distinct_date_split(x,y,dates,k=cv)
-    else:
-        kf = sklearn.model_selection.KFold(n_splits=cv)
-        splits = kf.split(x)
-    metrics = np.zeros((cv,3))
-    for i,indices in enumerate(splits):
-        train_index,test_index = indices
-        x_train, x_test,y_train, y_test = x[train_index], x[test_index], y[train_index], y[test_index]
-        
-        clf.fit(x_train,y_train)
-        y_sick_scores = clf.predict_proba(x_test)[:,1]
-        m = get_metrics(y_sick_scores,y_test,top_ratio) 
-        metrics[i,:] = m
+    if(splits is None):
+        if(dates_fold):
+            splits = distinct_date_split(x,y,dates,k=cv)
+        else:
+            kf = sklearn.model_selection.KFold(n_splits=cv)
+            splits = list(kf.split(x))
+    predictions = get_oof_predictions(clf,x,y,splits,cache_dir,preproc_config)
+    metrics = np.zeros((len(predictions),3))
+    for i,(test_index,y_sick_scores) in enumerate(predictions):
+        metrics[i,:] = get_metrics(y_sick_scores,y[test_index],top_ratio)
     return np.mean(metrics,axis = 0)
 
 def get_metrics(y_sick_scores,y_test,top_ratio):
@@ -95,7 +103,7 @@ def get_metrics(y_sick_scores,y_test,top_ratio):
     F1 = 100*sklearn.metrics.f1_score(y_true,y_pred)
     return P,R,F1
 
-def distinct_date_split(x,y,dates,k = 5, balanced = True, shuffle = True):
+def distinct_date_split(x,y,dates,k = 5, balanced = True, shuffle = True, random_state = None):
     """
     Provides a list of k-tuples of train and test indices such that the folds all contain distinct dates.
     
@@ -111,17 +119,21 @@ def distinct_date_split(x,y,dates,k = 5, balanced = True, shuffle = True):
         should be set to True if we want the training set to have balanced classes
     shuffle : boolean, default True
         should be set to True if we want the train and test indices to be shuffled
+    random_state : int, optional
+        seed of the folds, setting it makes the splits (and therefore the 
+        out-of-fold prediction cache keys) reproducible
 
     Returns
     -------------
     splits: list 
         a list of pair train-test indices
     """
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
     dates = pd.Series(dates)
     distinct_days = dates.unique()
     # We shuffle the days for some randomness in our folds
     if(shuffle):
-        np.random.shuffle(distinct_days)
+        rng.shuffle(distinct_days)
 
     day_2_fold = {key: value%k for (value, key) in list(enumerate(distinct_days))} 
     folds = dates.map(day_2_fold).values
@@ -141,19 +153,61 @@ def distinct_date_split(x,y,dates,k = 5, balanced = True, shuffle = True):
             healthy_i_in_train = np.intersect1d(healthy_i_in_dataset,train_index)
             sick_i_in_train = np.intersect1d(sick_i_in_dataset,train_index)
 
-            sampled_healthy_i = np.random.choice(healthy_i_in_train, size=len(sick_i_in_train), replace = False)
+            sampled_healthy_i = rng.choice(healthy_i_in_train, size=len(sick_i_in_train), replace = False)
             balanced_train_index = np.union1d(sick_i_in_train,sampled_healthy_i)
             
             train_index = balanced_train_index
         if(shuffle):
             # so that they are shuffled
-            train_index = np.random.permutation(train_index)
-            test_index = np.random.permutation(test_index)
+            train_index = rng.permutation(train_index)
+            test_index = rng.permutation(test_index)
 
         splits.append((train_index,test_index))
     return splits
 
-def analyse_clustering(y,clusters):
+def confusion_counts(y,labelings,codes=None,classes=None):
+    """
+    Counts with a single np.bincount the vectors of each (predicted label or cluster, true label) 
+    pair for many predictions or clusterings of the same vectors at once (e.g. every k of a sweep 
+    or every fold).
+
+    Parameters
+    -------------
+    y: numpy ndarray
+        true labels
+    labelings: numpy ndarray or list(numpy ndarray)
+        the predicted labels or cluster labels (one array, or L arrays of the same length than y)
+    codes: numpy ndarray, optional
+        the sorted values the labelings can take (their distinct values by default)
+    classes: numpy ndarray, optional
+        the sorted values y can take (its distinct values by default)
+
+    Returns
+    -------------
+    counts: numpy ndarray
+        L by C by K array, counts[l,c,k] is the number of vectors with label (or cluster) codes[c] in 
+        the labelling l and true label classes[k] (C by K if a single array was given)
+    codes: numpy ndarray
+        the sorted distinct predicted labels (or clusters)
+    classes: numpy ndarray
+        the sorted distinct true labels
+    """
+    labelings = np.asarray(labelings)
+    single = (labelings.ndim == 1)
+    labelings = np.atleast_2d(labelings)
+    classes = np.unique(y) if classes is None else classes
+    codes = np.unique(labelings) if codes is None else codes
+    y_codes = np.searchsorted(classes, y)
+    label_codes = np.searchsorted(codes, labelings)
+
+    L, C, K = labelings.shape[0], len(codes), len(classes)
+    flat = (np.arange(L)[:,np.newaxis]*C + label_codes)*K + y_codes
+    counts = np.bincount(flat.ravel(), minlength=L*C*K).reshape(L, C, K)
+    if(single):
+        counts = counts[0]
+    return counts, codes, classes
+
+def analyse_clustering(y,clusters,verbose=True):
     """
     Given true labels and cluster predictions the function displays the details of the repartition 
     of the different classes inside the binary clusters and therefore tries to compute a precision 
@@ -165,6 +219,8 @@ def analyse_clustering(y,clusters):
         true labels
     clusters: numpy ndarray
         corresponding cluster labels
+    verbose: boolean, default True
+        can be set to False to not print the precision and recall
 
     Returns
     -------------
@@ -172,43 +228,105 @@ def analyse_clustering(y,clusters):
         containing all the details of the clustering analysis
 
     """
-    analysis_df = pd.DataFrame(np.hstack((y.reshape(-1,1),clusters.reshape(-1,1))),columns=['Labels','Cluster'])
-    analysis_df['Counts'] = 1
-    synthesis = analysis_df.groupby(['Cluster','Labels']).sum()
-    cluster_counts = analysis_df.groupby(['Cluster']).sum()[['Counts']]
-    cluster_counts.columns = ['Cluster_counts']
-    label_counts = analysis_df.groupby(['Labels']).sum()[['Counts']]
-    label_counts.columns = ['Label_counts']
+    counts, codes, classes = confusion_counts(y,clusters)
+    return clustering_table(counts,codes,classes,verbose)
+
+def analyse_clusterings(y,clusterings,names=None,verbose=False):
+    """
+    Same as analyse_clustering for many binary clusterings of the same vectors, 
+    counted in a single call of confusion_counts
+
+    Parameters
+    -------------
+    y: numpy ndarray
+        true labels
+    clusterings: list(numpy ndarray)
+        the cluster labels of each clustering
+    names: list, optional
+        the name of each clustering (their index by default)
+    verbose: boolean, default False
+        can be set to True to print the precision and recall of each clustering
+
+    Returns
+    -------------
+    df: pandas Dataframe
+        the tables of analyse_clustering indexed by the name of the clustering
+    """
+    counts, codes, classes = confusion_counts(y,clusterings)
+    names = list(range(len(counts))) if names is None else names
+    return pd.concat([clustering_table(c,codes,classes,verbose) for c in counts], keys=names, names=['Clustering'])
 
-    merged = synthesis.merge(cluster_counts, left_index=True, right_index=True).merge(label_counts, left_index=True, right_index=True)
+def clustering_table(counts,codes,classes,verbose=True):
+    """
+    Builds the table of analyse_clustering from the counts of a binary clustering
 
-    merged['Cluster proportion'] = 100*merged['Counts']/merged['Cluster_counts']
-    merged['Label proportion'] = 100*merged['Counts']/merged['Label_counts']
+    Parameters
+    -------------
+    counts: numpy ndarray
+        2 by 2 array of the counts of each (cluster, true label) pair (see confusion_counts)
+    codes: numpy ndarray
+        the two cluster labels
+    classes: numpy ndarray
+        the two true labels (healthy first)
+    verbose: boolean, default True
+        can be set to False to not print the precision and recall
 
+    Returns
+    -------------
+    df: pandas Dataframe
+    """
     # Then we determine the healthy and sick cluster
-    cluster_0_ratio_sick = np.sum(y[clusters == 0])/len(y[clusters == 0])
-    cluster_1_ratio_sick = np.sum(y[clusters == 1])/len(y[clusters == 1])
-    
-    healthy_cluster = 0 if(cluster_1_ratio_sick > cluster_0_ratio_sick) else 1
+    ratio_sick = counts[:,1]/counts.sum(axis=1)
+    healthy_cluster = 0 if(ratio_sick[1] > ratio_sick[0]) else 1
     sick_cluster = 1^healthy_cluster
-    merged = merged.reset_index()
-    merged['Cluster'] = merged['Cluster'].map({healthy_cluster:'healthy',sick_cluster:'sick'})
-    merged = merged.set_index(['Cluster','Labels'])
-    merged['Desc'] = ''
-    merged.set_value(('healthy',0.0),'Desc','True negatives')
-    merged.set_value(('healthy',1.0),'Desc','False negatives')
-    merged.set_value(('sick',0.0),'Desc','False positives')
-    merged.set_value(('sick',1.0),'Desc','True positives')
-
-    tp = merged.query("Desc == 'True positives'")['Counts'].values[0]
-    fn = merged.query("Desc == 'False negatives'")['Counts'].values[0]
-    fp = merged.query("Desc == 'False positives'")['Counts'].values[0]
+    names = {healthy_cluster:'healthy',sick_cluster:'sick'}
+    descs = {('healthy',0):'True negatives',('healthy',1):'False negatives',('sick',0):'False positives',('sick',1):'True positives'}
+
+    cluster_counts = counts.sum(axis=1)
+    label_counts = counts.sum(axis=0)
+    rows = []
+    for c in range(counts.shape[0]):
+        for k in range(counts.shape[1]):
+            rows.append({'Cluster': names[c], 'Labels': float(classes[k]), 'Desc': descs[(names[c],k)],
+                         'Counts': counts[c,k],
+                         'Label proportion': 100*counts[c,k]/label_counts[k],
+                         'Cluster proportion': 100*counts[c,k]/cluster_counts[c]})
+    merged = pd.DataFrame(rows).set_index(['Cluster','Labels'])
+
+    tp = counts[sick_cluster,1]
+    fn = counts[healthy_cluster,1]
+    fp = counts[sick_cluster,0]
 
     precision = round(100*tp/(tp+fp),3)
     recall = round(100*tp/(tp+fn),3)
-    print('Precision = {}%\tRecall = {}%'.format(precision,recall))
+    if(verbose):
+        print('Precision = {}%\tRecall = {}%'.format(precision,recall))
     return merged[['Desc','Counts','Label proportion','Cluster proportion']]
 
+def prediction_metrics(counts):
+    """
+    Computes the precision, recall, F1 score and support of each class from the counts 
+    of confusion_counts (as precision_recall_fscore_support, 0 when undefined)
+
+    Parameters
+    -------------
+    counts: numpy ndarray
+        (L by) C by C array of counts of each (predicted label, true label) pair
+
+    Returns
+    -------------
+    precision, recall, f1, support: numpy ndarray
+        (L by) C arrays
+    """
+    tp = np.diagonal(counts, axis1=-2, axis2=-1).astype(np.float64)
+    predicted = counts.sum(axis=-1)
+    support = counts.sum(axis=-2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = np.where(predicted > 0, tp/predicted, 0)
+        recall = np.where(support > 0, tp/support, 0)
+        f1 = np.where(precision + recall > 0, 2*precision*recall/(precision + recall), 0)
+    return precision, recall, f1, support
+
 def analyse_prediction(y,preds):
     """
     Computes a dataframe givign the different emtrics of a binary classification 
@@ -226,13 +344,38 @@ def analyse_prediction(y,preds):
     df: pandas Dataframe
         containing all the details of the prediction analysis
     """
-    precision, recall, f1, support = sklearn.metrics.precision_recall_fscore_support(y, preds)
-    df = pd.DataFrame()
-    df['Precision'] = precision
-    df['Recall']=recall
-    df['F1 score']=f1
+    return analyse_predictions(y,[preds]).loc[0]
+
+def analyse_predictions(y,preds_list,names=None):
+    """
+    Same as analyse_prediction for many predictions of the same vectors (e.g. every 
+    fold or every threshold), counted in a single call of confusion_counts
+
+    Parameters
+    -------------
+    y: numpy ndarray
+        true labels
+    preds_list: list(numpy ndarray)
+        the predicted labels of each prediction
+    names: list, optional
+        the name of each prediction (their index by default)
+
+    Returns
+    -------------
+    df: pandas Dataframe
+        the tables of analyse_prediction indexed by the name of the prediction and the class
+    """
+    # the predictions and the labels are counted over the same classes
+    classes = np.unique(np.concatenate((np.unique(y),np.unique(preds_list))))
+    counts, _, _ = confusion_counts(y, np.atleast_2d(preds_list), classes, classes)
+    L, C = counts.shape[0], len(classes)
+
+    precision, recall, f1, support = prediction_metrics(counts)
+    names = list(range(L)) if names is None else names
+    df = pd.DataFrame({'Precision': precision.ravel(), 'Recall': recall.ravel(), 'F1 score': f1.ravel()},
+                      index=pd.MultiIndex.from_product([names, range(C)]))
     df = df.apply(lambda x: round(100*x,3))
-    df['Support']= support
+    df['Support'] = support.ravel()
     return df
 
 def get_recall_for_precision(y_test,y_proba_sick,prec_thresh):
@@ -325,15 +468,31 @@ def partial_auc(x_train, x_test,y_train, y_test,clf,min_precision=0.7):
     """
     clf.fit(x_train,y_train)
     y_proba_sick = clf.predict_proba(x_test)[:,1]
+    return auc_from_scores(y_test,y_proba_sick,min_precision)
+
+def auc_from_scores(y_test,y_proba_sick,min_precision=0.7):
+    """
+    Same estimate as partial_auc but computed from already available predictions 
+    (e.g. the ones served by get_oof_predictions), so that no model is refitted.
+
+    Parameters
+    -------------
+    y_test: numpy ndarray
+        true labels
+    y_proba_sick: numpy ndarray
+        probability of each sample to be sick
+    min_precision: float, default 0.7
+        the minimum precision up to where we compute the area
+
+    Returns
+    -------------
+    auc: float
+        the area under the curve
+    """
     precision, recall, _ = sklearn.metrics.precision_recall_curve(y_test, y_proba_sick)
-    
-    p_index = np.where(precision>0.7)
-    p_precision = precision[p_index]
-    p_recall = recall[p_index]
-    sklearn.metrics.auc(p_recall,p_precision)
     return sklearn.metrics.auc(recall,precision)
 
-def cross_validate_auc(x,y,clf,splits,min_precision=0.7):
+def cross_validate_auc(x,y,clf,splits,min_precision=0.7,cache_dir=None,preproc_config=None):
     """
     Returns an unbiased estimate of the partial auc by cross validating 
     it over the different splits
@@ -350,6 +509,10 @@ def cross_validate_auc(x,y,clf,splits,min_precision=0.7):
         a list of pair train-test indices
     min_precision: float, default 0.7
         the minimum precision up to where we compute the area
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    preproc_config: optional
+        description of the preprocessing that produced x, used to key the cache
 
     Returns
     -------------
@@ -359,12 +522,99 @@ def cross_validate_auc(x,y,clf,splits,min_precision=0.7):
         the std pAUC
     """
     auc = []
-    for i,(train_index,test_index) in enumerate(splits):
-        x_train, x_test,y_train, y_test = x[train_index], x[test_index], y[train_index], y[test_index]
-        auc.append(partial_auc(x_train, x_test,y_train, y_test,clf))
+    for test_index,y_proba_sick in get_oof_predictions(clf,x,y,splits,cache_dir,preproc_config):
+        auc.append(auc_from_scores(y[test_index],y_proba_sick,min_precision))
     return np.mean(auc),np.std(auc)
 
-def custom_GridSearchCV(x,y,dates,estimator,param_grid,cv=5,min_precision=0.7):
+def cross_validated_roc(clf,x,y,splits,top_ratio=0.15,cache_dir=None,preproc_config=None):
+    """
+    Computes the data behind a cross validated ROC curve: the curve of each fold, the mean 
+    curve (interpolated on a regular grid of false positive rates) and the top_ratio metrics.
+
+    Parameters
+    -------------
+    clf: sklearn pipeline or any model we can call fit() and predict_proba() on
+        the classifier
+    x,y: numpy ndarrays
+        ML ready data
+    splits: list
+        a list of pair train-test indices
+    top_ratio: float, default 0.15
+        the ratio of top predictions on which get_metrics is computed
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    preproc_config: optional
+        description of the preprocessing that produced x, used to key the cache
+
+    Returns
+    -------------
+    roc: dict
+        'folds' (list of (fpr,tpr,auc) for each fold), 'mean_fpr', 'mean_tpr', 'std_tpr', 
+        'mean_auc', 'std_auc' and 'metrics' (the mean Precision, Recall and F1 on the top_ratio)
+    """
+    mean_fpr = np.linspace(0, 1, 100)
+    folds = []
+    tprs = []
+    metrics = []
+    for test_index,y_proba_sick in get_oof_predictions(clf,x,y,splits,cache_dir,preproc_config):
+        fpr, tpr, _ = sklearn.metrics.roc_curve(y[test_index], y_proba_sick)
+        folds.append((fpr,tpr,sklearn.metrics.auc(fpr, tpr)))
+        tprs.append(np.interp(mean_fpr, fpr, tpr))
+        tprs[-1][0] = 0.0
+        metrics.append(get_metrics(y_proba_sick,y[test_index],top_ratio))
+
+    mean_tpr = np.mean(tprs, axis=0)
+    mean_tpr[-1] = 1.0
+    return {'folds':folds,'mean_fpr':mean_fpr,'mean_tpr':mean_tpr,'std_tpr':np.std(tprs, axis=0),
+            'mean_auc':sklearn.metrics.auc(mean_fpr, mean_tpr),'std_auc':np.std([f[2] for f in folds]),
+            'metrics':np.mean(metrics,axis = 0)}
+
+def cross_validated_precision_recall(clf,x,y,splits,prec_thresh_list=[0.7,0.8,0.9],cache_dir=None,preproc_config=None):
+    """
+    Computes the data behind a cross validated precision recall curve: the curve of each fold, 
+    the max recall (and its cutoff) for each precision level on each fold and the overall curve 
+    obtained by pooling the predictions of all the folds.
+
+    Parameters
+    -------------
+    clf: sklearn pipeline or any model we can call fit() and predict_proba() on
+        the classifier
+    x,y: numpy ndarrays
+        ML ready data
+    splits: list
+        a list of pair train-test indices
+    prec_thresh_list: list(float), default [0.7,0.8,0.9]
+        the precision levels that we wish to compute the max recall for
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    preproc_config: optional
+        description of the preprocessing that produced x, used to key the cache
+
+    Returns
+    -------------
+    pr: dict
+        'folds' (list of (precision,recall,auc) for each fold), 'recall_levels' and 'thresholds' 
+        (arrays of shape (n_folds,len(prec_thresh_list))), the overall 'precision', 'recall' 
+        and 'overall_auc'
+    """
+    predictions = get_oof_predictions(clf,x,y,splits,cache_dir,preproc_config)
+    folds = []
+    recall_levels = np.zeros((len(predictions),len(prec_thresh_list)))
+    threshs = np.zeros((len(predictions),len(prec_thresh_list)))
+    for i,(test_index,y_proba_sick) in enumerate(predictions):
+        y_test = y[test_index]
+        precision, recall, _ = sklearn.metrics.precision_recall_curve(y_test, y_proba_sick)
+        folds.append((precision,recall,sklearn.metrics.auc(recall,precision)))
+        recall_levels[i,:],threshs[i,:] = recalls_for_prec_list(y_test,y_proba_sick,prec_thresh_list)
+
+    # compute the overall
+    y_real = np.concatenate([y[test_index] for test_index,_ in predictions])
+    y_scores = np.concatenate([y_proba_sick for _,y_proba_sick in predictions])
+    precision, recall, _ = sklearn.metrics.precision_recall_curve(y_real, y_scores)
+    return {'folds':folds,'recall_levels':recall_levels,'thresholds':threshs,
+            'precision':precision,'recall':recall,'overall_auc':sklearn.metrics.auc(recall,precision)}
+
+def custom_GridSearchCV(x,y,dates,estimator,param_grid,cv=5,min_precision=0.7,cache_dir=None,preproc_config=None,random_state=None):
     """
     Performs a grid search of optimal parameters by trying each possible combination of proposed parameters and 
     performing a cross validation on the partial AUC for each combination
@@ -386,6 +636,12 @@ def custom_GridSearchCV(x,y,dates,estimator,param_grid,cv=5,min_precision=0.7):
         number of folds to use to cross validate
     min_precision: float, default 0.7
         the minimum precision up to where we compute the area
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    preproc_config: optional
+        description of the preprocessing that produced x, used to key the cache
+    random_state: int, optional
+        seed of the date splits, must be set for cached predictions to be reused across calls
 
     Returns
     -------------
@@ -397,7 +653,7 @@ def custom_GridSearchCV(x,y,dates,estimator,param_grid,cv=5,min_precision=0.7):
     items = sorted(param_grid.items())
     keys, values = zip(*items)
     
-    splits = distinct_date_split(x,y,dates,cv)
+    splits = distinct_date_split(x,y,dates,cv,random_state=random_state)
     best = {'best_auc':0,'best_args':None}
     best_auc = 0
     best_args = None
@@ -410,7 +666,7 @@ def custom_GridSearchCV(x,y,dates,estimator,param_grid,cv=5,min_precision=0.7):
     for i,v in enumerate(param_combinations):
         kw_args = dict(zip(keys, v))
         clf = estimator(kw_args)
-        mean_auc,std_auc = cross_validate_auc(x,y,clf,splits)
+        mean_auc,std_auc = cross_validate_auc(x,y,clf,splits,min_precision,cache_dir,preproc_config)
         if(mean_auc > best['best_auc']):
             best['best_auc'] = mean_auc
             best['best_args'] = kw_args
@@ -418,4 +674,547 @@ def custom_GridSearchCV(x,y,dates,estimator,param_grid,cv=5,min_precision=0.7):
         results[str(kw_args)] = ({'mean_auc':mean_auc,'std_auc':std_auc})
         scripts.utils.progress(i+1, n_iteration, suffix='Trying different combinations')
     return {'results':results,'best':best}
-    
\ No newline at end of file
+    
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Out-of-fold prediction cache------------------------
+### --------------------------------------------------------------------------------------------
+def get_split_hash(splits):
+    """
+    Computes a hash identifying a list of train-test splits (the order of the folds 
+    and of the indices inside each fold matter).
+
+    Parameters
+    -------------
+    splits: list
+        a list of pair train-test indices
+
+    Returns
+    -------------
+    h: str
+        hexadecimal digest of the splits
+    """
+    h = hashlib.sha1()
+    for train_index,test_index in splits:
+        h.update(np.asarray(train_index,dtype=np.int64).tobytes())
+        h.update(b'|')
+        h.update(np.asarray(test_index,dtype=np.int64).tobytes())
+        h.update(b'#')
+    return h.hexdigest()
+
+def get_pipeline_hash(clf):
+    """
+    Computes a hash of the (deep) parameters of a sklearn pipeline or model, such that 
+    two identically configured pipelines share the same hash.
+
+    Parameters
+    -------------
+    clf: sklearn pipeline or model on which we can call get_params()
+        the classifier
+
+    Returns
+    -------------
+    h: str
+        hexadecimal digest of the parameters
+    """
+    desc = [type(clf).__name__]
+    for k,v in sorted(clf.get_params(deep=True).items()):
+        # nested estimators are described by their own parameters that are also in the deep dict
+        desc.append('{}={}'.format(k,type(v).__name__ if hasattr(v,'get_params') else repr(v)))
+    return hashlib.sha1('\n'.join(desc).encode('utf-8')).hexdigest()
+
+def get_data_fingerprint(x,y,block_size=10000):
+    """
+    Computes a fingerprint of the ML data: its shape, dtype, the full targets and every 
+    value of the inputs. The inputs are hashed by blocks of rows so that a memory-mapped 
+    x is never copied as a whole.
+
+    Parameters
+    -------------
+    x: numpy ndarray
+        ML inputs
+    y: numpy ndarray
+        ML targets
+    block_size: int, default 10000
+        the number of rows of x that are hashed at once
+
+    Returns
+    -------------
+    h: str
+        hexadecimal digest of the data
+    """
+    h = hashlib.sha1('{}|{}'.format(x.shape,x.dtype).encode('utf-8'))
+    h.update(np.ascontiguousarray(y).tobytes())
+    for start in range(0,len(x),block_size):
+        h.update(memoryview(np.ascontiguousarray(x[start:start + block_size])))
+    return h.hexdigest()
+
+def get_oof_key(clf,x,y,splits,preproc_config=None):
+    """
+    Returns the key under which the out-of-fold predictions of a model are stored, 
+    it combines the pipeline parameters, the preprocessing configuration (along with 
+    a fingerprint of the data) and the hash of the splits.
+
+    Parameters
+    -------------
+    clf: sklearn pipeline or model on which we can call get_params()
+        the classifier
+    x,y: numpy ndarrays
+        ML ready data
+    splits: list
+        a list of pair train-test indices
+    preproc_config: optional
+        any object whose repr describes the preprocessing that produced x 
+        (e.g. the date string of the sample and the dropped features)
+
+    Returns
+    -------------
+    key: str
+    """
+    h = hashlib.sha1()
+    h.update(get_pipeline_hash(clf).encode('utf-8'))
+    h.update(repr(preproc_config).encode('utf-8'))
+    h.update(get_data_fingerprint(x,y).encode('utf-8'))
+    h.update(get_split_hash(splits).encode('utf-8'))
+    return h.hexdigest()
+
+def get_oof_predictions(clf,x,y,splits,cache_dir=None,preproc_config=None):
+    """
+    Returns the out-of-fold predictions of a model: for each split the model is fitted on the 
+    training indices and predict_proba is called on the testing ones. If cache_dir is set, the 
+    predictions of each fold are stored on disk and served from there the next time the same 
+    pipeline is evaluated on the same data and splits, so that plotting the same predictions 
+    differently or computing a new metric does not require to retrain the model.
+
+    Parameters
+    -------------
+    clf: sklearn pipeline or model on which we can call fit() and predict_proba()
+        the classifier
+    x,y: numpy ndarrays
+        ML ready data
+    splits: list
+        a list of pair train-test indices
+    cache_dir: str, optional
+        the folder where the predictions are stored (it will be created if needed), 
+        if not set nothing is persisted
+    preproc_config: optional
+        description of the preprocessing that produced x (see get_oof_key)
+
+    Returns
+    -------------
+    predictions: list((numpy ndarray,numpy ndarray))
+        for each fold, the testing indices and the probability of each of them to be sick
+    """
+    splits = list(splits)
+    fold_dir = None
+    if(cache_dir is not None):
+        fold_dir = os.path.join(cache_dir,get_oof_key(clf,x,y,splits,preproc_config))
+        os.makedirs(fold_dir,exist_ok=True)
+
+    predictions = []
+    for i,(train_index,test_index) in enumerate(splits):
+        fold_path = None if fold_dir is None else os.path.join(fold_dir,'fold_{:d}.npy'.format(i))
+        if(fold_path is not None and os.path.isfile(fold_path)):
+            y_proba_sick = np.load(fold_path)
+        else:
+            clf.fit(x[train_index],y[train_index])
+            y_proba_sick = clf.predict_proba(x[test_index])[:,1]
+            if(fold_path is not None):
+                # written under another name first such that a concurrent reader never sees a partial fold
+                tmp_path = fold_path + '.{}.tmp.npy'.format(os.getpid())
+                np.save(tmp_path,y_proba_sick)
+                os.replace(tmp_path,fold_path)
+        predictions.append((np.asarray(test_index),y_proba_sick))
+    return predictions
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Rolling-origin backtest-----------------------------
+### --------------------------------------------------------------------------------------------
+def get_day_offsets(dates):
+    """
+    Groups the rows by day once: the rows are (stably) sorted by date such that the rows of 
+    any range of consecutive days are a contiguous slice of the returned order.
+
+    Parameters
+    -------------
+    dates: numpy ndarray
+        day_0 of each input vector
+
+    Returns
+    -------------
+    order: numpy ndarray
+        the row indices sorted by date
+    days: pandas DatetimeIndex
+        the distinct days (sorted)
+    offsets: numpy ndarray
+        array of length len(days)+1 such that the rows of days[i] are order[offsets[i]:offsets[i+1]]
+    """
+    day_values = pd.to_datetime(np.asarray(dates)).values.astype('datetime64[D]')
+    order = np.argsort(day_values,kind='mergesort')
+    sorted_days = day_values[order]
+    days, starts = np.unique(sorted_days,return_index=True)
+    offsets = np.append(starts,len(order))
+    return order,pd.to_datetime(days),offsets
+
+def get_final_estimator(model):
+    """
+    Returns the last step of a sklearn pipeline (or the model itself if it isn't a pipeline)
+
+    Parameters
+    -------------
+    model: sklearn pipeline or model
+
+    Returns
+    -------------
+    estimator: the final estimator
+    """
+    return model.steps[-1][1] if hasattr(model,'steps') else model
+
+def rolling_origin_backtest(x,y,dates,model,gaps,ratio_testing=0.25,mode='full',warm_start_increment=10):
+    """
+    Evaluates a daily retraining policy: a training window of consecutive days slides one day at a 
+    time over the longest sequence of dates and, for each gap in gaps, the model trained on the window 
+    is tested on the day that comes gap days after the end of the window (the same protocol as 
+    plot_gap_performance). The rows of each day are located with precomputed offsets and, depending 
+    on mode, the work done on a window is reused for the next one:
+        * 'full': the model is refitted from scratch on each window
+        * 'warm_start': the final estimator (e.g. GradientBoostingClassifier) is fitted once on the 
+          first window and then grows warm_start_increment new estimators on each following window
+        * 'partial_fit': the model is fitted with partial_fit on the first window and then only 
+          updated with the day that enters each following window
+
+    Parameters
+    -------------
+    x,y: np ndarrays
+        ML ready data
+    dates: numpy ndarray
+        day_0 of the input vectors
+    model: sklearn pipeline or model on which we can call fit()
+        the machine learning model we wish to evaluate, it is cloned before fitting such that 
+        the caller's model (and its parameters) are left untouched
+    gaps: list(int)
+        list of time gaps (as number of days) between the last training date and testing date
+    ratio_testing: float, default 0.25
+        the ratio of usable days we wich to use in order to 
+        have a meaningful performance evaluation
+    mode: str, default 'full'
+        how the model is updated between consecutive windows (from 'full','warm_start','partial_fit')
+    warm_start_increment: int, default 10
+        the number of estimators added for each new window when mode is 'warm_start'
+
+    Returns
+    -------------
+    results: dict(int -> dict)
+        for each gap, the concatenated true labels ('y_true') and scores ('y_score') of all the 
+        testing days, the resulting 'precision', 'recall' and 'thresholds' and the 'auc'
+    """
+    assert(mode in ['full','warm_start','partial_fit']), 'The chosen backtest mode is not valid'
+    if(mode == 'partial_fit'):
+        assert(hasattr(model,'partial_fit')), 'partial_fit mode requires a model implementing partial_fit'
+    # the warm_start mode changes the parameters of the estimator it fits
+    model = sklearn.base.clone(model)
+
+    dates_to_consider = scripts.utils.get_longest_date_seq(dates,verbose=False)
+    max_gap = max(gaps)
+    usable_days = len(dates_to_consider) - max_gap
+    testing_days = math.floor(ratio_testing*usable_days)
+    training_days = usable_days - testing_days
+
+    order,days,offsets = get_day_offsets(dates)
+    day_2_index = {d: i for i,d in enumerate(days)}
+    first_day = day_2_index[pd.Timestamp(dates_to_consider[0])]
+
+    def rows_of(first,last):
+        # rows of the days [first,last) kept in their original order
+        if(first < 0 or last > len(days)):
+            return np.array([],dtype=int)
+        return np.sort(order[offsets[first]:offsets[last]])
+
+    true_y = {g: [] for g in gaps}
+    score_y = {g: [] for g in gaps}
+    scripts.utils.progress(0, testing_days)
+
+    for w in range(testing_days):
+        start = first_day + w
+        end = start + training_days
+        if(mode == 'full' or w == 0):
+            tr_rows = rows_of(start,end)
+            if(mode == 'partial_fit'):
+                model.partial_fit(x[tr_rows],y[tr_rows],classes=np.array([0,1]))
+            else:
+                model.fit(x[tr_rows],y[tr_rows])
+        elif(mode == 'warm_start'):
+            tr_rows = rows_of(start,end)
+            estimator = get_final_estimator(model)
+            estimator.set_params(warm_start=True,n_estimators=estimator.n_estimators + warm_start_increment)
+            model.fit(x[tr_rows],y[tr_rows])
+        else:
+            # only the day that enters the window is new to the model
+            new_rows = rows_of(end-1,end)
+            model.partial_fit(x[new_rows],y[new_rows])
+        scripts.utils.progress(w+1, testing_days)
+
+        for g in gaps:
+            te_rows = rows_of(end + g,end + g + 1)
+            if(len(te_rows) == 0):
+                continue
+            true_y[g].append(y[te_rows])
+            score_y[g].append(model.predict_proba(x[te_rows])[:, 1])
+
+    results = {}
+    for g in gaps:
+        y_true = np.concatenate(true_y[g])
+        y_score = np.concatenate(score_y[g])
+        precision, recall, thresholds = sklearn.metrics.precision_recall_curve(y_true, y_score)
+        results[g] = {'y_true':y_true,'y_score':y_score,'precision':precision,'recall':recall,
+                      'thresholds':thresholds,'auc':sklearn.metrics.auc(recall, precision)}
+    return results
+
+def evaluate_gap_window(model,x,y,train_rows,test_rows,window_start,prec_thresh_list=[0.7,0.8,0.9]):
+    """
+    Fits a copy of the model on a single training window and evaluates it on the testing day 
+    of each gap. It is the unit of work of parallel_gap_evaluation.
+
+    Parameters
+    -------------
+    model: sklearn pipeline or model on which we can call fit()
+        the (unfitted) model, it is cloned before fitting
+    x,y: np ndarrays
+        ML ready data (x may be a read only memmap shared between workers)
+    train_rows: numpy ndarray
+        rows of the training window
+    test_rows: dict(int -> numpy ndarray)
+        for each gap, the rows of the testing day
+    window_start: pandas Timestamp
+        first day of the training window
+    prec_thresh_list: list(float), default [0.7,0.8,0.9]
+        precision levels at which the max recall is reported
+
+    Returns
+    -------------
+    rows: list(dict)
+        one record per gap (see parallel_gap_evaluation for the fields)
+    """
+    clf = sklearn.base.clone(model)
+    start = timeit.default_timer()
+    clf.fit(x[train_rows],y[train_rows])
+    fit_seconds = timeit.default_timer() - start
+
+    rows = []
+    for g,te_rows in test_rows.items():
+        start = timeit.default_timer()
+        y_score = clf.predict_proba(x[te_rows])[:,1]
+        predict_seconds = timeit.default_timer() - start
+        y_test = y[te_rows]
+
+        record = {'gap':g,'window_start':window_start,'n_test':len(te_rows),'n_sick':int(np.sum(y_test)),
+                  'pr_auc':np.nan,'fit_seconds':fit_seconds,'predict_seconds':predict_seconds}
+        recalls = np.full(len(prec_thresh_list),np.nan)
+        if(record['n_sick'] > 0):
+            # without any sick CPE the precision recall curve isn't defined
+            record['pr_auc'] = auc_from_scores(y_test,y_score)
+            recalls,_ = recalls_for_prec_list(y_test,y_score,prec_thresh_list)
+        for p,r in zip(prec_thresh_list,recalls):
+            record['recall_p{:d}'.format(int(round(100*p)))] = r
+        rows.append(record)
+    return rows
+
+def parallel_gap_evaluation(x,y,dates,model,gaps,ratio_testing=0.25,prec_thresh_list=[0.7,0.8,0.9],n_jobs=-1,verbose=0):
+    """
+    Headless version of the time gap analysis of plot_gap_performance: the training windows 
+    (each fitted from scratch) are evaluated in a pool of processes that share the feature 
+    matrix (it is memory mapped once instead of being copied to each worker). The results are 
+    returned as a tidy table with one row per (training window, gap) such that plotting is optional 
+    (see plot_gap_table).
+
+    Parameters
+    -------------
+    x,y: np ndarrays
+        ML ready data
+    dates: numpy ndarray
+        day_0 of the input vectors
+    model: sklearn pipeline or model on which we can call fit()
+        the machine learning model we wish to evaluate (it is cloned for each window)
+    gaps: list(int)
+        list of time gaps (as number of days) between the last training date and testing date
+    ratio_testing: float, default 0.25
+        the ratio of usable days we wich to use in order to 
+        have a meaningful performance evaluation
+    prec_thresh_list: list(float), default [0.7,0.8,0.9]
+        precision levels at which the max recall is reported
+    n_jobs: int, default -1
+        number of processes to use (-1 to use all the cores)
+    verbose: int, default 0
+        verbosity of the pool of processes
+
+    Returns
+    -------------
+    results_df: pandas DataFrame
+        one row per (gap, window_start) with the number of testing vectors ('n_test') and of sick 
+        ones ('n_sick'), the 'pr_auc', the max recall for each precision level ('recall_p70', ...) 
+        and the time spent fitting ('fit_seconds') and predicting ('predict_seconds')
+    """
+    dates_to_consider = scripts.utils.get_longest_date_seq(dates,verbose=False)
+    max_gap = max(gaps)
+    usable_days = len(dates_to_consider) - max_gap
+    testing_days = math.floor(ratio_testing*usable_days)
+    training_days = usable_days - testing_days
+
+    order,days,offsets = get_day_offsets(dates)
+    first_day = list(days).index(pd.Timestamp(dates_to_consider[0]))
+
+    def rows_of(first,last):
+        return np.sort(order[offsets[first]:offsets[last]])
+
+    tasks = []
+    for w in range(testing_days):
+        start = first_day + w
+        end = start + training_days
+        test_rows = {g: rows_of(end + g,end + g + 1) for g in gaps}
+        test_rows = {g: r for g,r in test_rows.items() if len(r) != 0}
+        tasks.append(delayed(evaluate_gap_window)(model,x,y,rows_of(start,end),test_rows,days[start],prec_thresh_list))
+
+    # arrays larger than max_nbytes are memory mapped and shared by the workers
+    records = Parallel(n_jobs=n_jobs,max_nbytes='1M',mmap_mode='r',verbose=verbose)(tasks)
+    results_df = pd.DataFrame([r for window in records for r in window])
+    return results_df.sort_values(by=['gap','window_start']).reset_index(drop=True)
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Segmented evaluation--------------------------------
+### --------------------------------------------------------------------------------------------
+def get_segment_labels(x_df,prefix):
+    """
+    Recovers the segment of each vector from the dummy columns created by encode_categorical 
+    (e.g. prefix 'wk' gives the weekday and prefix 'model' the hardware model index).
+
+    Parameters
+    -------------
+    x_df: pandas Dataframe
+        the dataframe containing the dummy columns
+    prefix: str
+        the prefix of the dummy columns (as passed to encode_categorical)
+
+    Returns
+    -------------
+    segments: numpy ndarray
+        the segment of each vector (None where no dummy column is set)
+    """
+    cols = [c for c in x_df.columns if c.startswith(prefix+'_')]
+    assert(len(cols) != 0), 'There is no dummy column with prefix {}'.format(prefix)
+    values = np.array([c[len(prefix)+1:] for c in cols],dtype=object)
+    dummies = x_df[cols].values
+    segments = values[np.argmax(dummies,axis=1)]
+    segments[dummies.max(axis=1) == 0] = None
+    return segments
+
+def get_segment_indices(segments):
+    """
+    Builds the row-group index of a segmentation key in one pass: the rows of each 
+    segment are found with a single sort instead of one mask per segment.
+
+    Parameters
+    -------------
+    segments: numpy ndarray or pandas Serie
+        the segment of each vector (e.g. weekday, hardware_model, cmts or service_group)
+
+    Returns
+    -------------
+    indices: dict(segment -> numpy ndarray)
+        the (sorted) rows of each segment
+    """
+    codes,uniques = pd.factorize(pd.Series(segments),sort=True)
+    order = np.argsort(codes,kind='mergesort')
+    bounds = np.searchsorted(codes[order],np.arange(len(uniques)+1))
+    return {uniques[i]: order[bounds[i]:bounds[i+1]] for i in range(len(uniques))}
+
+def evaluate_segment(clf,x,y,dates,rows,segment,prec_thresh_list=[0.7,0.8,0.9],cv=5,random_state=None):
+    """
+    Cross validates a model on the vectors of a single segment only (both training 
+    and testing) with distinct dates in each fold. It is the unit of work of segmented_evaluation.
+
+    Parameters
+    -------------
+    clf: sklearn pipeline or any model we can call fit() and predict_proba() on
+        the classifier (it is cloned)
+    x,y: numpy ndarrays
+        ML ready data (x may be a read only memmap shared between workers)
+    dates: numpy ndarray
+        day_0 of the input vectors
+    rows: numpy ndarray
+        the rows of the segment
+    segment:
+        the name of the segment
+    prec_thresh_list: list(float), default [0.7,0.8,0.9]
+        precision levels at which the max recall is reported
+    cv: int, default 5
+        number of folds
+    random_state: int, optional
+        seed of the date splits
+
+    Returns
+    -------------
+    record: dict
+        see segmented_evaluation for the fields
+    """
+    y_s = y[rows]
+    dates_s = np.asarray(dates)[rows]
+    n_days = len(pd.unique(dates_s))
+    record = {'segment':segment,'n':len(rows),'n_sick':int(np.sum(y_s)),'n_days':n_days,'pr_auc':np.nan,'seconds':np.nan}
+    for p in prec_thresh_list:
+        record['recall_p{:d}'.format(int(round(100*p)))] = np.nan
+
+    # we need at least one date per fold and sick vectors to train on
+    if(n_days < cv or record['n_sick'] < cv):
+        return record
+
+    start = timeit.default_timer()
+    x_s = x[rows]
+    splits = distinct_date_split(x_s,y_s,dates_s,cv,random_state=random_state)
+    pr = cross_validated_precision_recall(sklearn.base.clone(clf),x_s,y_s,splits,prec_thresh_list)
+    record['pr_auc'] = pr['overall_auc']
+    for p,r in zip(prec_thresh_list,np.mean(pr['recall_levels'],axis=0)):
+        record['recall_p{:d}'.format(int(round(100*p)))] = r
+    record['seconds'] = timeit.default_timer() - start
+    return record
+
+def segmented_evaluation(clf,x,y,dates,segments,prec_thresh_list=[0.7,0.8,0.9],cv=5,n_jobs=-1,random_state=None,verbose=0):
+    """
+    Generalisation of weekday_influence to any segmentation key (weekday, hardware_model, 
+    cmts, service_group, ...): the vectors of each segment are located through a row-group 
+    index built once and the cross validation of the segments runs in a pool of processes 
+    sharing the feature matrix.
+
+    Parameters
+    -------------
+    clf: sklearn pipeline or any model we can call fit() and predict_proba() on
+        the classifier
+    x,y: numpy ndarrays
+        ML ready data
+    dates: numpy ndarray
+        day_0 of the input vectors
+    segments: numpy ndarray or pandas Serie
+        the segment of each vector, e.g. get_segment_labels(x_df,'wk') for the weekdays or 
+        the 'cmts' column of the imported sample
+    prec_thresh_list: list(float), default [0.7,0.8,0.9]
+        precision levels at which the max recall is reported
+    cv: int, default 5
+        number of folds
+    n_jobs: int, default -1
+        number of processes to use (-1 to use all the cores)
+    random_state: int, optional
+        seed of the date splits
+    verbose: int, default 0
+        verbosity of the pool of processes
+
+    Returns
+    -------------
+    results_df: pandas DataFrame
+        indexed by segment, with the number of vectors ('n'), of sick ones ('n_sick') and of days 
+        ('n_days'), the overall 'pr_auc', the mean max recall for each precision level 
+        ('recall_p70', ...) and the time spent ('seconds'). The metrics of segments that have less 
+        days or sick vectors than folds are NaN.
+    """
+    indices = get_segment_indices(segments)
+    tasks = [delayed(evaluate_segment)(clf,x,y,dates,rows,s,prec_thresh_list,cv,random_state) for s,rows in indices.items()]
+    records = Parallel(n_jobs=n_jobs,max_nbytes='1M',mmap_mode='r',verbose=verbose)(tasks)
+    return pd.DataFrame(records).set_index('segment')
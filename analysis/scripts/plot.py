@@ -4,31 +4,33 @@
     Module containing all the functions that are used to generate plots. 
     mainly composed of three groups of functions, those that are used to 
     do the Analysis of the Weekends influence on the vectors, the clustering 
-    analysis and the classification analysis
+    analysis and the classification analysis. The numeric work is done by the 
+    other (plot-free) modules and matplotlib/seaborn are only imported when a 
+    plotting function is called, such that batch jobs never pay for them.
 """
 __author__ = "Hugo Moreau"
 __email__ = "hugo.moreau@epfl.ch"
 __status__ = "Prototype"
 
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import pandas as pd
 import math
 
-import sklearn
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import KFold
-from scipy import interp
+import sklearn.cluster
+import sklearn.metrics
+import sklearn.model_selection
 
+import scripts.utils
+import scripts.preprocessing
 import scripts.model_selection
-from scripts.preprocessing import *
-from scripts.model_selection import *
-from scripts.utils import *
+import scripts.clustering
+import scripts.aggregation
+import scripts.profiling
 
 ### --------------------------------------------------------------------------------------------
 ### ----------------------------------------Week-end analysis-----------------------------------
 ### --------------------------------------------------------------------------------------------
-def plot_difference(column_name,week_df,weekend_df,ratio_pop_show=0.9,n_bins=1000):
+def plot_difference(column_name,week_df,weekend_df,ratio_pop_show=0.9,n_bins=1000,profile=None):
     """
     Plots the distribution of a variable for week and weekend
 
@@ -42,35 +44,60 @@ def plot_difference(column_name,week_df,weekend_df,ratio_pop_show=0.9,n_bins=100
     ratio_pop_show : float, default 0.9
         the ratio of the total population that we wish to display in order to hide the outliers.
     n_bins : int, default 1000  
-        the number of bins to use to build the histogram for continuous variables
+        the number of bins to use to build the histogram for continuous variables 
+        (over the displayed interval, the histograms are aggregated before drawing)
+    profile : dict, optional
+        if set, the distributions are read from the merged week and weekend sketches of this 
+        profile (see profiling.build_profile) and week_df, weekend_df can be None
     """
-    week_serie = week_df[column_name].dropna()
-    weekend_serie = weekend_df[column_name].dropna()
+    import matplotlib.pyplot as plt
+
+    if(profile is not None):
+        j = profile['columns'].index(column_name)
+        sketches = [scripts.profiling.select_sketch(profile,period='weekend'),scripts.profiling.select_sketch(profile,period='week')]
+    else:
+        week_values = scripts.aggregation.get_values(week_df[column_name])
+        weekend_values = scripts.aggregation.get_values(weekend_df[column_name])
     
     f, axes = plt.subplots(1, 2, figsize=(18, 5), sharex=True , sharey =True)
     axes[0].set_title("Weekend")
     axes[1].set_title("Week")
         
-    # Then we compute the x axis limit such that ratio_pop_show is shown on the graph
-    lower_quantile = (1-ratio_pop_show)/2
-    upper_quantile = 1-lower_quantile
-    lower_x = min(week_serie.quantile(lower_quantile),weekend_serie.quantile(lower_quantile))
-    upper_x = max(week_serie.quantile(upper_quantile),weekend_serie.quantile(upper_quantile))
-    if('MISS' in column_name):
-        week_serie.value_counts().apply(lambda x: x/week_serie.count()).sort_index().plot(kind='bar',title='Week',color="red",ax=axes[1])
-        weekend_serie.value_counts().apply(lambda x: x/weekend_serie.count()).sort_index().plot(kind='bar',title='Weekend',color="skyblue",ax=axes[0])
+    if(profile is not None):
+        if('MISS' in column_name):
+            for ax, sketch, color in [(axes[0],sketches[0],"skyblue"),(axes[1],sketches[1],"red")]:
+                values, counts = sketch['values'][j]
+                pd.Series(counts/max(sketch['count'][j],1),index=values).sort_index().plot(kind='bar',color=color,ax=ax)
+        else:
+            lower_x, upper_x = scripts.profiling.sketch_central_range(sketches,j,ratio_pop_show)
+            if(lower_x == upper_x):
+                lower_x, upper_x = lower_x - 0.5, upper_x + 0.5
+            edges = np.linspace(lower_x,upper_x,n_bins+1)
+            for ax, sketch, color in [(axes[0],sketches[0],"skyblue"),(axes[1],sketches[1],"red")]:
+                counts = scripts.profiling.sketch_histogram(sketch,j,edges)
+                ax.hist(edges[:-1],bins=edges,weights=counts/(max(sketch['count'][j],1)*np.diff(edges)),color=color)
+                ax.set_xlim(lower_x,upper_x)
+    elif('MISS' in column_name):
+        scripts.aggregation.value_frequencies(week_values).plot(kind='bar',title='Week',color="red",ax=axes[1])
+        scripts.aggregation.value_frequencies(weekend_values).plot(kind='bar',title='Weekend',color="skyblue",ax=axes[0])
     else :
-        axes[0].set_xlim(lower_x,upper_x)
-        axes[1].set_xlim(lower_x,upper_x)
-        sns.distplot(weekend_serie,bins=n_bins,color="skyblue",ax=axes[0],norm_hist=True)
-        sns.distplot(week_serie,bins=n_bins,color="red",ax=axes[1],norm_hist=True)
+        # Then we compute the x axis limit such that ratio_pop_show is shown on the graph
+        lower_x, upper_x = scripts.aggregation.get_central_range([week_values,weekend_values],ratio_pop_show)
+        if(lower_x == upper_x):
+            lower_x, upper_x = lower_x - 0.5, upper_x + 0.5
+        edges = np.linspace(lower_x,upper_x,n_bins+1)
+        for ax, values, color in [(axes[0],weekend_values,"skyblue"),(axes[1],week_values,"red")]:
+            counts = scripts.aggregation.histogram_1d(values,edges)
+            # normalised by the whole population such that the hidden outliers keep their weight
+            ax.hist(edges[:-1],bins=edges,weights=counts/(max(len(values),1)*np.diff(edges)),color=color)
+            ax.set_xlim(lower_x,upper_x)
     f.suptitle('Distribution of {}'.format(column_name))
     f.show()
 
 ### --------------------------------------------------------------------------------------------
 ### ----------------------------------------Classification Analysis-----------------------------
 ### --------------------------------------------------------------------------------------------
-def single_roc_curve(x,y,pipeline_generator,param,top_ratio = 0.15,ax=None,cv=5,distinct_date=False,dates = None):
+def single_roc_curve(x,y,pipeline_generator,param,top_ratio = 0.15,ax=None,cv=5,distinct_date=False,dates = None,cache_dir=None,random_state=None):
     """
     Compute a cross validated ROC curve for a given model. 
 
@@ -92,6 +119,11 @@ def single_roc_curve(x,y,pipeline_generator,param,top_ratio = 0.15,ax=None,cv=5,
         whether we wish to split the dataset in order to have distinct dates in the training and testing set
     dates: numpy array
         an array of dates (same length as x has rows)
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    random_state: int, optional
+        seed of the class balancing (or of the date splits when distinct_date is True), it must be 
+        set for cached predictions to be reused across calls
 
     Returns
     -------------
@@ -99,12 +131,8 @@ def single_roc_curve(x,y,pipeline_generator,param,top_ratio = 0.15,ax=None,cv=5,
         contains 3 elements Precision Recall and F1-score of the model estimated over different folds
 
     """
-    tprs = []
-    aucs = []
-    mean_fpr = np.linspace(0, 1, 100)
-    metrics = np.zeros((cv,3))
+    import matplotlib.pyplot as plt
 
-    i = 0
     model = pipeline_generator(param)
 
     assert((distinct_date and dates is not None) or not distinct_date), 'distinct_date was True but no date provided'
@@ -115,49 +143,34 @@ def single_roc_curve(x,y,pipeline_generator,param,top_ratio = 0.15,ax=None,cv=5,
 
     # construct the splits depending on the strategy
     if(not distinct_date):
-        kf = KFold(n_splits=cv)
-        x,y = get_balanced_classes(x,y)
-        splits = kf.split(x)
+        x,y = scripts.preprocessing.get_balanced_classes(x,y,random_state=random_state)
+        splits = list(sklearn.model_selection.KFold(n_splits=cv).split(x))
     else:
-        splits =  distinct_date_split(x,y,dates,k=cv)
+        splits =  scripts.model_selection.distinct_date_split(x,y,dates,k=cv,random_state=random_state)
 
-    for train, test in splits:
-        probas_ = model.fit(x[train], y[train]).predict_proba(x[test])
-        
-        # Compute ROC curve and area the curve
-        fpr, tpr, thresholds = sklearn.metrics.roc_curve(y[test], probas_[:, 1])
-        tprs.append(interp(mean_fpr, fpr, tpr))
-        tprs[-1][0] = 0.0
-        roc_auc = sklearn.metrics.auc(fpr, tpr)
-        aucs.append(roc_auc)
+    roc = scripts.model_selection.cross_validated_roc(model,x,y,splits,top_ratio,cache_dir)
+
+    for i,(fpr,tpr,roc_auc) in enumerate(roc['folds']):
         ax.plot(fpr, tpr, lw=1, alpha=0.3,
                  label='ROC fold %d (AUC = %0.2f)' % (i, roc_auc))
 
-        # compute the metrics on the top ratio
-        metrics[i,:] = get_metrics(probas_[:, 1],y[test],top_ratio)
-
-        i += 1
-
     # add the diagonal to show what a random clf would give
     ax.plot([0, 1], [0, 1], linestyle='--', lw=2, color='r',
          label='Luck', alpha=.8)
 
-    mean_tpr = np.mean(tprs, axis=0)
-    mean_tpr[-1] = 1.0
-    mean_auc = sklearn.metrics.auc(mean_fpr, mean_tpr)
-    std_auc = np.std(aucs)
-    m = np.mean(metrics,axis = 0)
+    mean_fpr = roc['mean_fpr']
+    mean_tpr = roc['mean_tpr']
+    m = roc['metrics']
 
     t = 'Param = {}'.format(param)
     t += "\nP = {:.3f}%; R = {:.3f}%; F1 = {:.3f}%".format(m[0],m[1],m[2])
 
     ax.plot(mean_fpr, mean_tpr, color='b',
-             label=r'Mean ROC (AUC = %0.2f $\pm$ %0.2f)' % (mean_auc, std_auc),
+             label=r'Mean ROC (AUC = %0.2f $\pm$ %0.2f)' % (roc['mean_auc'], roc['std_auc']),
              lw=2, alpha=.8)
 
-    std_tpr = np.std(tprs, axis=0)
-    tprs_upper = np.minimum(mean_tpr + std_tpr, 1)
-    tprs_lower = np.maximum(mean_tpr - std_tpr, 0)
+    tprs_upper = np.minimum(mean_tpr + roc['std_tpr'], 1)
+    tprs_lower = np.maximum(mean_tpr - roc['std_tpr'], 0)
 
     # confidence interval
     ax.fill_between(mean_fpr, tprs_lower, tprs_upper, color='grey', alpha=.2,
@@ -172,7 +185,7 @@ def single_roc_curve(x,y,pipeline_generator,param,top_ratio = 0.15,ax=None,cv=5,
     ax.legend(loc="lower right")
     return m
 
-def roc_curves(param_list,pipeline_generator,x,y,title,top_ratio,dates=None,distinct_date=False,cv=5):
+def roc_curves(param_list,pipeline_generator,x,y,title,top_ratio,dates=None,distinct_date=False,cv=5,cache_dir=None,random_state=None):
     """
     Draws all the roc_curves for each parameter for a given pipeline generator
     
@@ -194,6 +207,11 @@ def roc_curves(param_list,pipeline_generator,x,y,title,top_ratio,dates=None,dist
         can be set to true if we wish the cross validation to take place on distinct date between folds
     cv: int, default 5
         the number of folds used to cross validate the results
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    random_state: int, optional
+        seed of the class balancing (or of the date splits when distinct_date is True), it must be 
+        set for cached predictions to be reused across calls
 
     Returns
     -------------
@@ -208,6 +226,8 @@ def roc_curves(param_list,pipeline_generator,x,y,title,top_ratio,dates=None,dist
     opt_param: depends on the way the pipeline generator is constructed
         the optimal parameter(s) that yields optimal metrics.
     """
+    import matplotlib.pyplot as plt
+
     n_subplots=len(param_list)
     fig, axes = plt.subplots(ncols=n_subplots,sharex = True,sharey=True,figsize=(5*n_subplots, 5))
     scripts.utils.progress(0, n_subplots, suffix='Generating subplots')
@@ -217,7 +237,8 @@ def roc_curves(param_list,pipeline_generator,x,y,title,top_ratio,dates=None,dist
     if(n_subplots == 1):
         axes = [axes]
     for i,p in enumerate(param_list):
-        results[i,:] = single_roc_curve(x,y,pipeline_generator,p,top_ratio=top_ratio,ax=axes[i],cv=cv,distinct_date=distinct_date,dates = dates)
+        results[i,:] = single_roc_curve(x,y,pipeline_generator,p,top_ratio=top_ratio,ax=axes[i],cv=cv,distinct_date=distinct_date,dates = dates,
+                                        cache_dir=cache_dir,random_state=random_state)
         scripts.utils.progress(i+1, n_subplots, suffix='Generating subplots')
 
 
@@ -232,7 +253,8 @@ def roc_curves(param_list,pipeline_generator,x,y,title,top_ratio,dates=None,dist
     return title,P,R,F,opt_param
 
 
-def single_precision_recall_curve(clf, x, y, dates, title,prec_thresh_list=[0.7,0.8,0.9],cv=5, balanced = True, shuffle = True,ax=None,plot_var=True):
+def single_precision_recall_curve(clf, x, y, dates, title,prec_thresh_list=[0.7,0.8,0.9],cv=5, balanced = True, shuffle = True,ax=None,plot_var=True,
+                                  cache_dir=None,random_state=None):
     """
     Draws a precision recall curve and evaluates the maximum recall that the model can achieves for different precision level
 
@@ -258,48 +280,36 @@ def single_precision_recall_curve(clf, x, y, dates, title,prec_thresh_list=[0.7,
         if we wish to plot multiple such curves against each other 
     plot_var: boolean
         can be set to false if we wish to draw only the overall curve and not each fold's
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    random_state: int, optional
+        seed of the date splits, must be set for cached predictions to be reused across calls
 
     Returns 
     -------------
     arr: np array
         contains the recall levels for specified precision threshold and the overall auc
     """
+    import matplotlib.pyplot as plt
+
     if(ax is None):
         # if we do not want to plot multiple roc curves side by side
         fig,ax = plt.subplots(1,1)
 
-    splits = scripts.model_selection.distinct_date_split(x,y,dates,cv,balanced,shuffle)
-    recall_levels = np.zeros((cv,len(prec_thresh_list)))
-    threshs = np.zeros((cv,len(prec_thresh_list)))
-    
-    y_real = []
-    y_scores = []
-    
-    for i,(train_index,test_index) in enumerate(splits):
-        x_train, x_test,y_train, y_test = x[train_index], x[test_index], y[train_index], y[test_index]
-        clf.fit(x_train,y_train)
-        y_proba_sick = clf.predict_proba(x_test)[:,1]
-        if(plot_var):
-            precision, recall, threshold = sklearn.metrics.precision_recall_curve(y_test, y_proba_sick) 
-            lab = 'Fold {:d} AUC = {:.4f}'.format(i+1,sklearn.metrics.auc(recall,precision))
-            
+    splits = scripts.model_selection.distinct_date_split(x,y,dates,cv,balanced,shuffle,random_state)
+    pr = scripts.model_selection.cross_validated_precision_recall(clf,x,y,splits,prec_thresh_list,cache_dir)
+
+    if(plot_var):
+        for i,(precision,recall,fold_auc) in enumerate(pr['folds']):
+            lab = 'Fold {:d} AUC = {:.4f}'.format(i+1,fold_auc)
             ax.step(recall, precision,alpha=0.2,where='post',label=lab)
-        
-        #store them 
-        y_real.append(y_test)
-        y_scores.append(y_proba_sick)
-        recalls_for_i,thresholds_for_i = scripts.model_selection.recalls_for_prec_list(y_test,y_proba_sick,prec_thresh_list)
-        recall_levels[i,:] = recalls_for_i
-        threshs[i,:] = thresholds_for_i
-    
-    # compute the overall
-    y_real = np.concatenate(y_real)
-    y_scores = np.concatenate(y_scores)
-    precision, recall, _ = sklearn.metrics.precision_recall_curve(y_real, y_scores)
 
-    overall_auc = sklearn.metrics.auc(recall,precision)
+    # the overall curve
+    overall_auc = pr['overall_auc']
+    recall_levels = pr['recall_levels']
+    threshs = pr['thresholds']
     lab = 'Overall AUC = {:.4f}'.format(overall_auc)
-    ax.step(recall, precision, label=lab,where='post',lw=2, color='black')
+    ax.step(pr['recall'], pr['precision'], label=lab,where='post',lw=2, color='black')
 
     ax.set_xlabel('Recall')
     ax.set_ylabel('Precision')
@@ -318,7 +328,7 @@ def single_precision_recall_curve(clf, x, y, dates, title,prec_thresh_list=[0.7,
 
     return np.array(np.mean(recall_levels,axis=0).tolist() + [overall_auc])
 
-def precision_recall_curves(param_list,pipeline_generator,x,y,title,prec_thresh,dates,cv=5):
+def precision_recall_curves(param_list,pipeline_generator,x,y,title,prec_thresh,dates,cv=5,cache_dir=None,random_state=None):
     """
     Graphically compares multiple models using precision recalls curves
 
@@ -338,6 +348,10 @@ def precision_recall_curves(param_list,pipeline_generator,x,y,title,prec_thresh,
         day_0 of the vectors
     cv: int, default 5
         he number of folds to use to perform the cross validation
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    random_state: int, optional
+        seed of the date splits, must be set for cached predictions to be reused across calls
 
     Returns 
     -------------
@@ -349,6 +363,8 @@ def precision_recall_curves(param_list,pipeline_generator,x,y,title,prec_thresh,
     opt_param:
         the parameter(s) that yield the optimal results
     """
+    import matplotlib.pyplot as plt
+
     n_subplots = len(param_list)
 
     # we will store for each parameter the max recall level and overall AUC
@@ -361,7 +377,8 @@ def precision_recall_curves(param_list,pipeline_generator,x,y,title,prec_thresh,
     for i,p in enumerate(param_list):
         clf = pipeline_generator(p)
         t = 'Param = {}'.format(round(p,3))
-        results[i,:] = single_precision_recall_curve(clf, x, y, dates,t,prec_thresh,cv,ax=axes[i])
+        results[i,:] = single_precision_recall_curve(clf, x, y, dates,t,prec_thresh,cv,ax=axes[i],
+                                                     cache_dir=cache_dir,random_state=random_state)
         scripts.utils.progress(i+1, n_subplots, suffix='Generating subplots')
 
     prec_thresh_s = ";".join(['{:.2f}%'.format(100*x) for x in prec_thresh])
@@ -378,7 +395,7 @@ def precision_recall_curves(param_list,pipeline_generator,x,y,title,prec_thresh,
     return [title] + opt_results + [opt_param]
 
 
-def compare_distrib(var_to_explore, df, n_bins = 10):
+def compare_distrib(var_to_explore, df, n_bins = 10, profile = None):
     '''
     Allows us to compare the distribution of variables depending on their class 
     in order to see hwo the classifier could potentially use a variable to 
@@ -393,17 +410,18 @@ def compare_distrib(var_to_explore, df, n_bins = 10):
         well as a column 'sick' that is set to 1 or 0 depending on the target (the class)
     n_bins: int, default 10
         the number of bins used to create the histogram
+    profile: dict, optional
+        if set, the histograms are read from the merged sketches of each class of this 
+        profile (see profiling.build_profile) and df can be None
     '''
-    binned_name = var_to_explore + '_binned'
-    min_ = df[var_to_explore].min()
-    max_ = df[var_to_explore].max()
-    df[str(binned_name)] = pd.cut(
-        df[var_to_explore], n_bins, include_lowest=True)
+    import matplotlib.pyplot as plt
 
-    cnt = pd.DataFrame()
-    cnt['sick'] = df[df['sick'] == 1][binned_name].value_counts()
-    cnt['healthy'] = df[df['sick'] == 0][binned_name].value_counts()
-    cnt = cnt.apply(lambda x: round(100*x/x.sum(), 3)).sort_index()
+    if(profile is not None):
+        cnt = scripts.profiling.sketch_class_histograms(scripts.profiling.select_sketch(profile, classes=(1,)),
+                                                        scripts.profiling.select_sketch(profile, classes=(0,)),
+                                                        profile['columns'].index(var_to_explore), n_bins)
+    else:
+        cnt = scripts.aggregation.class_histograms(df[var_to_explore].values, df['sick'].values, n_bins)
 
     plt.style.use('ggplot')
     ind = np.array([i for i, _ in enumerate(cnt.index)])
@@ -416,7 +434,7 @@ def compare_distrib(var_to_explore, df, n_bins = 10):
     plt.title(var_to_explore)
     plt.show()
 
-def plot_gap_performance(x,y,dates,model,gaps,ratio_testing=0.25):
+def plot_gap_performance(x,y,dates,model,gaps,ratio_testing=0.25,mode='full',warm_start_increment=10):
     """
     Plots the Recall Precision curve for different time gaps between the training and testing.
     
@@ -431,59 +449,24 @@ def plot_gap_performance(x,y,dates,model,gaps,ratio_testing=0.25):
     ratio_testing: float, default 0.25
         the ratio of usable days we wich to use in order to 
         have a meaningful performance evaluation
-    """
-    dates_to_consider = get_longest_date_seq(dates,verbose=False)
-
-    max_gap = max(gaps)
-    usable_days = len(dates_to_consider) - max_gap
-    testing_days = math.floor(ratio_testing*usable_days)
-    training_days = usable_days - testing_days
+    mode: str, default 'full'
+        how the model is updated between consecutive training windows (see rolling_origin_backtest)
+    warm_start_increment: int, default 10
+        the number of estimators added for each new window when mode is 'warm_start'
 
-    scripts.utils.progress(0, testing_days)
-
-    # generate training sets.
-    day_0 = dates_to_consider[0]
-    training_sets_dates = [[day_0 + timedelta(days=first_day_delta) +
-                            timedelta(days=i) for i in range(0, training_days)]
-                           for first_day_delta in range(0, testing_days)]
-
-    dates_pd = pd.to_datetime(dates)
-
-    # to store the results
-    true_y = {g: [] for g in gaps}
-    score_y = {g: [] for g in gaps}
-    i = 1
-
-    for tr_d in training_sets_dates:
-        tr_mask = dates_pd.isin(tr_d)
-        x_training = x[tr_mask]
-        y_training = y[tr_mask]
-
-        # fit the model
-        model.fit(x_training, y_training)
-
-        # print the progress
-        scripts.utils.progress(i, testing_days)
-        i+=1
-
-        for g in gaps:
-            te_d = tr_d[-1] + timedelta(days=g + 1)
-            te_mask = [dates_pd == te_d]
-            x_testing = x[te_mask]
-            y_testing = y[te_mask]
+    Returns
+    -------------
+    results: dict(int -> dict)
+        the per gap results of rolling_origin_backtest
+    """
+    import matplotlib.pyplot as plt
 
-            # test the model and get predictions
-            scores = model.predict_proba(x_testing)[:, 1]
-            true_y[g].append(y_testing)
-            score_y[g].append(scores)
+    results = scripts.model_selection.rolling_origin_backtest(x,y,dates,model,gaps,ratio_testing,mode,warm_start_increment)
 
     fig, ax = plt.subplots()
     for g in gaps:
-        precision, recall, threshold = sklearn.metrics.precision_recall_curve(
-            np.concatenate(true_y[g]), np.concatenate(score_y[g]))
-        lab = 'Gap = {}d, AUC = {:.4f}'.format(
-            g, sklearn.metrics.auc(recall, precision))
-        ax.step(recall, precision, alpha=0.5, where='post', label=lab)
+        lab = 'Gap = {}d, AUC = {:.4f}'.format(g, results[g]['auc'])
+        ax.step(results[g]['recall'], results[g]['precision'], alpha=0.5, where='post', label=lab)
 
     ax.set_xlabel('Recall')
     ax.set_ylabel('Precision')
@@ -492,8 +475,35 @@ def plot_gap_performance(x,y,dates,model,gaps,ratio_testing=0.25):
     ax.set_title(
         'Comparison of performance with\ndifferent training-testing time gaps')
     ax.legend(loc='upper right', fontsize='small')
+    return results
+
+def plot_gap_table(results_df,metric='pr_auc',ax=None):
+    """
+    Plots the evolution of a metric over the training windows for each time gap, 
+    from the table returned by parallel_gap_evaluation.
 
-def weekday_only_pr_curve(weekday_index,x_df,y,dates,clf,ax=None):
+    Parameters
+    -------------
+    results_df: pandas DataFrame
+        the results of parallel_gap_evaluation
+    metric: str, default 'pr_auc'
+        the column of results_df to plot
+    ax: matplotlib.axes._subplots.AxesSubplot, optional
+        if we wish to plot multiple such curves against each other 
+    """
+    import matplotlib.pyplot as plt
+
+    if(ax is None):
+        fig,ax = plt.subplots(1,1)
+    for g,df in results_df.groupby('gap'):
+        lab = 'Gap = {}d, mean = {:.4f}'.format(g,df[metric].mean())
+        ax.plot(df['window_start'],df[metric],marker='.',alpha=0.7,label=lab)
+    ax.set_xlabel('First day of the training window')
+    ax.set_ylabel(metric)
+    ax.set_title('{} for different training-testing time gaps'.format(metric))
+    ax.legend(loc='best', fontsize='small')
+
+def weekday_only_pr_curve(weekday_index,x_df,y,dates,clf,ax=None,cache_dir=None,random_state=None):
     """
     Plots a PR curve for a given model and weekday such that both 
     training and testing are only composed of the same weekday
@@ -513,7 +523,13 @@ def weekday_only_pr_curve(weekday_index,x_df,y,dates,clf,ax=None):
         the model
     ax: matplotlib.axes._subplots.AxesSubplot, optional
         if we wish to plot multiple such curves against each other 
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    random_state: int, optional
+        seed of the date splits, must be set for cached predictions to be reused across calls
     """
+    import matplotlib.pyplot as plt
+
     if(ax is None):
         # if we do not want to plot multiple roc curves side by side
         fig,ax = plt.subplots(1,1)
@@ -524,9 +540,10 @@ def weekday_only_pr_curve(weekday_index,x_df,y,dates,clf,ax=None):
     dates = dates[weekday_indices]
     x = x_df[weekday_indices].values
     y = y[weekday_indices]
-    single_precision_recall_curve(clf, x, y, dates,'Weekday = {}\n'.format(weekday_index),ax=ax)
+    single_precision_recall_curve(clf, x, y, dates,'Weekday = {}\n'.format(weekday_index),ax=ax,
+                                  cache_dir=cache_dir,random_state=random_state)
 
-def weekday_influence(x_df,y,dates,clf):
+def weekday_influence(x_df,y,dates,clf,cache_dir=None,random_state=None):
     """
     Plots precision recall curves for each weekday to analyse whether training and 
     testing on the same weekday yields higher performances.
@@ -542,11 +559,17 @@ def weekday_influence(x_df,y,dates,clf):
         day_0 of the input vectors
     clf: instantiated pipeline 
         the model
+    cache_dir: str, optional
+        folder of the out-of-fold prediction cache (see get_oof_predictions)
+    random_state: int, optional
+        seed of the date splits, must be set for cached predictions to be reused across calls
     """ 
+    import matplotlib.pyplot as plt
+
     fig, axes =  plt.subplots(ncols=7,sharex = True,sharey=True,figsize=(5*7, 5))
     scripts.utils.progress(0, 7, "Creating subplots for each week day")
     for w_i in range(0,7):
-        weekday_only_pr_curve(w_i,x_df,y,dates,clf,axes[w_i])
+        weekday_only_pr_curve(w_i,x_df,y,dates,clf,axes[w_i],cache_dir,random_state)
         scripts.utils.progress(w_i+1, 7, "Creating subplots for each week day")
     plt.subplots_adjust(top=0.85)
     fig.show()
@@ -556,10 +579,12 @@ def weekday_influence(x_df,y,dates,clf):
 ### --------------------------------------------------------------------------------------------
 ### ----------------------------------------Correlation Analysis--------------------------------
 ### --------------------------------------------------------------------------------------------
-def look_at_joint_dist(data,key,identical_set):
+def look_at_joint_dist(data,key,identical_set,n_bins=100):
     """
     This function will create as many plots as there are elements in 
-    identical_set to show the joint distribution of the key with each element of the set
+    identical_set to show the joint distribution of the key with each element of the set. 
+    Each joint distribution is drawn from its 2-D histogram (with the least squares line), 
+    the Spearman correlation is approximated from the histogram (see aggregation.joint_aggregates).
     
     Parameters
     -------------
@@ -569,14 +594,15 @@ def look_at_joint_dist(data,key,identical_set):
         the main variable we want to compare to all others
     identical_set: list(str)
         the list of all the variables we wish to compare key to.
+    n_bins: int, default 100
+        the number of bins along each axis of the histograms
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+
     n_plots = len(identical_set)
     iden = list(identical_set)
     
-    red = data[[key] + iden]
-    pearson = red.corr()
-    spearman = red.corr(method='spearman')
-    
     width_single = 5
     height_single = 5
     n_rows = math.ceil(n_plots/4)
@@ -595,9 +621,14 @@ def look_at_joint_dist(data,key,identical_set):
         else:
             ax_=axes[i]
         
-        sns.regplot(key, iden[i], data=data, ax=ax_)
-        p = pearson.loc[key,iden[i]]
-        s = spearman.loc[key,iden[i]]
+        agg = scripts.aggregation.joint_aggregates(data[key].values, data[iden[i]].values, n_bins)
+        ax_.pcolormesh(agg['x_edges'], agg['y_edges'], np.ma.masked_equal(agg['counts'].T, 0), norm=LogNorm(), cmap='Blues')
+        line_x = agg['x_edges'][[0,-1]]
+        ax_.plot(line_x, agg['intercept'] + agg['slope']*line_x, color='red')
+        ax_.set_xlabel(key)
+        ax_.set_ylabel(iden[i])
+        p = agg['pearson']
+        s = agg['spearman']
         ax_.set_title('Pearson = {:.2f}, Spearman = {:.2f}'.format(p,s))
         
     fig.subplots_adjust(hspace=0.5)
@@ -606,10 +637,12 @@ def look_at_joint_dist(data,key,identical_set):
 ### --------------------------------------------------------------------------------------------
 ### ----------------------------------------Clustering Analysis---------------------------------
 ### --------------------------------------------------------------------------------------------
-def silhouette_analysis(range_n_clusters,X):
+def silhouette_analysis(range_n_clusters,X,sample_size=10000,random_state=None):
     """
     Plots a silhouette analysis for the clustering of a given dataset 
-    using K-means and for different number of clusters.
+    using K-means and for different number of clusters. The silhouettes of 
+    all the clusterings are computed on the same sample of vectors, sharing 
+    the distance computations (see clustering.compute_sampled_silhouettes).
 
     Parameters
     -------------
@@ -617,11 +650,25 @@ def silhouette_analysis(range_n_clusters,X):
         Cluster numbers we wish to consider
     - X: numpy ndarray
         input dataset
+    - sample_size: int, default 10000
+        the number of vectors whose silhouette is computed
+    - random_state: int, optional
+        seed of the sample
     """
 
+    import matplotlib.pyplot as plt
+
+    labelings = []
+    for n_clusters in range_n_clusters:
+        # Initialize the clusterer with n_clusters value and a random generator
+        # seed of 10 for reproducibility.
+        clusterer = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=10, batch_size=1000)
+        labelings.append(clusterer.fit_predict(X))
+    rows, silhouettes = scripts.clustering.compute_sampled_silhouettes(X, labelings, sample_size, random_state=random_state)
+
     # Create a grid of 3 columns to display plots neatly
     n_plots = len(range_n_clusters)
-    n_rows = ceil(n_plots/3)
+    n_rows = math.ceil(n_plots/3)
     n_cols = 3
     fig, axes = plt.subplots(nrows=n_rows, ncols=n_cols,sharex=True, sharey=True)
 
@@ -630,22 +677,18 @@ def silhouette_analysis(range_n_clusters,X):
     to_print = ''
 
     for i,n_clusters in enumerate(range_n_clusters):
-        # Initialize the clusterer with n_clusters value and a random generator
-        # seed of 10 for reproducibility.
-        clusterer = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=10, batch_size=1000)
-        cluster_labels = clusterer.fit_predict(X)
-
         # plot the silhouette analysis
         ax = axes[i%3] if n_rows == 1 else axes[i//3][i%3]
-        legend = get_single_silhouette(X,cluster_labels,n_clusters,ax)
+        legend = get_single_silhouette(X,labelings[i],n_clusters,ax,sample_silhouettes=(rows,silhouettes[:,i]))
         to_print += legend +'\n'
 
     print(to_print)
     fig.show()
 
-def get_single_silhouette(X,cluster_labels,n_clusters,ax=None):
+def get_single_silhouette(X,cluster_labels,n_clusters,ax=None,sample_size=10000,random_state=None,sample_silhouettes=None):
     """
-    Will draw a silhouette for a given dataset
+    Will draw a silhouette for a given dataset, on a random sample of vectors when 
+    it has more than sample_size vectors
 
     Parameters
     -------------
@@ -657,7 +700,21 @@ def get_single_silhouette(X,cluster_labels,n_clusters,ax=None):
         the number of clusters used
     ax: matplotlib.axes._subplots.AxesSubplot, optionnal
         when we wish to draw multiple subplots against each other
+    sample_size: int, default 10000
+        the number of vectors whose silhouette is computed
+    random_state: int, optional
+        seed of the sample
+    sample_silhouettes: (numpy ndarray,numpy ndarray), optional
+        the sampled rows and their silhouettes if they were already computed
     """
+    import matplotlib.pyplot as plt
+
+    if(sample_silhouettes is None):
+        rows, silhouettes = scripts.clustering.compute_sampled_silhouettes(X, [cluster_labels], sample_size, random_state=random_state)
+        sample_silhouettes = (rows, silhouettes[:,0])
+    rows, sample_silhouette_values = sample_silhouettes
+    sample_labels = np.asarray(cluster_labels)[rows]
+    show = (ax is None)
 
     if(ax == None):
         fig, ax = plt.subplots(1,1)
@@ -667,29 +724,27 @@ def get_single_silhouette(X,cluster_labels,n_clusters,ax=None):
 
     # The (n_clusters+1)*10 is for inserting blank space between silhouette
     # plots of individual clusters, to demarcate them clearly.
-    ax.set_ylim([0, len(X) + (n_clusters + 1) * 10])
+    ax.set_ylim([0, len(rows) + (n_clusters + 1) * 10])
 
     # The silhouette_score gives the average value for all the samples.
     # This gives a perspective into the density and separation of the formed
     # clusters
-    silhouette_avg = silhouette_score(X, cluster_labels)
-    to_return = "For n_clusters = {:d}, the average silhouette_score is : {:.4f}".format(n_clusters,silhouette_avg)
-
-    # Compute the silhouette scores for each sample
-    sample_silhouette_values = silhouette_samples(X, cluster_labels)
+    scores, errors = scripts.clustering.summarise_silhouettes(sample_silhouette_values[:,np.newaxis], len(X))
+    silhouette_avg = scores[0]
+    to_return = "For n_clusters = {:d}, the average silhouette_score is : {:.4f} (+/- {:.4f})".format(n_clusters,silhouette_avg,errors[0])
 
     y_lower = 10
     for i in range(n_clusters):
         # Aggregate the silhouette scores for samples belonging to
         # cluster i, and sort them
-        ith_cluster_silhouette_values = sample_silhouette_values[cluster_labels == i]
+        ith_cluster_silhouette_values = sample_silhouette_values[sample_labels == i]
 
         ith_cluster_silhouette_values.sort()
 
         size_cluster_i = ith_cluster_silhouette_values.shape[0]
         y_upper = y_lower + size_cluster_i
 
-        color = cm.spectral(float(i) / n_clusters)
+        color = plt.cm.nipy_spectral(float(i) / n_clusters)
         ax.fill_betweenx(np.arange(y_lower, y_upper),
                           0, ith_cluster_silhouette_values,
                           facecolor=color, edgecolor=color, alpha=0.7)
@@ -709,13 +764,13 @@ def get_single_silhouette(X,cluster_labels,n_clusters,ax=None):
     ax.set_yticks([])  # Clear the yaxis labels / ticks
     ax.set_xticks([-0.9,-0.5,-0.1, 0, 0.2, 0.4, 0.6, 0.8, 1])
     
-    if(ax == None):
+    if(show):
         fig.show()
         print(to_return)
 
     return to_return;
 
-def plot_silhouette_score(cluster_numbers,X):
+def plot_silhouette_score(cluster_numbers,X,sample_size=1000,strata=None,n_jobs=1,random_state=None):
     """
     Allows us to plot silhouette scores and sum of squared errors for K-means clustering on 
     different number of cluster in order to determine the most appropriate number of clusters.
@@ -726,18 +781,37 @@ def plot_silhouette_score(cluster_numbers,X):
         a list of k we wish to use for k-means
     X: numpy ndarray
         data that is ready for clustering
+    sample_size: int, default 1000
+        the number of vectors whose silhouette is computed
+    strata: numpy ndarray, optional
+        stratum of each vector (e.g. the binary labels) to draw a stratified sample
+    n_jobs: int, default 1
+        the number of processes fitting the clusterings (-1 for all cores)
+    random_state: int, optional
+        seed of the clusterings and of the sample
+
+    Returns
+    -------------
+    sweep_df: pandas DataFrame
+        the inertia, silhouette score and fit time of each k (see clustering.kmeans_sweep)
     """
+    sweep_df = scripts.clustering.kmeans_sweep(X, cluster_numbers, sample_size, strata, n_jobs=n_jobs, random_state=random_state)
+    plot_kmeans_sweep(sweep_df)
+    return sweep_df
 
-    inertias = []
-    sc = []
-    for k in cluster_numbers:
-        k_mean = sklearn.cluster.MiniBatchKMeans(n_clusters=k, verbose=0, batch_size=1000)
-        k_mean.fit(X)
-        silhouette_avg = metrics.silhouette_score(X, k_mean.labels_, sample_size=1000)
-        sc.append(silhouette_avg)
-        inertias.append(k_mean.inertia_)
+def plot_kmeans_sweep(sweep_df):
+    """
+    Plots the sum of squared errors (elbow) and the silhouette score w.r.t the number of clusters
 
-    red_inertias = [x/100000 for x in inertias]
+    Parameters
+    -------------
+    sweep_df: pandas DataFrame
+        the result of clustering.kmeans_sweep
+    """
+    import matplotlib.pyplot as plt
+
+    cluster_numbers = list(sweep_df.index)
+    red_inertias = [x/100000 for x in sweep_df.inertia]
     plt.figure(figsize=(23,10))
     plt.scatter(cluster_numbers,red_inertias)
     plt.plot(cluster_numbers, red_inertias)
@@ -745,22 +819,23 @@ def plot_silhouette_score(cluster_numbers,X):
     plt.xlabel('Number of clusters (k)')
     plt.ylabel('SSE (*10^5)')
     plt.title('Evolution of the sum of squared error w.r.t the # of clusters')
-    plt.figure(figsize=(3,23))
     plt.show()
 
+    sc = sweep_df.silhouette.values
     plt.figure(figsize=(23,10))
-    plt.scatter(cluster_numbers,sc)
+    plt.errorbar(cluster_numbers, sc, yerr=sweep_df.silhouette_error.values, fmt='o')
     plt.plot(cluster_numbers, sc)
     plt.xticks(cluster_numbers)
     plt.xlabel('Number of clusters (k)')
     plt.ylabel('Silhouette average score')
     plt.title('Evolution of the silhouette score w.r.t the # of clusters')
-    plt.figure(figsize=(3,23))
     plt.show()
 
-def plot_silhouette_score_different_PCA(x,list_retained_var,list_cluster_numbers,sample = False):
+def plot_silhouette_score_different_PCA(x,list_retained_var,list_cluster_numbers,sample = False,y = None,cache_dir = None,n_jobs = 1,random_state = None):
     """
-    Depending on the ratio of retained var we plot the silhouette score over different number of clusters
+    Depending on the ratio of retained var we plot the silhouette score over different number of clusters. 
+    A single PCA is fitted for the largest retained variance and each smaller one uses its first 
+    components (see clustering.fit_pca_once).
 
     Parameters
     -------------
@@ -772,40 +847,56 @@ def plot_silhouette_score_different_PCA(x,list_retained_var,list_cluster_numbers
         list of different number of clusters we wish to consider
     sample: boolean, default False
         can be set to true if we wish to subsample the healthy class
+    y: numpy ndarray, optional
+        the binary labels of x (needed when sample is True)
+    cache_dir: str, optional
+        the folder where the PCA projection is cached
+    n_jobs: int, default 1
+        the number of processes fitting the clusterings (-1 for all cores)
+    random_state: int, optional
+        seed of the subsample, of the PCA and of the clusterings
+
+    Returns
+    -------------
+    sweeps: dict(float -> pandas DataFrame)
+        the k-means sweep of each retained variance (see clustering.kmeans_sweep)
     """
+    import matplotlib.pyplot as plt
+
+    x_scaled = x
     if(sample):
+        assert(y is not None), 'The labels y are needed to subsample the healthy class'
+        rng = np.random if random_state is None else np.random.RandomState(random_state)
         # we split our x into two populations
-        vec_healthy = x_scaled[y_binary == 0]
-        vec_sick = x_scaled[y_binary == 1]
+        vec_healthy = x_scaled[y == 0]
+        vec_sick = x_scaled[y == 1]
         n_sick = len(vec_sick)
 
         # we select as many random indices from vec_healthy as we have routers that are sick
-        sampled_indices = np.random.choice(len(vec_healthy), size=n_sick)
+        sampled_indices = rng.choice(len(vec_healthy), size=n_sick)
 
         sample_healthy = vec_healthy[sampled_indices]
         x_scaled = np.vstack((sample_healthy,vec_sick))
 
+    projection, explained_variance_ratio = scripts.clustering.fit_pca_once(x_scaled, max(list_retained_var), cache_dir=cache_dir,
+                                                                           random_state=random_state)
+
     # setup the figure
     plt.figure(figsize=(23,10))
-    color = iter(cm.rainbow(np.linspace(0,1,len(list_retained_var))))
+    color = iter(plt.cm.rainbow(np.linspace(0,1,len(list_retained_var))))
     plt.xticks(list_cluster_numbers)
     plt.xlabel('Number of clusters (k)')
     plt.ylabel('Silhouette average score')
     plt.title('Silhouette score w.r.t the # of clusters for different retained variance')
 
+    sweeps = {}
     for i,var in enumerate(list_retained_var):
-        pca = PCA(var)
-        X = pca.fit_transform(x_scaled)
-        sc = []
-
-        for k in list_cluster_numbers:
-            k_mean = sklearn.cluster.MiniBatchKMeans(n_clusters=k, batch_size=1000)
-            k_mean.fit(X)
-            silhouette_avg = metrics.silhouette_score(X, k_mean.labels_, sample_size=1000)
-            sc.append(silhouette_avg)
+        X = scripts.clustering.project_retained_variance(projection, explained_variance_ratio, var)
+        sweeps[var] = scripts.clustering.kmeans_sweep(X, list_cluster_numbers, sample_size=1000, n_jobs=n_jobs, random_state=random_state)
 
         c = next(color)
-        plt.plot(list_cluster_numbers,sc,c=c,label='retained var = {}'.format(var))
+        plt.plot(list_cluster_numbers,sweeps[var].silhouette.values,c=c,label='retained var = {}'.format(var))
 
     plt.legend()
-    plt.show()
\ No newline at end of file
+    plt.show()
+    return sweeps
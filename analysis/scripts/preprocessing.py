@@ -11,11 +11,6 @@ __status__ = "Prototype"
 
 import pandas as pd
 import numpy as np
-import sklearn
-
-from scripts.utils import *
-from scripts.model_selection import *
-from scripts.plot import *
 
 ### --------------------------------------------------------------------------------------------
 ### ----------------------------------------Data preprocessing----------------------------------
@@ -78,11 +73,36 @@ def impute_missing(feature_vec_df,method = 'zero'):
     if(method == 'zero'):
         return feature_vec_df.fillna(0)
     elif(method in ['mean','median']):
+        # sklearn is only needed (and imported) for these imputation strategies
+        import sklearn.preprocessing
         imputer = sklearn.preprocessing.Imputer(strategy=method)
         values_no_missing = imputer.fit_transform(feature_vec_df.values)
         return pd.DataFrame(values_no_missing, columns = feature_vec_df.columns)
 
-def remove_features(x,verbose = True):
+def get_removed_features():
+    """
+    Returns the list of features spotted in the initial analysis as duplicated or highly 
+    correlated with another one (the column plan applied by remove_features).
+
+    Returns
+    -------------
+    to_drop: list(str)
+        the names of the columns to drop
+    """
+    suffixes_non_miss = ['','_6h','_12h','_18h','_1d','_2d','_3d','_4d','_5d']
+    suffixes_miss = ['','_6h','_12h','_18h','_24h','_2d','_3d','_4d','_5d']
+
+    to_drop = ['cmts_ms_utilization_up' + s for s in suffixes_non_miss] + \
+                        ['miss_pct_traffic_sdmh_up' + s for s in suffixes_miss] + \
+                        ['miss_rx_dn' + s for s in suffixes_miss] + \
+                        ['miss_tx_up' + s for s in suffixes_miss] + \
+                        ['miss_snr_up' + s for s in suffixes_miss]
+    to_drop = to_drop + ['miss_cer_dn_1d','miss_cer_up_1d','miss_pct_traffic_dmh_up_1d',
+        'miss_pct_traffic_sdmh_up_1d','miss_rx_dn_1d','miss_rx_up_1d','miss_snr_dn_1d',
+        'miss_snr_up_1d','miss_tx_up_1d']
+    return to_drop
+
+def remove_features(x,verbose = True,to_drop = None):
     """
     In order to remove the features spotted in the initial analysis as duplicated 
     or highly correlated with another one.
@@ -94,30 +114,24 @@ def remove_features(x,verbose = True):
         that have been identified as highly correlated
     verbose: boolean, default True
         can be set to false if we do not want to print the proportion of features deleted
+    to_drop: list(str), optional
+        the columns to drop (e.g. the plan stored with a model artifact), 
+        get_removed_features() if not set
 
     Returns
     -------------
     df: pandas Dataframe
         where features have been dropped
     """
-    suffixes_non_miss = ['','_6h','_12h','_18h','_1d','_2d','_3d','_4d','_5d']
-    suffixes_miss = ['','_6h','_12h','_18h','_24h','_2d','_3d','_4d','_5d']
-
-    to_drop = ['cmts_ms_utilization_up' + s for s in suffixes_non_miss] + \
-                        ['miss_pct_traffic_sdmh_up' + s for s in suffixes_miss] + \
-                        ['miss_rx_dn' + s for s in suffixes_miss] + \
-                        ['miss_tx_up' + s for s in suffixes_miss] + \
-                        ['miss_snr_up' + s for s in suffixes_miss]
-    to_drop = to_drop + ['miss_cer_dn_1d','miss_cer_up_1d','miss_pct_traffic_dmh_up_1d',
-        'miss_pct_traffic_sdmh_up_1d','miss_rx_dn_1d','miss_rx_up_1d','miss_snr_dn_1d',
-        'miss_snr_up_1d','miss_tx_up_1d']
+    if(to_drop is None):
+        to_drop = get_removed_features()
     if(verbose):
         deleted = len(to_drop)
         p = 100*deleted/len(x.columns)
         print('Deleting {} features ({:.3f}%).'.format(deleted,p))
     return  x.drop(labels=to_drop,axis=1)
 
-def get_balanced_classes(x,y_binary):
+def get_balanced_classes(x,y_binary,random_state=None):
     """
     In order to balance the dataset. Will return a randomly shuffled subsample 
     of the dataset that subsamples the positive class (healthy)
@@ -128,6 +142,8 @@ def get_balanced_classes(x,y_binary):
         the input data
     y_binary: numpy ndarray
         binary targets
+    random_state: int, optional
+        seed of the subsample and of the shuffling (the same seed gives the same balanced data)
 
     Returns
     -------------
@@ -137,17 +153,18 @@ def get_balanced_classes(x,y_binary):
         shuffled subsample of the targets
 
     """
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
     vec_healthy = x[y_binary == 0]
     vec_sick = x[y_binary == 1]
     n_sick = len(vec_sick)
 
     # we select as many random indices from vec_healthy as we have routers that are sick
-    sampled_indices = np.random.choice(len(vec_healthy), size=n_sick)
+    sampled_indices = rng.choice(len(vec_healthy), size=n_sick)
 
     sample_healthy = vec_healthy[sampled_indices]
     x_s = np.vstack((sample_healthy,vec_sick))
     y_s = np.vstack((np.zeros(n_sick).reshape(-1,1),np.ones(n_sick).reshape(-1,1)))
-    shuffled_indices = np.random.permutation(len(x_s))
+    shuffled_indices = rng.permutation(len(x_s))
     return x_s[shuffled_indices],y_s[shuffled_indices]
 
 ### --------------------------------------------------------------------------------------------
@@ -267,7 +284,7 @@ def find_correlation(data, threshold=0.9):
     """
     corr_mat = data.corr().apply(lambda x:abs(x))
     # we keep only the upper triangle
-    corr_mat = corr_mat.where(np.triu(np.ones(corr_mat.shape), k=1).astype(np.bool))
+    corr_mat = corr_mat.where(np.triu(np.ones(corr_mat.shape), k=1).astype(bool))
     correlated_lists = {}
     identical_lists = {}
     result = []
@@ -300,6 +317,8 @@ def compare_candidate_identical(principal,secondaries,suffixes,data):
     data: pandas DataFrame 
         into which resides the data (where all the previous column are present)
     """
+    from scripts.plot import look_at_joint_dist
+
     clique = {}
     for s in suffixes:
         clique[principal+s] = set([x + s for x in secondaries])
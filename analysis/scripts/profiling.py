@@ -0,0 +1,689 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing the feature profiles: each ingested day is summarised once, for each class,
+    in mergeable sketches of every column (counts, missing values, moments, top values, number
+    of distinct values and quantiles). The profile of a sample is stored next to its data cache, the sketches of any
+    set of days, classes or of the weekdays/weekends are then obtained by merging those of the
+    days instead of rescanning the vectors, e.g. (from the analysis folder):
+
+        df = import_sample('Data/sample_27_04.xlsx', 'Data/sample_27_04.pk')
+        profile = get_sample_profile(df, 'Data/sample_27_04.pk')
+        week, weekend = select_sketch(profile, period='week'), select_sketch(profile, period='weekend')
+        sketch_ks_test(week, weekend, profile['columns'])
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from scripts.preprocessing import convert_to_binary_labels
+from scripts.energy_test_DP import compute_ks_energy_block
+
+# the columns of the samples that are not profiled (identifiers, dates and labels)
+NON_PROFILED_COLS = ['mac','day_0','cly_account_number','saa_account_number',
+                     'seq_id','milestone_name','weekday']
+
+# the week days (as given by day_0.dt.weekday) of the weekends
+WEEKEND_DAYS = [5, 6]
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Distinct values-------------------------------------
+### --------------------------------------------------------------------------------------------
+def hash_values(values):
+    """
+    Hashes float values to 64 bits (splitmix64 finalizer of their binary representation, -0.0
+    being hashed as 0.0)
+
+    Parameters
+    -------------
+    values: numpy ndarray
+
+    Returns
+    -------------
+    h: numpy ndarray (uint64)
+    """
+    h = (np.asarray(values, dtype=np.float64) + 0.0).view(np.uint64)
+    h = (h ^ (h >> np.uint64(30)))*np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27)))*np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+def build_distinct_registers(values, precision=10):
+    """
+    Builds the HyperLogLog registers of a set of values: the first precision bits of the hash of
+    a value select a register, which keeps the largest rank of the first set bit of the remaining
+    bits. The registers of disjoint sets are merged with their maximum.
+
+    Parameters
+    -------------
+    values: numpy ndarray
+        the (non missing) values
+    precision: int, default 10
+        the log2 of the number of registers (the relative error of the estimate is 1.04/sqrt(2**precision))
+
+    Returns
+    -------------
+    registers: numpy ndarray (uint8)
+    """
+    registers = np.zeros(2**precision, dtype=np.uint8)
+    if(len(values) == 0):
+        return registers
+    h = hash_values(values)
+    bits = 64 - precision
+    index = (h >> np.uint64(bits)).astype(np.intp)
+    rest = h & np.uint64(2**bits - 1)
+    # rest lies in [2**(e-1), 2**e[ and its first set bit has rank bits - e + 1
+    _, exponent = np.frexp(rest.astype(np.float64))
+    rank = np.where(rest == 0, bits + 1, bits - exponent + 1)
+    np.maximum.at(registers, index, rank.astype(np.uint8))
+    return registers
+
+def estimate_distinct(registers):
+    """
+    HyperLogLog estimate of the number of distinct values from registers (with the linear counting
+    correction of the small cardinalities)
+
+    Parameters
+    -------------
+    registers: numpy ndarray
+        d by m registers of d columns (see build_distinct_registers)
+
+    Returns
+    -------------
+    n_distinct: numpy ndarray
+    """
+    m = registers.shape[-1]
+    alpha = 0.7213/(1 + 1.079/m)
+    estimate = alpha*m*m/np.sum(2.0**-registers.astype(np.float64), axis=-1)
+    n_zeros = (registers == 0).sum(axis=-1)
+    with np.errstate(divide='ignore'):
+        linear = m*np.log(m/np.maximum(n_zeros, 1))
+    return np.where((estimate <= 2.5*m) & (n_zeros > 0), linear, estimate)
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Sketches--------------------------------------------
+### --------------------------------------------------------------------------------------------
+def build_sketch(x, n_quantiles=100, max_values=100, hll_precision=10):
+    """
+    Summarises each column of a set of vectors in a mergeable sketch.
+
+    Parameters
+    -------------
+    x: numpy ndarray
+        n by d array of the vectors (the missing values are NaN)
+    n_quantiles: int, default 100
+        the number of quantiles kept for each column
+    max_values: int, default 100
+        the number of most frequent values kept (with their counts) for each column
+    hll_precision: int, default 10
+        the log2 of the number of HyperLogLog registers of each column (see build_distinct_registers)
+
+    Returns
+    -------------
+    sketch: dict
+        'n_rows', and for each column: 'count' (non missing values), 'n_missing', 'sum', 'sum_sq',
+        'min', 'max', 'quantiles' (n_quantiles by d), 'values' (list of (values, counts) sorted by
+        decreasing counts), 'complete' (True when every distinct value is in 'values'), 'n_distinct'
+        (the number of distinct values) and 'distinct_registers' (d by 2**hll_precision)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    missing = np.isnan(x)
+    count = len(x) - missing.sum(axis=0)
+    filled = np.where(missing, 0, x)
+    has_values = count > 0
+
+    minimum = np.full(x.shape[1], np.nan)
+    maximum = np.full(x.shape[1], np.nan)
+    quantiles = np.full((n_quantiles, x.shape[1]), np.nan)
+    if(has_values.any()):
+        levels = (np.arange(n_quantiles) + 0.5)/n_quantiles
+        minimum[has_values] = np.nanmin(x[:,has_values], axis=0)
+        maximum[has_values] = np.nanmax(x[:,has_values], axis=0)
+        quantiles[:,has_values] = np.nanquantile(x[:,has_values], levels, axis=0)
+
+    values = []
+    complete = np.ones(x.shape[1], dtype=bool)
+    n_distinct = np.zeros(x.shape[1])
+    registers = np.zeros((x.shape[1], 2**hll_precision), dtype=np.uint8)
+    for j in range(x.shape[1]):
+        distinct, counts = np.unique(x[~missing[:,j],j], return_counts=True)
+        order = np.argsort(-counts, kind='stable')[:max_values]
+        values.append((distinct[order], counts[order]))
+        complete[j] = len(distinct) <= max_values
+        n_distinct[j] = len(distinct)
+        registers[j] = build_distinct_registers(distinct, hll_precision)
+
+    return {'n_rows': len(x),
+            'count': count,
+            'n_missing': missing.sum(axis=0),
+            'sum': filled.sum(axis=0),
+            'sum_sq': (filled**2).sum(axis=0),
+            'min': minimum,
+            'max': maximum,
+            'quantiles': quantiles,
+            'values': values,
+            'complete': complete,
+            'n_distinct': n_distinct,
+            'distinct_registers': registers}
+
+def merge_quantiles(quantiles_list, counts_list, n_quantiles):
+    """
+    Merges quantile sketches: the quantiles of each sketch are used as points weighted by the
+    number of values they summarise and the quantiles of the pooled points are interpolated.
+
+    Parameters
+    -------------
+    quantiles_list: list(numpy ndarray)
+        the quantiles (n_quantiles by d) of each sketch
+    counts_list: list(numpy ndarray)
+        the number of values of each column in each sketch
+    n_quantiles: int
+        the number of quantiles of the merged sketch
+
+    Returns
+    -------------
+    quantiles: numpy ndarray
+        n_quantiles by d
+    """
+    levels = (np.arange(n_quantiles) + 0.5)/n_quantiles
+    points = np.concatenate(quantiles_list)
+    weights = np.concatenate([np.broadcast_to(c/len(q), q.shape) for q, c in zip(quantiles_list, counts_list)])
+    quantiles = np.full((n_quantiles, points.shape[1]), np.nan)
+    for j in range(points.shape[1]):
+        keep = (weights[:,j] > 0) & ~np.isnan(points[:,j])
+        if(not keep.any()):
+            continue
+        order = np.argsort(points[keep,j])
+        p = points[keep,j][order]
+        w = weights[keep,j][order]
+        # each point sits at the middle of the mass it represents
+        cdf = (np.cumsum(w) - w/2)/w.sum()
+        quantiles[:,j] = np.interp(levels, cdf, p)
+    return quantiles
+
+def merge_sketches(sketches, max_values=100):
+    """
+    Merges the sketches of disjoint sets of vectors having the same columns. Counts, missing
+    values, moments and extrema are merged exactly, so are the values (and their number) of the
+    columns that stay complete (at most max_values distinct values). For the other columns the
+    counts of the values are lower bounds (a value may have been dropped from the top values of
+    some sketches) and the number of distinct values is estimated from the merged HyperLogLog
+    registers, the quantiles are approximated (see merge_quantiles).
+
+    Parameters
+    -------------
+    sketches: list(dict)
+        the sketches to merge (see build_sketch)
+    max_values: int, default 100
+        the number of most frequent values kept for each column
+
+    Returns
+    -------------
+    sketch: dict
+    """
+    if(len(sketches) == 1):
+        return sketches[0]
+    n_quantiles = sketches[0]['quantiles'].shape[0]
+
+    merged = {'n_rows': sum(s['n_rows'] for s in sketches)}
+    for key in ['count', 'n_missing', 'sum', 'sum_sq']:
+        merged[key] = np.sum([s[key] for s in sketches], axis=0)
+    merged['min'] = np.fmin.reduce([s['min'] for s in sketches])
+    merged['max'] = np.fmax.reduce([s['max'] for s in sketches])
+    merged['quantiles'] = merge_quantiles([s['quantiles'] for s in sketches], [s['count'] for s in sketches], n_quantiles)
+
+    values = []
+    complete = np.ones(len(merged['count']), dtype=bool)
+    n_distinct = np.zeros(len(merged['count']))
+    for j in range(len(merged['count'])):
+        distinct, inverse = np.unique(np.concatenate([s['values'][j][0] for s in sketches]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([s['values'][j][1] for s in sketches])).astype(np.int64)
+        order = np.argsort(-counts, kind='stable')[:max_values]
+        values.append((distinct[order], counts[order]))
+        complete[j] = all(s['complete'][j] for s in sketches) and len(distinct) <= max_values
+        n_distinct[j] = len(distinct)
+    merged['values'] = values
+    merged['complete'] = complete
+    merged['distinct_registers'] = np.maximum.reduce([s['distinct_registers'] for s in sketches])
+    # the estimate can not be lower than the number of values seen in one of the sketches
+    estimate = np.fmax(estimate_distinct(merged['distinct_registers']), np.max([s['n_distinct'] for s in sketches], axis=0))
+    merged['n_distinct'] = np.where(complete, n_distinct, np.maximum(estimate, n_distinct))
+    return merged
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Profiles--------------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_profiled_columns(df):
+    """
+    Returns the columns of a sample (as returned by import_sample) that are profiled: the numeric
+    and categorical columns that are not identifiers, dates or labels
+
+    Parameters
+    -------------
+    df: pandas DataFrame
+
+    Returns
+    -------------
+    columns: list(str)
+    """
+    return [c for c in df.columns if c not in NON_PROFILED_COLS
+            and (pd.api.types.is_numeric_dtype(df[c]) or isinstance(df[c].dtype, pd.CategoricalDtype))]
+
+def get_profile_values(df, columns):
+    """
+    Returns the values of the profiled columns as a float array (the categories by their value,
+    or by their code when they are not numeric)
+
+    Parameters
+    -------------
+    df: pandas DataFrame
+    columns: list(str)
+
+    Returns
+    -------------
+    x: numpy ndarray
+    """
+    x = np.empty((len(df), len(columns)))
+    for j, c in enumerate(columns):
+        serie = df[c]
+        if(isinstance(serie.dtype, pd.CategoricalDtype) and not pd.api.types.is_numeric_dtype(serie.cat.categories)):
+            codes = serie.cat.codes.values.astype(np.float64)
+            codes[codes < 0] = np.nan
+            x[:,j] = codes
+        else:
+            x[:,j] = pd.to_numeric(pd.Series(np.asarray(serie, dtype=object)), errors='coerce').values
+    return x
+
+def update_profile(profile, df, verbose=True):
+    """
+    Adds to a profile the sketches of the days of a sample that it does not contain yet (the days
+    already profiled are not rescanned)
+
+    Parameters
+    -------------
+    profile: dict
+        the profile to update in place (see build_profile)
+    df: pandas DataFrame
+        the sample (as returned by import_sample)
+    verbose: boolean, default True
+        can be set to False to not print the number of new days
+
+    Returns
+    -------------
+    n_new_days: int
+    """
+    days = df['day_0'].values
+    classes = convert_to_binary_labels(df['milestone_name'])
+    new_days = [d for d in np.unique(days) if pd.Timestamp(d) not in profile['days']]
+    if(len(new_days) != 0):
+        x = get_profile_values(df, profile['columns'])
+        for day in new_days:
+            in_day = days == day
+            profile['days'][pd.Timestamp(day)] = {c: build_sketch(x[in_day & (classes == c)], profile['n_quantiles'], profile['max_values'])
+                                                 for c in [0, 1]}
+    if(verbose):
+        print('Profiled {} new days ({} in total)'.format(len(new_days), len(profile['days'])))
+    return len(new_days)
+
+def build_profile(df, n_quantiles=100, max_values=100, columns=None, verbose=True):
+    """
+    Builds the profile of a sample: the sketch of every (day, class) pair
+
+    Parameters
+    -------------
+    df: pandas DataFrame
+        the sample (as returned by import_sample)
+    n_quantiles: int, default 100
+        the number of quantiles kept for each column
+    max_values: int, default 100
+        the number of most frequent values kept for each column
+    columns: list(str), optional
+        the profiled columns (see get_profiled_columns if not set)
+    verbose: boolean, default True
+
+    Returns
+    -------------
+    profile: dict
+        'columns', 'n_quantiles', 'max_values' and 'days' mapping each day to the sketches of
+        its healthy (0) and sick (1) vectors
+    """
+    profile = {'columns': list(columns) if columns is not None else get_profiled_columns(df),
+               'n_quantiles': n_quantiles,
+               'max_values': max_values,
+               'days': {}}
+    update_profile(profile, df, verbose)
+    return profile
+
+def get_profile_path(dump_file_path):
+    """
+    Returns the path of the profile stored next to a data cache (e.g. 'Data/sample_27_04_sick_only.pk'
+    is profiled in 'Data/sample_27_04_sick_only_profile.pk')
+
+    Parameters
+    -------------
+    dump_file_path: str
+
+    Returns
+    -------------
+    profile_path: str
+    """
+    return os.path.splitext(dump_file_path)[0] + '_profile.pk'
+
+def save_profile(profile, path):
+    """
+    Saves a profile (pickled)
+
+    Parameters
+    -------------
+    profile: dict
+    path: str
+    """
+    print('Saving to ' + path)
+    with open(path, 'wb') as handle:
+        pickle.dump(profile, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_profile(path):
+    """
+    Loads a profile saved by save_profile
+
+    Parameters
+    -------------
+    path: str
+
+    Returns
+    -------------
+    profile: dict
+    """
+    print('Retrieving from ' + path)
+    with open(path, 'rb') as handle:
+        return pickle.load(handle)
+
+def get_sample_profile(df, dump_file_path, n_quantiles=100, max_values=100):
+    """
+    Returns the profile of a sample stored next to its data cache: it is loaded if it exists and
+    only the days that were not profiled yet are sketched (the profile is then saved again).
+
+    Parameters
+    -------------
+    df: pandas DataFrame
+        the sample (as returned by import_sample)
+    dump_file_path: str
+        the data cache of the sample (or any path next to which the profile is stored)
+    n_quantiles: int, default 100
+        the number of quantiles kept for each column of a new profile
+    max_values: int, default 100
+        the number of most frequent values kept for each column of a new profile
+
+    Returns
+    -------------
+    profile: dict
+    """
+    path = get_profile_path(dump_file_path)
+    profile = load_profile(path) if os.path.isfile(path) else None
+    # the profiles saved before the sketches counted the distinct values are rebuilt
+    if(profile is not None and all('n_distinct' in s for sketches in profile['days'].values() for s in sketches.values())):
+        if(update_profile(profile, df) != 0):
+            save_profile(profile, path)
+    else:
+        profile = build_profile(df, n_quantiles, max_values)
+        save_profile(profile, path)
+    return profile
+
+def select_sketch(profile, days=None, classes=(0, 1), period=None):
+    """
+    Merges the sketches of a profile for a selection of days and classes
+
+    Parameters
+    -------------
+    profile: dict
+        the profile (see build_profile)
+    days: list, optional
+        the days to merge (all days if not set)
+    classes: tuple(int), default (0, 1)
+        the classes to merge (0 for healthy, 1 for sick)
+    period: str, optional
+        'week' or 'weekend' to only keep the days of that period
+
+    Returns
+    -------------
+    sketch: dict
+    """
+    selected = sorted(profile['days']) if days is None else [pd.Timestamp(d) for d in days]
+    if(period is not None):
+        assert(period in ['week','weekend']), 'period must be one of week or weekend'
+        selected = [d for d in selected if (d.weekday() in WEEKEND_DAYS) == (period == 'weekend')]
+    assert(len(selected) != 0), 'No profiled day matches the selection'
+    return merge_sketches([profile['days'][d][c] for d in selected for c in classes], profile['max_values'])
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Queries---------------------------------------------
+### --------------------------------------------------------------------------------------------
+def sketch_summary(sketch, columns):
+    """
+    Summarises the columns of a sketch in a table
+
+    Parameters
+    -------------
+    sketch: dict
+    columns: list(str)
+        the columns of the sketch (profile['columns'])
+
+    Returns
+    -------------
+    summary_df: pandas DataFrame
+        count, missing rate, mean, std, min, median, max, most common value, its frequency (in %
+        of the non missing values, a lower bound when not complete) and number of distinct values 
+        (estimated when not complete)
+    """
+    count = np.maximum(sketch['count'], 1)
+    mean = sketch['sum']/count
+    median_row = sketch['quantiles'].shape[0]//2
+    return pd.DataFrame({'count': sketch['count'],
+                         'missing_rate': sketch['n_missing']/max(sketch['n_rows'], 1),
+                         'mean': mean,
+                         'std': np.sqrt(np.maximum(sketch['sum_sq']/count - mean**2, 0)),
+                         'min': sketch['min'],
+                         'median': sketch['quantiles'][median_row],
+                         'max': sketch['max'],
+                         'top_value': [v[0] if len(v) else np.nan for v,_ in sketch['values']],
+                         'top_freq': [100*c[0]/n if len(c) else np.nan for (_,c),n in zip(sketch['values'], count)],
+                         'n_distinct': np.round(sketch['n_distinct']).astype(np.int64),
+                         'complete': sketch['complete']},
+                        index=pd.Index(columns, name='measurement'))
+
+def sketch_cdf(sketch, j, points):
+    """
+    Empirical CDF of a column of a sketch at some points: exact when the column is complete,
+    interpolated between the quantiles (and the extrema) otherwise
+
+    Parameters
+    -------------
+    sketch: dict
+    j: int
+        the index of the column
+    points: numpy ndarray
+
+    Returns
+    -------------
+    cdf: numpy ndarray
+        the ratio of the non missing values lower or equal to each point
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if(sketch['count'][j] == 0):
+        return np.zeros(len(points))
+    if(sketch['complete'][j]):
+        values, counts = sketch['values'][j]
+        order = np.argsort(values)
+        cumulated = np.concatenate([[0], np.cumsum(counts[order])])
+        return cumulated[np.searchsorted(values[order], points, side='right')]/sketch['count'][j]
+    n_quantiles = sketch['quantiles'].shape[0]
+    levels = np.concatenate([[0], (np.arange(n_quantiles) + 0.5)/n_quantiles, [1]])
+    knots = np.concatenate([[sketch['min'][j]], sketch['quantiles'][:,j], [sketch['max'][j]]])
+    return np.interp(points, knots, levels, left=0, right=1)
+
+def sketch_histogram(sketch, j, edges):
+    """
+    Number of values of a column of a sketch in each bin (exact when the column is complete)
+
+    Parameters
+    -------------
+    sketch: dict
+    j: int
+        the index of the column
+    edges: numpy ndarray
+        the edges of the bins
+
+    Returns
+    -------------
+    counts: numpy ndarray
+    """
+    if(sketch['complete'][j]):
+        values, counts = sketch['values'][j]
+        return np.histogram(values, bins=edges, weights=counts)[0]
+    cdf = sketch_cdf(sketch, j, edges)
+    # the first bin also contains its left edge as in np.histogram
+    cdf[0] = sketch_cdf(sketch, j, [np.nextafter(edges[0], -np.inf)])[0]
+    return np.diff(cdf)*sketch['count'][j]
+
+def sketch_central_range(sketches, j, ratio_pop_show=0.9):
+    """
+    Interval containing the central ratio_pop_show of the values of a column in every sketch
+    (counterpart of aggregation.get_central_range)
+
+    Parameters
+    -------------
+    sketches: list(dict)
+    j: int
+        the index of the column
+    ratio_pop_show: float, default 0.9
+
+    Returns
+    -------------
+    lower, upper: float
+    """
+    lower_quantile = (1-ratio_pop_show)/2
+    upper_quantile = 1-lower_quantile
+    bounds = []
+    for s in sketches:
+        n_quantiles = s['quantiles'].shape[0]
+        levels = np.concatenate([[0], (np.arange(n_quantiles) + 0.5)/n_quantiles, [1]])
+        knots = np.concatenate([[s['min'][j]], s['quantiles'][:,j], [s['max'][j]]])
+        bounds.append(np.interp([lower_quantile, upper_quantile], levels, knots))
+    return min(b[0] for b in bounds), max(b[1] for b in bounds)
+
+def sketch_class_histograms(sick_sketch, healthy_sketch, j, n_bins=10):
+    """
+    Counterpart of aggregation.class_histograms computed from the sketches of each class
+
+    Parameters
+    -------------
+    sick_sketch, healthy_sketch: dict
+    j: int
+        the index of the column
+    n_bins: int, default 10
+
+    Returns
+    -------------
+    cnt: pandas DataFrame
+        the percentage of each class ('sick' and 'healthy') in each bin, indexed by the bins
+    """
+    lower = np.fmin(sick_sketch['min'][j], healthy_sketch['min'][j])
+    upper = np.fmax(sick_sketch['max'][j], healthy_sketch['max'][j])
+    _, edges = pd.cut(np.array([lower, upper]), n_bins, include_lowest=True, retbins=True)
+    index = pd.IntervalIndex.from_breaks(np.round(edges, 3), closed='right')
+    # the outer edges are widened such that the extrema are counted
+    edges[0], edges[-1] = lower, upper
+    cnt = pd.DataFrame({'sick': sketch_histogram(sick_sketch, j, edges),
+                        'healthy': sketch_histogram(healthy_sketch, j, edges)}, index=index)
+    return cnt.apply(lambda x: round(100*x/max(x.sum(), 1), 3))
+
+def sketch_near_zero_var(sketch, columns, freqCut=99, ratioCut=95/5, uniqueCut=10):
+    """
+    Counterpart of preprocessing.nearZeroVar answered from a sketch. Everything is exact for the
+    complete columns. For the others (more than max_values distinct values) the number of distinct
+    values is the HyperLogLog estimate and, in merged sketches, the frequencies of the two most
+    common values are lower bounds (they are exact in the sketch of a single day)
+
+    Parameters
+    -------------
+    sketch: dict
+    columns: list(str)
+        the columns of the sketch (profile['columns'])
+    freqCut: int, default 99
+        freq of the most common value as a percentage of the number of samples
+    ratioCut: float, default 95/5
+        ratio of the most common value freq over the second most common over which we cut
+    uniqueCut:  int, default 10
+        ratio of unique values over the total number of all values
+
+    Returns
+    -------------
+    to_Return: list(str)
+        the list of columns that should be investigated
+    """
+    toReturn = []
+    for j, col in enumerate(columns):
+        _, counts = sketch['values'][j]
+        total = sketch['count'][j]
+        if(total == 0):
+            continue
+        most_common = 100*counts[0]/total
+        sec_most_common = 100*counts[1]/total if len(counts) > 1 else 0
+
+        r = most_common/sec_most_common if sec_most_common > 0 else np.inf
+        unique_perc = 100*sketch['n_distinct'][j]/total
+
+        if (most_common >= freqCut or (r >= ratioCut and unique_perc <= uniqueCut)):
+            toReturn.append(col)
+    return toReturn
+
+def sketch_ks_test(first, second, columns, measurements=None, with_miss_mes=True):
+    """
+    Counterpart of energy_test_DP.get_ks_test_result answered from the sketches of two populations,
+    it also gives the 1-D energy distance of each measurement. The statistics of the complete columns
+    are exact, those of the others are computed on their quantiles.
+
+    Parameters
+    -------------
+    first, second: dict
+        the sketches of the two populations
+    columns: list(str)
+        the columns of the sketches (profile['columns'])
+    measurements: list(str), optional
+        the list of columns that we wish to look at (all columns if not set)
+    with_miss_mes: boolean, default True
+        can be et to False to take out the Measurements that are prefixed by 'MISS' in the list of measurements
+
+    Returns
+    -------------
+    results_df: pandas Dataframe
+        KS statistic, p-value and energy distance of each measurement, sorted by increasing p-values
+    """
+    considered_mes = list(columns) if measurements is None else measurements
+    if(not with_miss_mes):
+        considered_mes = [x for x in considered_mes if not('MISS' in x)]
+    index = [list(columns).index(m) for m in considered_mes]
+
+    ks_statistics, energy_distances = compute_ks_energy_block(first['quantiles'][:,index], second['quantiles'][:,index])
+    for k, j in enumerate(index):
+        if(first['count'][j] == 0 or second['count'][j] == 0):
+            ks_statistics[k] = energy_distances[k] = np.nan
+        elif(first['complete'][j] and second['complete'][j]):
+            points = np.union1d(first['values'][j][0], second['values'][j][0])
+            gaps = sketch_cdf(first, j, points) - sketch_cdf(second, j, points)
+            ks_statistics[k] = np.abs(gaps).max()
+            energy_distances[k] = np.sqrt(2*np.sum(gaps[:-1]**2*np.diff(points)))
+
+    n1 = first['count'][index].astype(np.float64)
+    n2 = second['count'][index].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_values = stats.kstwo.sf(ks_statistics, np.round(n1*n2/(n1 + n2)))
+    result_df = pd.DataFrame({'statistic': ks_statistics, 'pvalue': p_values, 'energy_distance': energy_distances},
+                             index=pd.Index(considered_mes, name='measurement'))
+    return result_df.sort_values(by='pvalue',ascending=True)
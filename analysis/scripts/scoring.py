@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing the batch scoring of a day of vectors in production: the vectors are
+    streamed in chunks through the same preprocessing as usable_data and through the fitted
+    pipeline, and only the top predictions (the CPEs that should be serviced first) are kept.
+    It can be used as a command line tool, e.g. (from the analysis folder):
+
+        python -m scripts.scoring Data/model.pk Data/vectors_27_06.csv Data/ranked_27_06.csv --top-ratio 0.15
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import heapq
+import pickle
+import argparse
+import itertools
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from scripts.utils import transform_raw_sample, NON_FEATURE_COLS
+from scripts.preprocessing import encode_categorical, remove_features
+from scripts.model_artifact import load_model_artifact, is_model_artifact
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Model and data--------------------------------------
+### --------------------------------------------------------------------------------------------
+def load_model(model_path, columns_path = None):
+    """
+    Loads a fitted pipeline along with the order of the feature columns it was trained on, either 
+    from a model artifact (see model_artifact.py, the estimator is then memory mapped) or from a 
+    pickle saved from the notebooks.
+
+    Parameters
+    -------------
+    model_path: str
+        path to the artifact folder or to the pickle, it contains either a dict with keys 'model' 
+        and 'feature_columns' or directly the fitted pipeline (then columns_path must be given)
+    columns_path: str, optional
+        path to a text file giving the feature columns (one per line) in the training order
+
+    Returns
+    -------------
+    model: sklearn pipeline or model on which we can call predict_proba()
+        the fitted pipeline
+    feature_columns: list(str)
+        the columns of the feature vectors expected by the model
+    hw_models_2_id: dict(str -> int)
+        the hardware model indices used during training (None for pickles)
+    removed_features: list(str)
+        the column plan of remove_features (None for pickles)
+    """
+    if(is_model_artifact(model_path)):
+        artifact = load_model_artifact(model_path)
+        return artifact.model, artifact.feature_columns, artifact.hw_models_2_id, artifact.removed_features
+
+    with open(model_path, 'rb') as handle:
+        loaded = pickle.load(handle)
+
+    if(isinstance(loaded,dict)):
+        model = loaded['model']
+        feature_columns = loaded.get('feature_columns')
+    else:
+        model = loaded
+        feature_columns = None
+
+    if(columns_path is not None):
+        with open(columns_path) as handle:
+            feature_columns = [l.strip() for l in handle if l.strip()]
+    assert(feature_columns is not None), 'The order of the feature columns is unknown, please provide columns_path'
+    return model, list(feature_columns), None, None
+
+def iter_vector_chunks(source_path, chunk_size = 50000, day = None):
+    """
+    Iterates over the raw vectors of a source file in chunks of at most chunk_size rows. Csv
+    files are truly streamed, pickled dataframes and excel files are read at once and then sliced.
+
+    Parameters
+    -------------
+    source_path: str
+        the path to the vectors (.csv, .pk or .xlsx)
+    chunk_size: int, default 50000
+        the number of rows in each chunk
+    day: str, optional
+        if set, only the vectors having this day_0 are returned (e.g. '2018-06-27')
+
+    Returns
+    -------------
+    chunks: generator(pandas DataFrame)
+        the raw chunks (with their original column names)
+    """
+    if(source_path.endswith('.csv')):
+        chunks = pd.read_csv(source_path, chunksize = chunk_size)
+    else:
+        df = pd.read_pickle(source_path) if source_path.endswith('.pk') else pd.read_excel(source_path)
+        chunks = (df.iloc[i:i+chunk_size] for i in range(0, len(df), chunk_size))
+
+    for chunk in chunks:
+        if(day is not None):
+            day_col = [c for c in chunk.columns if c.lower() == 'day_0'][0]
+            chunk = chunk[pd.to_datetime(chunk[day_col],dayfirst = True) == pd.Timestamp(day)]
+        if(len(chunk) != 0):
+            yield chunk
+
+def count_vectors(source_path, day = None):
+    """
+    Counts the vectors of a source file without keeping them in memory, it is needed to
+    turn a top ratio into a number of predictions before streaming.
+
+    Parameters
+    -------------
+    source_path: str
+        the path to the vectors (.csv, .pk or .xlsx)
+    day: str, optional
+        if set, only the vectors having this day_0 are counted
+
+    Returns
+    -------------
+    n: int
+    """
+    if(source_path.endswith('.csv') and day is None):
+        with open(source_path, 'rb') as handle:
+            # we do not count the header
+            return sum(1 for _ in handle) - 1
+    return sum(len(c) for c in iter_vector_chunks(source_path, day = day))
+
+def prepare_chunk(raw_chunk, feature_columns, hw_models_2_id = None, removed_features = None):
+    """
+    Applies to a chunk of raw vectors the preprocessing of usable_data (transformations of
+    import_sample, encoding of the categorical features and removal of the features found to be
+    correlated) and aligns the result on the columns the model was trained on: dummy columns
+    that do not appear in the chunk (e.g. the other week days) are set to 0.
+
+    Parameters
+    -------------
+    raw_chunk: pandas DataFrame
+        raw vectors
+    feature_columns: list(str)
+        the columns of the feature vectors expected by the model
+    hw_models_2_id: dict(str -> int), optional
+        the hardware model indices used during training
+    removed_features: list(str), optional
+        the column plan of remove_features used during training
+
+    Returns
+    -------------
+    macs: numpy ndarray
+        the mac address of each vector
+    x: numpy ndarray
+        ML ready inputs
+    """
+    df = transform_raw_sample(raw_chunk.copy(), hw_models_2_id)
+    macs = df['mac'].values
+    features = df[[c for c in df.columns if c not in NON_FEATURE_COLS]]
+    x_df = remove_features(encode_categorical(features), verbose = False, to_drop = removed_features)
+    x_df = x_df.reindex(columns = feature_columns, fill_value = 0)
+    return macs, x_df.values.astype(np.float64)
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Scoring---------------------------------------------
+### --------------------------------------------------------------------------------------------
+def push_top_k(heap, k, macs, scores):
+    """
+    Keeps in heap (a min-heap of (score, mac)) the k highest scores seen so far.
+
+    Parameters
+    -------------
+    heap: list
+        the heap, updated in place
+    k: int
+        the maximum number of predictions to keep
+    macs: numpy ndarray
+        mac address of the new predictions
+    scores: numpy ndarray
+        probability to be sick of the new predictions
+    """
+    if(k <= 0):
+        return
+    # only the scores that can enter the heap are pushed
+    if(len(heap) >= k):
+        candidates = np.flatnonzero(scores > heap[0][0])
+    else:
+        candidates = np.arange(len(scores))
+    for i in candidates:
+        item = (float(scores[i]), str(macs[i]))
+        if(len(heap) < k):
+            heapq.heappush(heap, item)
+        elif(item > heap[0]):
+            heapq.heapreplace(heap, item)
+
+def score_day(model, feature_columns, source_path, top_ratio = None, top_k = None, chunk_size = 50000,
+              n_jobs = 4, day = None, hw_models_2_id = None, removed_features = None, verbose = True):
+    """
+    Streams the vectors of a day through the preprocessing and the model in chunks scored by
+    a pool of threads, and keeps the top predictions in a bounded heap such that the memory used
+    does not depend on the number of CPEs (only on the number of predictions returned). As in
+    get_metrics, the top_ratio predictions are the round(top_ratio*n) highest probabilities.
+
+    Parameters
+    -------------
+    model: sklearn pipeline or model on which we can call predict_proba()
+        the fitted pipeline
+    feature_columns: list(str)
+        the columns of the feature vectors expected by the model
+    source_path: str
+        the path to the vectors of the day (.csv, .pk or .xlsx)
+    top_ratio: float, optional
+        the ratio of top predictions to return (one of top_ratio or top_k must be set)
+    top_k: int, optional
+        the number of top predictions to return
+    chunk_size: int, default 50000
+        the number of vectors scored at once
+    n_jobs: int, default 4
+        the number of threads scoring chunks
+    day: str, optional
+        if set, only the vectors having this day_0 are scored
+    hw_models_2_id: dict(str -> int), optional
+        the hardware model indices used during training
+    removed_features: list(str), optional
+        the column plan of remove_features used during training
+    verbose: boolean, default True
+        can be set to False to not print the number of scored vectors and the execution time
+
+    Returns
+    -------------
+    ranked: pandas DataFrame
+        the top predictions ordered by decreasing probability (columns 'rank', 'mac', 'score')
+    """
+    assert((top_ratio is None) != (top_k is None)), 'Exactly one of top_ratio and top_k must be set'
+    start = timeit.default_timer()
+    if(top_k is None):
+        top_k = int(round(top_ratio*count_vectors(source_path, day)))
+
+    def score_chunk(raw_chunk):
+        macs, x = prepare_chunk(raw_chunk, feature_columns, hw_models_2_id, removed_features)
+        return macs, model.predict_proba(x)[:, 1]
+
+    heap = []
+    n_scored = 0
+    chunks = iter_vector_chunks(source_path, chunk_size, day)
+    with ThreadPoolExecutor(max_workers = n_jobs) as executor:
+        # at most 2*n_jobs chunks are in memory at the same time
+        pending = [executor.submit(score_chunk, c) for c in itertools.islice(chunks, 2*n_jobs)]
+        while(len(pending) != 0):
+            macs, scores = pending.pop(0).result()
+            n_scored += len(scores)
+            push_top_k(heap, top_k, macs, scores)
+            for c in itertools.islice(chunks, 1):
+                pending.append(executor.submit(score_chunk, c))
+
+    ranked = sorted(heap, reverse = True)
+    ranked = pd.DataFrame({'rank': np.arange(1, len(ranked) + 1),
+                           'mac': [m for _, m in ranked],
+                           'score': [s for s, _ in ranked]})
+    if(verbose):
+        print('Scored {} vectors, kept the top {} ({}s)'.format(n_scored, len(ranked), round(timeit.default_timer() - start, 4)))
+    return ranked
+
+def main(argv = None):
+    """
+    Command line entry point, see the module documentation or --help
+    """
+    parser = argparse.ArgumentParser(description = 'Ranks the CPEs of a day by their probability to be sick.')
+    parser.add_argument('model', help = 'model artifact folder or pickled fitted pipeline (or dict with model and feature_columns)')
+    parser.add_argument('source', help = 'vectors of the day (.csv is streamed, .pk or .xlsx)')
+    parser.add_argument('output', help = 'csv file where the ranked mac list is written')
+    parser.add_argument('--columns', default = None, help = 'text file with the feature columns of the model')
+    group = parser.add_mutually_exclusive_group(required = True)
+    group.add_argument('--top-ratio', type = float, default = None)
+    group.add_argument('--top-k', type = int, default = None)
+    parser.add_argument('--day', default = None, help = 'only score the vectors of this day_0 (YYYY-MM-DD)')
+    parser.add_argument('--chunk-size', type = int, default = 50000)
+    parser.add_argument('--n-jobs', type = int, default = 4)
+    args = parser.parse_args(argv)
+
+    model, feature_columns, hw_models_2_id, removed_features = load_model(args.model, args.columns)
+    ranked = score_day(model, feature_columns, args.source, args.top_ratio, args.top_k,
+                       args.chunk_size, args.n_jobs, args.day, hw_models_2_id, removed_features)
+    ranked.to_csv(args.output, index = False)
+    print('Saving to ' + args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing a small local HTTP service to score CPEs on demand (e.g. when a call
+    centre agent asks whether a modem is about to fail). The fitted pipeline is loaded once and
+    the concurrent requests are gathered into micro-batches before calling predict_proba. The
+    vectors go through the same preprocessing as the batch scoring (see scoring.prepare_chunk).
+    It can be started from the analysis folder with:
+
+        python -m scripts.scoring_service Data/model.pk --port 8080
+
+    and exposes:
+        * POST /score   body {"vectors": [raw vector, ...]} (or a single raw vector), where a raw
+                        vector maps the columns of the samples (mac, day_0, hardware_model, ...)
+                        to their value, returns {"scores": [{"mac": ..., "score": ...}, ...]}
+        * GET /metrics  latency percentiles (p50/p99 in ms) and batch size statistics
+
+    The vectors of a request are validated before joining a micro-batch and a malformed request
+    is answered with 400 without failing the other requests of its batch. Bodies larger than
+    max_body_bytes are refused with 413.
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import json
+import asyncio
+import argparse
+import collections
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from scripts.scoring import load_model, prepare_chunk
+
+# the raw columns that transform_raw_sample needs to build a vector
+REQUIRED_RAW_COLS = ['mac', 'day_0', 'hardware_model']
+# the largest request body that is read (10 MB is about 20000 raw vectors)
+MAX_BODY_BYTES = 10*1024*1024
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Micro-batching--------------------------------------
+### --------------------------------------------------------------------------------------------
+class MicroBatchScorer(object):
+    """
+    Gathers the vectors of concurrent requests into batches of at most max_batch_size vectors
+    (waiting at most max_wait_ms after the first one) that are scored at once in a worker
+    thread, such that the event loop keeps accepting requests while a batch is scored.
+
+    Parameters
+    -------------
+    model: sklearn pipeline or model on which we can call predict_proba()
+        the fitted pipeline
+    feature_columns: list(str)
+        the columns of the feature vectors expected by the model
+    max_batch_size: int, default 256
+        the maximum number of vectors scored at once
+    max_wait_ms: float, default 5
+        the maximum time a vector waits for others to fill its batch
+    hw_models_2_id: dict(str -> int), optional
+        the hardware model indices used during training
+    removed_features: list(str), optional
+        the column plan of remove_features used during training
+    n_latencies: int, default 10000
+        the number of last request latencies kept to compute the percentiles
+    """
+    def __init__(self, model, feature_columns, max_batch_size = 256, max_wait_ms = 5, hw_models_2_id = None,
+                 removed_features = None, n_latencies = 10000):
+        self.model = model
+        self.feature_columns = feature_columns
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000
+        self.hw_models_2_id = hw_models_2_id
+        self.removed_features = removed_features
+        self.queue = None
+        self.latencies = collections.deque(maxlen = n_latencies)
+        self.batch_sizes = collections.deque(maxlen = n_latencies)
+        self.n_requests = 0
+        self.n_vectors = 0
+
+    def validate(self, vectors):
+        """
+        Checks that a request holds a non-empty list of raw vectors carrying the required raw
+        columns, a valid day_0 and numeric (or null) values for the features of the model, such
+        that a malformed request is refused before it is batched with others.
+
+        Parameters
+        -------------
+        vectors: list(dict)
+            the raw vectors of a request
+
+        Raises
+        -------------
+        ValueError
+            describing the first problem found
+        """
+        if(not isinstance(vectors, list) or len(vectors) == 0):
+            raise ValueError('expected a non-empty list of vectors')
+        numeric_cols = set(self.feature_columns)
+        for i,vector in enumerate(vectors):
+            if(not isinstance(vector, dict)):
+                raise ValueError('vector {} is not an object'.format(i))
+            vector = {str(k).lower(): v for k,v in vector.items()}
+            missing = [c for c in REQUIRED_RAW_COLS if vector.get(c) is None]
+            if(len(missing) != 0):
+                raise ValueError('vector {} misses {}'.format(i, missing))
+            if(pd.isnull(pd.to_datetime(vector['day_0'], dayfirst = True, errors = 'coerce'))):
+                raise ValueError('vector {} has an invalid day_0 {!r}'.format(i, vector['day_0']))
+            for k,v in vector.items():
+                if(k in numeric_cols and v is not None and (isinstance(v, bool) or not isinstance(v, (int, float)))):
+                    raise ValueError('vector {} has a non numeric value for {}: {!r}'.format(i, k, v))
+
+    def score_batch(self, vectors):
+        """
+        Scores a list of raw vectors (called in a worker thread)
+
+        Parameters
+        -------------
+        vectors: list(dict)
+            the raw vectors
+
+        Returns
+        -------------
+        macs: numpy ndarray
+        scores: numpy ndarray
+        """
+        macs, x = prepare_chunk(pd.DataFrame(vectors), self.feature_columns, self.hw_models_2_id, self.removed_features)
+        return macs, self.model.predict_proba(x)[:, 1]
+
+    async def run(self):
+        """
+        Batching loop, it must run as a task of the event loop serving the requests
+        """
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_event_loop()
+        while(True):
+            pending = [await self.queue.get()]
+            n = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while(n < self.max_batch_size):
+                timeout = deadline - loop.time()
+                if(timeout <= 0):
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                n += len(item[0])
+
+            vectors = [v for vecs,_ in pending for v in vecs]
+            try:
+                macs, scores = await loop.run_in_executor(None, self.score_batch, vectors)
+            except Exception as e:
+                if(len(pending) == 1):
+                    pending[0][1].set_exception(e)
+                    continue
+                # a request passed the validation but still breaks the batch: the requests are
+                # scored one by one such that only the faulty ones fail
+                for vecs,future in pending:
+                    try:
+                        macs, scores = await loop.run_in_executor(None, self.score_batch, vecs)
+                    except Exception as e:
+                        future.set_exception(e)
+                        continue
+                    self.batch_sizes.append(len(vecs))
+                    future.set_result([{'mac': str(m), 'score': float(s)} for m,s in zip(macs, scores)])
+                continue
+            self.batch_sizes.append(len(vectors))
+
+            # each request gets back the scores of its own vectors
+            start = 0
+            for vecs,future in pending:
+                end = start + len(vecs)
+                future.set_result([{'mac': str(m), 'score': float(s)} for m,s in zip(macs[start:end], scores[start:end])])
+                start = end
+
+    async def score(self, vectors):
+        """
+        Scores the raw vectors of a request once its micro-batch has been processed, the vectors
+        are validated first (see validate)
+
+        Parameters
+        -------------
+        vectors: list(dict)
+            the raw vectors
+
+        Returns
+        -------------
+        scores: list(dict)
+            the mac and the probability to be sick of each vector
+        """
+        self.validate(vectors)
+        start = timeit.default_timer()
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((vectors, future))
+        result = await future
+        self.latencies.append(timeit.default_timer() - start)
+        self.n_requests += 1
+        self.n_vectors += len(vectors)
+        return result
+
+    def get_metrics(self):
+        """
+        Returns the latency percentiles (in ms) of the last requests and statistics on the batch sizes
+
+        Returns
+        -------------
+        metrics: dict
+        """
+        metrics = {'n_requests': self.n_requests, 'n_vectors': self.n_vectors, 'n_batches': len(self.batch_sizes)}
+        if(len(self.latencies) != 0):
+            latencies = 1000*np.array(self.latencies)
+            metrics.update({'latency_p50_ms': float(np.percentile(latencies, 50)),
+                            'latency_p99_ms': float(np.percentile(latencies, 99)),
+                            'latency_max_ms': float(latencies.max())})
+        if(len(self.batch_sizes) != 0):
+            sizes = np.array(self.batch_sizes)
+            metrics.update({'batch_size_mean': float(sizes.mean()),
+                            'batch_size_p50': float(np.percentile(sizes, 50)),
+                            'batch_size_max': int(sizes.max())})
+        return metrics
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------HTTP service----------------------------------------
+### --------------------------------------------------------------------------------------------
+async def handle_connection(scorer, reader, writer, max_body_bytes = MAX_BODY_BYTES):
+    """
+    Serves the (keep-alive) HTTP requests of a connection
+
+    Parameters
+    -------------
+    scorer: MicroBatchScorer
+        the scorer shared by all connections
+    reader, writer: asyncio streams
+        the connection
+    max_body_bytes: int, default MAX_BODY_BYTES
+        the largest body that is read, the connection is answered with 413 and closed
+        (without reading the body) above it
+    """
+    try:
+        while(True):
+            request_line = await reader.readline()
+            if(not request_line):
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+            headers = {}
+            while(True):
+                line = await reader.readline()
+                if(line in (b'\r\n', b'\n', b'')):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            content_length = int(headers.get('content-length', 0))
+            too_large = content_length > max_body_bytes
+            body = b'' if too_large else await reader.readexactly(content_length)
+
+            status = '200 OK'
+            try:
+                if(too_large):
+                    status, response = '413 Payload Too Large', {'error': 'body of {} bytes over the limit of {}'.format(content_length, max_body_bytes)}
+                elif(method == 'POST' and path == '/score'):
+                    payload = json.loads(body)
+                    vectors = payload['vectors'] if 'vectors' in payload else [payload]
+                    response = {'scores': await scorer.score(vectors)}
+                elif(method == 'GET' and path == '/metrics'):
+                    response = scorer.get_metrics()
+                else:
+                    status, response = '404 Not Found', {'error': 'unknown endpoint {} {}'.format(method, path)}
+            except Exception as e:
+                status, response = '400 Bad Request', {'error': repr(e)}
+
+            data = json.dumps(response).encode('utf-8')
+            writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(status, len(data)).encode('latin-1') + data)
+            await writer.drain()
+            if(too_large or headers.get('connection', '').lower() == 'close'):
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(model, feature_columns, host = '127.0.0.1', port = 8080, max_batch_size = 256, max_wait_ms = 5, hw_models_2_id = None,
+                removed_features = None, max_body_bytes = MAX_BODY_BYTES):
+    """
+    Starts the scoring service and serves until cancelled
+
+    Parameters
+    -------------
+    model: sklearn pipeline or model on which we can call predict_proba()
+        the fitted pipeline
+    feature_columns: list(str)
+        the columns of the feature vectors expected by the model
+    host: str, default '127.0.0.1'
+    port: int, default 8080
+    max_batch_size: int, default 256
+        the maximum number of vectors scored at once
+    max_wait_ms: float, default 5
+        the maximum time a vector waits for others to fill its batch
+    hw_models_2_id: dict(str -> int), optional
+        the hardware model indices used during training
+    removed_features: list(str), optional
+        the column plan of remove_features used during training
+    max_body_bytes: int, default MAX_BODY_BYTES
+        the largest request body that is accepted
+    """
+    scorer = MicroBatchScorer(model, feature_columns, max_batch_size, max_wait_ms, hw_models_2_id, removed_features)
+    batching = asyncio.ensure_future(scorer.run())
+    server = await asyncio.start_server(lambda r,w: handle_connection(scorer, r, w, max_body_bytes), host, port)
+    print('Serving on {}:{}'.format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batching.cancel()
+
+def main(argv = None):
+    """
+    Command line entry point, see the module documentation or --help
+    """
+    parser = argparse.ArgumentParser(description = 'Local HTTP service scoring CPEs on demand.')
+    parser.add_argument('model', help = 'model artifact folder or pickled fitted pipeline (or dict with model and feature_columns)')
+    parser.add_argument('--columns', default = None, help = 'text file with the feature columns of the model')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8080)
+    parser.add_argument('--max-batch-size', type = int, default = 256)
+    parser.add_argument('--max-wait-ms', type = float, default = 5)
+    parser.add_argument('--max-body-bytes', type = int, default = MAX_BODY_BYTES)
+    args = parser.parse_args(argv)
+
+    model, feature_columns, hw_models_2_id, removed_features = load_model(args.model, args.columns)
+    try:
+        asyncio.run(serve(model, feature_columns, args.host, args.port, args.max_batch_size, args.max_wait_ms,
+                          hw_models_2_id, removed_features, args.max_body_bytes))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Module containing a generator of synthetic CPE vectors having the schema of the samples
+    extracted from VECTOR_FIVE_DAYS_II (see packages/package_DMT.sql): the identifiers, the
+    cmts/service_group and hardware_model strings of each CPE, the measurement families with
+    their _6h.._5d windows and miss_* flags, the CMTS measurements shared by all the CPEs of a
+    cmts, and the sparse milestone_name of the CPEs that called the VIA the following days.
+    The values only mimic the ranges of the real samples (most CPEs are healthy and flat, the
+    sick ones are noisier, more often offline and with more missing measurements), they are
+    meant to benchmark and load-test the pipeline, not to study the failures.
+
+    The vectors are written in partitions (one file per day and block of CPEs) generated in
+    parallel, each partition has its own seed such that the output does not depend on the
+    number of processes. It can be used as a command line tool, e.g. (from the analysis folder):
+
+        python -m scripts.synthetic Data/synthetic --n-days 30 --n-cpes 200000 --start 2018-06-04
+"""
+__author__ = "Hugo Moreau"
+__email__ = "hugo.moreau@epfl.ch"
+__status__ = "Prototype"
+
+import os
+import glob
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from scripts.utils import HW_MODELS_2_ID
+
+# the windows of the measurements (the day_0 value has no suffix)
+HOUR_WINDOWS = ['_6H','_12H','_18H']
+DAY_WINDOWS = ['_1D','_2D','_3D','_4D','_5D']
+
+# the measurement families of the CPEs, with their typical scale and the ratio of missing values
+CPE_FAMILIES = {'CER_DN': (0.03, 0.03),
+                'CER_UP': (0.03, 0.10),
+                'PCT_TRAFFIC_DMH_UP': (5., 0.03),
+                'PCT_TRAFFIC_SDMH_UP': (5., 0.03),
+                'RX_DN': (2., 0.06),
+                'RX_UP': (2., 0.06),
+                'SNR_DN': (1., 0.04),
+                'SNR_UP': (1., 0.04),
+                'TX_UP': (2., 0.04)}
+
+# the measurement families of the CMTS, with their typical scale
+CMTS_FAMILIES = {'CMTS_RX_UP': 1.,
+                 'CMTS_TX_UP': 1.,
+                 'CMTS_CER_UP': 0.01,
+                 'CMTS_UTILIZATION_UP': 5.,
+                 'CMTS_MS_UTILIZATION_UP': 5.,
+                 'CMTS_F_MS_UTILIZATION_UP': 5.,
+                 'CMTS_RX_DN': 1.,
+                 'CMTS_SNR_DN': 1.,
+                 'CMTS_CCER_DN': 0.01,
+                 'CMTS_CER_DN': 0.01,
+                 'CMTS_UTILIZATION_DN': 5.}
+
+# the milestones reached by the sick CPEs, with their frequencies in the extracted samples
+MILESTONES = {'internet.noconnection.start': 2907,
+              'internet.interruption.start': 487,
+              'internet.performance.start': 187,
+              'internet.services.connectapp.start': 88,
+              'internet.wifree.start': 47,
+              'tv.check': 15,
+              'internet.installation.powerline.start': 2}
+
+# the frequency of each hardware model
+HW_MODEL_WEIGHTS = [0.35, 0.12, 0.08, 0.10, 0.15, 0.12, 0.08]
+
+# the prefixes of the mac addresses (vendors)
+MAC_PREFIXES = ['0CEEE6', '0024D1', '002624', '905C44', 'C427CA']
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Schema----------------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_measurement_columns():
+    """
+    Returns the measurement columns of VECTOR_FIVE_DAYS_II in the order of the table: the values
+    of a family have no _24H window (the day_0 value is the 24 hours one) while its miss_* flags
+    have both
+
+    Returns
+    -------------
+    columns: list(str)
+    """
+    columns = ['OFFLINE_PCT' + w for w in HOUR_WINDOWS + ['_24H', ''] + DAY_WINDOWS]
+    for family in CPE_FAMILIES:
+        columns += [family + w for w in HOUR_WINDOWS + [''] + DAY_WINDOWS]
+        columns += ['MISS_' + family + w for w in HOUR_WINDOWS + ['_24H', ''] + DAY_WINDOWS]
+    for family in CMTS_FAMILIES:
+        columns += [family + w for w in HOUR_WINDOWS + [''] + DAY_WINDOWS]
+    return columns
+
+def get_sample_columns():
+    """
+    Returns all the columns of an extracted sample (as in SAMPLED_VECTORS)
+
+    Returns
+    -------------
+    columns: list(str)
+    """
+    return ['DAY_0','MAC','CLY_ACCOUNT_NUMBER','SAA_ACCOUNT_NUMBER','CMTS','SERVICE_GROUP','HARDWARE_MODEL',
+            'N_CPE_BUILDING'] + get_measurement_columns() + ['SEQ_ID','MILESTONE_NAME']
+
+def get_partition_path(output_dir, day, block, file_format='csv'):
+    """
+    Returns the path of the partition of a day and block of CPEs
+
+    Parameters
+    -------------
+    output_dir: str
+    day: pandas Timestamp
+    block: int
+    file_format: str, default 'csv'
+        one of 'csv', 'pk' or 'xlsx'
+
+    Returns
+    -------------
+    path: str
+    """
+    return os.path.join(output_dir, 'vectors_{}_part{:04d}.{}'.format(day.strftime('%Y_%m_%d'), block, file_format))
+
+def list_partitions(output_dir, day=None):
+    """
+    Returns the sorted paths of the partitions written in a folder
+
+    Parameters
+    -------------
+    output_dir: str
+    day: str, optional
+        if set, only the partitions of this day_0 are returned (e.g. '2018-06-04')
+
+    Returns
+    -------------
+    paths: list(str)
+    """
+    pattern = 'vectors_{}_part*.*'.format('*' if day is None else pd.Timestamp(day).strftime('%Y_%m_%d'))
+    return sorted(glob.glob(os.path.join(output_dir, pattern)))
+
+def read_partitions(paths):
+    """
+    Reads and concatenates partitions written by generate_dataset (raw vectors, as read from the
+    source files, see utils.transform_raw_sample)
+
+    Parameters
+    -------------
+    paths: list(str)
+
+    Returns
+    -------------
+    df: pandas DataFrame
+    """
+    dfs = []
+    for path in paths:
+        if(path.endswith('.csv')):
+            dfs.append(pd.read_csv(path))
+        elif(path.endswith('.pk')):
+            dfs.append(pd.read_pickle(path))
+        else:
+            dfs.append(pd.read_excel(path))
+    return pd.concat(dfs, ignore_index=True)
+
+### --------------------------------------------------------------------------------------------
+### ----------------------------------------Generation------------------------------------------
+### --------------------------------------------------------------------------------------------
+def get_partition_rng(seed, *keys):
+    """
+    Returns an independent random generator for each key: (0, block) for the static attributes
+    of the CPEs of a block, (1, day_index, block) for the vectors of a partition and (2, day_index)
+    for the CMTS measurements of a day
+
+    Parameters
+    -------------
+    seed: int
+    keys: int
+
+    Returns
+    -------------
+    rng: numpy Generator
+    """
+    return np.random.default_rng(np.random.SeedSequence([seed] + list(keys)))
+
+def generate_cpes(cpe_ids, n_cmts, seed):
+    """
+    Generates the static attributes of CPEs (the same whatever the day)
+
+    Parameters
+    -------------
+    cpe_ids: numpy ndarray
+        the indices of the CPEs (consecutive, starting at a multiple of the partition size)
+    n_cmts: int
+        the number of cmts
+    seed: int
+
+    Returns
+    -------------
+    cpes_df: pandas DataFrame
+        MAC, CLY_ACCOUNT_NUMBER, SAA_ACCOUNT_NUMBER, CMTS, SERVICE_GROUP, HARDWARE_MODEL,
+        N_CPE_BUILDING and the index of the cmts of each CPE
+    """
+    rng = get_partition_rng(seed, 0, int(cpe_ids[0]))
+    n = len(cpe_ids)
+    # the mac addresses are unique up to len(MAC_PREFIXES)*16**6 CPEs
+    prefixes = np.array(MAC_PREFIXES)[cpe_ids % len(MAC_PREFIXES)]
+    macs = [p + format(i, '06X') for p, i in zip(prefixes, (cpe_ids // len(MAC_PREFIXES)) % 16**6)]
+    accounts = 100000 + cpe_ids*7 + rng.integers(0, 7, n)
+
+    cmts_index = rng.integers(0, n_cmts, n)
+    hw_models = np.array(list(HW_MODELS_2_ID.keys()))
+    return pd.DataFrame({'MAC': macs,
+                         'CLY_ACCOUNT_NUMBER': accounts,
+                         'SAA_ACCOUNT_NUMBER': accounts,
+                         'CMTS': ['ch-mbc' + ''.join(chr(65 + (c//26**k)%26) for k in range(3)) + '301' for c in cmts_index],
+                         'SERVICE_GROUP': ['RW{}'.format(1 + (c*13 + s)%120) for c, s in zip(cmts_index, rng.integers(0, 8, n))],
+                         'HARDWARE_MODEL': hw_models[rng.choice(len(hw_models), n, p=HW_MODEL_WEIGHTS)],
+                         'N_CPE_BUILDING': np.maximum(1, np.round(rng.lognormal(np.log(6), 0.8, n))).astype(np.int64),
+                         'cmts_index': cmts_index})
+
+def generate_window_values(rng, n, scale, sick, zero_ratio=0.6):
+    """
+    Generates the values of a measurement family over its windows: each vector has a level
+    around which its windows vary, many values are exactly 0 (no change) and the sick vectors
+    are noisier
+
+    Parameters
+    -------------
+    rng: numpy Generator
+    n: int
+        the number of vectors
+    scale: float
+        the typical scale of the measurement
+    sick: numpy ndarray
+        whether each vector is sick
+    zero_ratio: float, default 0.6
+        the ratio of values set to 0 among the healthy vectors
+
+    Returns
+    -------------
+    values: numpy ndarray
+        n by 9 array (windows _6H, _12H, _18H, day_0, _1D, ..., _5D)
+    """
+    noise = np.where(sick, 3*scale, scale)[:,None]
+    level = rng.laplace(0, 1, (n, 1))*noise
+    values = level + rng.laplace(0, 0.5, (n, 9))*noise
+    zeros = rng.random((n, 9)) < np.where(sick, zero_ratio/2, zero_ratio)[:,None]
+    values[zeros] = 0
+    return values
+
+def generate_partition(output_dir, day, day_index, block, partition_size, n_cpes, n_cmts, sick_rate, seed, file_format='csv'):
+    """
+    Generates and writes the vectors of a day for a block of CPEs
+
+    Parameters
+    -------------
+    output_dir: str
+    day: pandas Timestamp
+        the day_0 of the vectors
+    day_index: int
+        the index of the day since the first one
+    block: int
+        the index of the block of CPEs
+    partition_size: int
+        the number of CPEs in each block
+    n_cpes: int
+        the total number of CPEs
+    n_cmts: int
+        the number of cmts
+    sick_rate: float
+        the ratio of sick vectors
+    seed: int
+    file_format: str, default 'csv'
+        one of 'csv', 'pk' or 'xlsx'
+
+    Returns
+    -------------
+    path: str
+        the path of the partition
+    n_vectors: int
+    n_sick: int
+    """
+    cpe_ids = np.arange(block*partition_size, min((block + 1)*partition_size, n_cpes))
+    n = len(cpe_ids)
+    df = generate_cpes(cpe_ids, n_cmts, seed)
+    rng = get_partition_rng(seed, 1, day_index, block)
+    sick = rng.random(n) < sick_rate
+
+    columns = {}
+    # percentage of time offline, most CPEs are always online
+    offline = rng.random((n, 10)) < np.where(sick, 0.3, 0.03)[:,None]
+    columns.update(zip(['OFFLINE_PCT' + w for w in HOUR_WINDOWS + ['_24H', ''] + DAY_WINDOWS],
+                       (np.round(offline*rng.beta(0.6, 1.5, (n, 10))*100, 4)).T))
+    for family, (scale, missing_ratio) in CPE_FAMILIES.items():
+        values = generate_window_values(rng, n, scale, sick)
+        # the ratio of missing values is larger for the short windows
+        missing = rng.random((n, 9)) < missing_ratio*np.array([1.5, 1.3, 1.1, 0.5, 1, 1, 1, 1, 1])*np.where(sick, 2, 1)[:,None]
+        values[missing] = np.nan
+        columns.update(zip([family + w for w in HOUR_WINDOWS + [''] + DAY_WINDOWS], values.T))
+        miss = rng.random((n, 10)) < np.where(sick, 0.15, 0.04)[:,None]
+        columns.update(zip(['MISS_' + family + w for w in HOUR_WINDOWS + ['_24H', ''] + DAY_WINDOWS],
+                           (np.round(miss*rng.beta(0.5, 1.5, (n, 10))*100, 4)).T))
+
+    # the CMTS measurements are shared by all the CPEs of a cmts (and do not depend on the block)
+    cmts_rng = get_partition_rng(seed, 2, day_index)
+    for family, scale in CMTS_FAMILIES.items():
+        values = generate_window_values(cmts_rng, n_cmts, scale, np.zeros(n_cmts, dtype=bool), zero_ratio=0.2)
+        columns.update(zip([family + w for w in HOUR_WINDOWS + [''] + DAY_WINDOWS], values[df['cmts_index'].values].T))
+
+    milestones = np.array(list(MILESTONES.keys()))
+    weights = np.array(list(MILESTONES.values()), dtype=np.float64)
+    milestone_name = np.full(n, None, dtype=object)
+    milestone_name[sick] = milestones[rng.choice(len(milestones), sick.sum(), p=weights/weights.sum())]
+
+    df = pd.concat([df.drop(columns='cmts_index'), pd.DataFrame(columns)], axis=1)
+    df['DAY_0'] = day
+    df['SEQ_ID'] = day_index*n_cpes + cpe_ids + 1
+    df['MILESTONE_NAME'] = milestone_name
+    df = df[get_sample_columns()]
+
+    path = get_partition_path(output_dir, day, block, file_format)
+    if(file_format == 'csv'):
+        # the dates are read with dayfirst=True (see utils.transform_raw_sample)
+        df.to_csv(path, index=False, date_format='%d/%m/%Y', float_format='%.6g')
+    elif(file_format == 'pk'):
+        df.to_pickle(path)
+    else:
+        df.to_excel(path, index=False)
+    return path, n, int(sick.sum())
+
+def generate_dataset(output_dir, n_days=30, n_cpes=100000, start='2018-06-04', sick_rate=0.003, n_cmts=150,
+                     partition_size=50000, file_format='csv', n_jobs=-1, seed=0, verbose=True):
+    """
+    Generates synthetic vectors for every CPE and day and writes them in partitions (one per day
+    and block of partition_size CPEs) generated in parallel.
+
+    Parameters
+    -------------
+    output_dir: str
+        the folder where the partitions are written (created if needed)
+    n_days: int, default 30
+        the number of consecutive days
+    n_cpes: int, default 100000
+        the number of CPEs (each has a vector every day)
+    start: str, default '2018-06-04'
+        the first day_0
+    sick_rate: float, default 0.003
+        the ratio of vectors of CPEs that call the VIA (the extracted samples keep all the sick
+        CPEs and subsample the healthy ones, their ratio of sick vectors is much larger)
+    n_cmts: int, default 150
+        the number of cmts
+    partition_size: int, default 50000
+        the number of CPEs in each partition
+    file_format: str, default 'csv'
+        one of 'csv', 'pk' or 'xlsx' (what import_sample reads, but slow to write)
+    n_jobs: int, default -1
+        the number of processes (-1 for all cores)
+    seed: int, default 0
+    verbose: boolean, default True
+        can be set to False to not print the summary
+
+    Returns
+    -------------
+    partitions_df: pandas DataFrame
+        the path, day, number of vectors and of sick vectors of each partition
+    """
+    assert(file_format in ['csv','pk','xlsx']), 'file_format must be one of csv, pk or xlsx'
+    start_time = timeit.default_timer()
+    if(not os.path.isdir(output_dir)):
+        os.makedirs(output_dir)
+    days = pd.date_range(start, periods=n_days, freq='D')
+    n_blocks = int(np.ceil(n_cpes/partition_size))
+
+    tasks = [(d, i, b) for i, d in enumerate(days) for b in range(n_blocks)]
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(generate_partition)(output_dir, d, i, b, partition_size, n_cpes, n_cmts, sick_rate, seed, file_format)
+        for d, i, b in tasks)
+
+    partitions_df = pd.DataFrame({'path': [r[0] for r in results],
+                                  'day_0': [d for d,_,_ in tasks],
+                                  'n_vectors': [r[1] for r in results],
+                                  'n_sick': [r[2] for r in results]})
+    if(verbose):
+        print('Generated {} vectors ({} sick) in {} partitions ({}s)'.format(partitions_df.n_vectors.sum(), partitions_df.n_sick.sum(),
+                                                                            len(partitions_df), round(timeit.default_timer() - start_time, 4)))
+    return partitions_df
+
+def main(argv = None):
+    """
+    Command line entry point, see the module documentation or --help
+    """
+    parser = argparse.ArgumentParser(description = 'Generates synthetic CPE vectors with the schema of VECTOR_FIVE_DAYS_II.')
+    parser.add_argument('output', help = 'folder where the partitions are written')
+    parser.add_argument('--n-days', type = int, default = 30)
+    parser.add_argument('--n-cpes', type = int, default = 100000)
+    parser.add_argument('--start', default = '2018-06-04', help = 'first day_0 (YYYY-MM-DD)')
+    parser.add_argument('--sick-rate', type = float, default = 0.003)
+    parser.add_argument('--n-cmts', type = int, default = 150)
+    parser.add_argument('--partition-size', type = int, default = 50000)
+    parser.add_argument('--format', default = 'csv', choices = ['csv','pk','xlsx'])
+    parser.add_argument('--n-jobs', type = int, default = -1)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args(argv)
+
+    generate_dataset(args.output, args.n_days, args.n_cpes, args.start, args.sick_rate, args.n_cmts,
+                     args.partition_size, args.format, args.n_jobs, args.seed)
+
+if __name__ == '__main__':
+    main()
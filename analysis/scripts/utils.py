@@ -10,13 +10,26 @@ __email__ = "hugo.moreau@epfl.ch"
 __status__ = "Prototype"
 
 import os,re,sys
+import numpy as np
 import pandas as pd
 import copy
 from datetime import timedelta
 
-from scripts.preprocessing import *
-from scripts.model_selection import *
-from scripts.plot import *
+from scripts.preprocessing import convert_to_binary_labels, encode_categorical, remove_features
+
+# the index given to each hardware model when none is provided to import_sample
+HW_MODELS_2_ID = { 'CONNECT BOX CH7465LG COMPAL': 0,
+                   'UBEE EVM3206 (ED 3.0) - CPE': 1,
+                   'UBEE EVM3236 (ED 3.0) - CPE': 2,
+                   'WLAN MODEM EVW3226 - CPE': 3,
+                   'WLAN MODEM TC7200 - CPE': 4,
+                   'WLAN MODEM TC7200 V2 - CPE': 5,
+                   'WLAN MODEM TWG870 - CPE': 6}
+
+# the columns of the samples that are not features of the ML
+NON_FEATURE_COLS = ['mac','day_0','cly_account_number',
+                    'saa_account_number','cmts','service_group',
+                    'seq_id','milestone_name']
 
 
 ### --------------------------------------------------------------------------------------------
@@ -73,11 +86,8 @@ def get_longest_date_seq(dates,verbose = True):
     curr_seq = []
     curr_l = 0
 
-    for d in days[1:]:
-        if len(curr_seq)==0:
-            curr_seq = [d]
-            curr_l = 1
-        elif(d == curr_seq[-1] + timedelta(days=1)):
+    for d in days:
+        if(len(curr_seq) != 0 and d == curr_seq[-1] + timedelta(days=1)):
             curr_seq.append(d)
             curr_l += 1
         else:
@@ -85,9 +95,12 @@ def get_longest_date_seq(dates,verbose = True):
                 # we replace the max sequence only if it is longer than the max one
                 max_seq = copy.deepcopy(curr_seq)
                 max_l = curr_l
-
-                curr_seq = []
-                curr_l = 0
+            curr_seq = [d]
+            curr_l = 1
+    if(curr_l > max_l):
+        # the last sequence is only closed once all days have been seen
+        max_seq = curr_seq
+        max_l = curr_l
     if(verbose):
         print('The longuest sequence of dates has length {}:\n\tS: {}\n\tE: {}'.format(max_l,max_seq[0],max_seq[-1]))        
     return max_seq
@@ -221,33 +234,7 @@ def import_sample(source_excel_path, dump_file_path, hw_models_2_id = None, dele
             df = pd.read_excel(source_excel_path)
             
             print('Performing some transformation')
-            # we lower case the column names
-            df.columns = map(str.lower, df.columns)
-            original_cols = list(df.columns)
-
-            # transforming dates to datetime and adding week day
-            df['day_0'] = pd.to_datetime(df['day_0'],dayfirst = True)
-            df['weekday'] = df['day_0'].apply(lambda x : x.weekday())
-
-            # converting the hardware model to an ID
-            translator = hw_models_2_id if hw_models_2_id else { 'CONNECT BOX CH7465LG COMPAL': 0,
-                                                                 'UBEE EVM3206 (ED 3.0) - CPE': 1,
-                                                                 'UBEE EVM3236 (ED 3.0) - CPE': 2,
-                                                                 'WLAN MODEM EVW3226 - CPE': 3,
-                                                                 'WLAN MODEM TC7200 - CPE': 4,
-                                                                 'WLAN MODEM TC7200 V2 - CPE': 5,
-                                                                 'WLAN MODEM TWG870 - CPE': 6}
-            df['hardware_model'] = df['hardware_model'].map(translator)
-
-            # transforming categories
-            df['cmts'] = df['cmts'].astype('category')
-            df['service_group'] = df['service_group'].astype('category')
-            df['milestone_name'] = df['milestone_name'].astype('category')
-            df['weekday'] = df['weekday'].astype('category')            
-
-            # we reorganise the columns
-            new_cols = ['weekday'] + original_cols
-            df = df[new_cols]
+            df = transform_raw_sample(df,hw_models_2_id)
 
             if(delete_only_healthy_days):
                 # we only keep the days during which there are at least 1 sick CPE
@@ -272,6 +259,48 @@ def import_sample(source_excel_path, dump_file_path, hw_models_2_id = None, dele
     print('The sample is composed of : {} vectors of dimension {}\n\tn_sick\t\t= {:>6}\n\tn_healthy\t= {:>6}'.format(n_total,dimensions,n_sick,n_healthy))
     return df
 
+def transform_raw_sample(df, hw_models_2_id = None):
+    """
+    Performs the transformations of import_sample on a raw dataframe (as read from the 
+    source files), it is also used on each chunk of vectors that are scored in production:
+    * convert column names to lowercase
+    * convert the dates to correct format and add the week day
+    * translate the hardware model to a unique index
+    * convert categorical features to categorical
+
+    Parameters
+    -------------
+    df: pandas Dataframe
+        the raw vectors
+    hw_models_2_id: dict(str -> int), optional
+        a dictionnary mapping the hardware model strings to indices (HW_MODELS_2_ID if not set)
+
+    Returns
+    -------------
+    df: pandas Dataframe
+        the transformed vectors (with the weekday as first column)
+    """
+    # we lower case the column names
+    df.columns = map(str.lower, df.columns)
+    original_cols = list(df.columns)
+
+    # transforming dates to datetime and adding week day
+    df['day_0'] = pd.to_datetime(df['day_0'],dayfirst = True)
+    df['weekday'] = df['day_0'].dt.weekday
+
+    # converting the hardware model to an ID
+    translator = hw_models_2_id if hw_models_2_id else HW_MODELS_2_ID
+    df['hardware_model'] = df['hardware_model'].map(translator)
+
+    # transforming categories (the label is unknown when scoring)
+    for col in ['cmts','service_group','milestone_name','weekday']:
+        if(col in df.columns):
+            df[col] = df[col].astype('category')
+
+    # we reorganise the columns
+    new_cols = ['weekday'] + original_cols
+    return df[new_cols]
+
 def get_ml_data(extracted_df,verbose = False):
     """
     Using the extracted dataframe, this function will return a dataframe that correspond to 
@@ -291,10 +320,7 @@ def get_ml_data(extracted_df,verbose = False):
     targets: pandas Serie
         the labels of each sample in inputs
     """
-    non_feature_cols = ['mac','day_0','cly_account_number',
-                    'saa_account_number','cmts','service_group',
-                    'seq_id','milestone_name']
-    feature_cols = [x for x in list(extracted_df.columns) if x not in non_feature_cols]
+    feature_cols = [x for x in list(extracted_df.columns) if x not in NON_FEATURE_COLS]
     
     if(verbose):
         print('We are working with {} features'.format(len(feature_cols)))